@@ -3,8 +3,13 @@
 '''
 # Import python libs
 from distutils.version import LooseVersion
+import asyncio
+import hashlib
+import json
 import logging
 import os
+import time
+from typing import Any, Dict
 
 # Import 3rd party libs
 import aiohttp
@@ -13,22 +18,218 @@ __virtualname__ = 'salt'
 
 log = logging.getLogger(__name__)
 
+REPO_URL = 'https://repo.saltstack.com/salt-bin'
 
-async def fetch(hub, session, url, download=False, location=False):
+# The size of the chunks artifacts are streamed to disk in
+CHUNK_SIZE = 1024 * 1024
+
+
+def __init__(hub):
+    '''
+    Set up the shared client session and the table of downloads in flight
+    '''
+    hub.artifact.salt.SESSION = None
+    hub.artifact.salt.DOWNLOADS = {}
+    hub.artifact.salt.REPO = {}
+    hub.artifact.salt.REPO_FUTURE = None
+
+
+def session(hub) -> aiohttp.ClientSession:
+    '''
+    Return the client session shared by every request this plugin makes so
+    that connections to the repo are pooled
+    '''
+    if hub.artifact.salt.SESSION is None or hub.artifact.salt.SESSION.closed:
+        hub.artifact.salt.SESSION = aiohttp.ClientSession()
+    return hub.artifact.salt.SESSION
+
+
+async def close(hub):
+    '''
+    Close the shared client session
+    '''
+    if hub.artifact.salt.SESSION is not None:
+        await hub.artifact.salt.SESSION.close()
+        hub.artifact.salt.SESSION = None
+
+
+def _hash_file(path: str, digest) -> int:
+    '''
+    Feed the contents of the file into the digest and return its size
+    '''
+    size = 0
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return size
+
+
+def _write(fp, digest, chunk: bytes):
+    '''
+    Write the chunk to the file and feed it into the digest
+    '''
+    fp.write(chunk)
+    digest.update(chunk)
+
+
+async def _stream(hub, session, url, location, sha256=None):
+    '''
+    Stream the url to the location in chunks, the file is written in the
+    loop's executor and hashed as it is written. If the location already
+    holds part of the file the download resumes from the end of it
+    '''
+    loop = asyncio.get_event_loop()
+    digest = hashlib.sha256()
+    offset = 0
+    if os.path.exists(location):
+        offset = await loop.run_in_executor(None, _hash_file, location, digest)
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    async with session.get(url, headers=headers) as resp:
+        if resp.status == 206 and offset:
+            log.info(f'Resuming the download of {url} at byte {offset}')
+            mode = 'ab'
+        elif resp.status == 200:
+            digest = hashlib.sha256()
+            mode = 'wb'
+        elif resp.status == 416 and offset:
+            # The partial file is already complete
+            mode = None
+        else:
+            log.critical(f'Cannot query url {url}. Returncode {resp.status} returned')
+            return False
+        if mode:
+            fp = await loop.run_in_executor(None, open, location, mode)
+            try:
+                async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                    await loop.run_in_executor(None, _write, fp, digest, chunk)
+            finally:
+                await loop.run_in_executor(None, fp.close)
+    if sha256 and digest.hexdigest() != sha256.lower():
+        log.critical(f'The checksum of {url} does not match the repo, '
+                     f'expected {sha256} got {digest.hexdigest()}')
+        os.remove(location)
+        return False
+    return location
+
+
+async def fetch(hub, session, url, download=False, location=False, sha256=None):
     '''
     Fetch a url and return json. If downloading artifact
-    return the download location.
+    return the download location. Downloads are streamed to disk, resumed
+    from a partial file at the location and checked against the sha256 if
+    one is given
     '''
+    if download:
+        return await _stream(hub, session, url, location, sha256=sha256)
     async with session.get(url) as resp:
         if resp.status == 200:
-            if download:
-                with open(location, 'wb') as fn_:
-                    fn_.write(await resp.read())
-                return location
             return await resp.json()
         log.critical(f'Cannot query url {url}. Returncode {resp.status} returned')
         return False
 
+
+def _read_index(path: str) -> Dict[str, Any]:
+    '''
+    Read the repo index persisted on disk
+    '''
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_index(path: str, index: Dict[str, Any]):
+    '''
+    Atomically persist the repo index to disk
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as fp:
+        json.dump(index, fp)
+    os.replace(tmp, path)
+
+
+def _latest_versions(data: Dict[str, Any]) -> Dict[str, str]:
+    '''
+    Return the newest version of the binary for every os in the repo data
+    '''
+    ret = {}
+    for t_os, binaries in data.items():
+        vers = [b['version'] for b in binaries.values()
+                if isinstance(b, dict) and 'version' in b]
+        if vers:
+            ret[t_os] = max(vers, key=LooseVersion)
+    return ret
+
+
+async def _load_repo(hub) -> Dict[str, Any]:
+    '''
+    Load the repo index from disk and revalidate it with the repo once its
+    ttl has passed. A stale index is used if the repo cannot be reached
+    '''
+    loop = asyncio.get_event_loop()
+    path = os.path.join(hub.OPT['heist']['artifacts_dir'], 'repo.json')
+    index = await loop.run_in_executor(None, _read_index, path)
+    if index and time.time() - index.get('fetched', 0) < hub.OPT['heist']['repo_ttl']:
+        return index
+
+    url = f'{REPO_URL}/repo.json'
+    headers = {}
+    if index.get('etag'):
+        headers['If-None-Match'] = index['etag']
+    if index.get('last_modified'):
+        headers['If-Modified-Since'] = index['last_modified']
+    try:
+        async with hub.artifact.salt.session().get(url, headers=headers) as resp:
+            if resp.status == 304 and index:
+                log.debug(f'The repo index at {url} has not changed')
+            elif resp.status == 200:
+                index = {'etag': resp.headers.get('ETag'),
+                         'last_modified': resp.headers.get('Last-Modified'),
+                         'data': await resp.json(content_type=None)}
+            else:
+                log.critical(f'Cannot query url {url}. Returncode {resp.status} returned')
+                return index
+    except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+        log.critical(f'Cannot query url {url}: {exc!r}')
+        return index
+    index['fetched'] = time.time()
+    index['latest'] = _latest_versions(index['data'])
+    await loop.run_in_executor(None, _write_index, path, index)
+    return index
+
+
+async def _refresh(hub):
+    '''
+    Load the repo index and make it the index for this run
+    '''
+    index = await _load_repo(hub)
+    if index.get('data'):
+        hub.artifact.salt.REPO = dict(
+            index, expires=time.monotonic() + hub.OPT['heist']['repo_ttl'])
+
+
+async def repo(hub) -> Dict[str, Any]:
+    '''
+    Return the repo index, a dict with the repo metadata under ``data`` and
+    the newest version for every os under ``latest``. The index is shared by
+    every target, concurrent callers wait on a single load
+    '''
+    if hub.artifact.salt.REPO and hub.artifact.salt.REPO['expires'] > time.monotonic():
+        return hub.artifact.salt.REPO
+    if hub.artifact.salt.REPO_FUTURE is None:
+        future = asyncio.ensure_future(_refresh(hub))
+        hub.artifact.salt.REPO_FUTURE = future
+
+        def _done(_):
+            hub.artifact.salt.REPO_FUTURE = None
+        future.add_done_callback(_done)
+    await asyncio.shield(hub.artifact.salt.REPO_FUTURE)
+    return hub.artifact.salt.REPO
+
+
 async def get_version(hub, t_os):
     '''
     Query latest version from repo if user does not define version
@@ -37,22 +238,14 @@ async def get_version(hub, t_os):
     if ver:
         return ver
 
-    url = 'https://repo.saltstack.com/salt-bin/repo.json'
-    async with aiohttp.ClientSession() as session:
-        data = await hub.artifact.salt.fetch(session, url)
-        if not data:
-            log.critical(f'Query to {url} failed, falling back to'
-                         f'pre-downloaded artifacts')
-            return False
-        # we did not set version so query latest version from the repo
-        for binary in data[t_os]:
-            b_ver = data[t_os][binary]['version']
-            if not ver:
-                ver = b_ver
-                continue
-            if LooseVersion(b_ver) > LooseVersion(ver):
-                ver = b_ver
-        return ver
+    index = await hub.artifact.salt.repo()
+    if not index:
+        log.critical(f'Query to {REPO_URL}/repo.json failed, falling back to'
+                     f'pre-downloaded artifacts')
+        return False
+    # we did not set version so use the latest version from the repo
+    return index['latest'].get(t_os, False)
+
 
 async def get_artifact(hub, t_name, t_type, art_dir, t_os, ver):
     '''
@@ -60,7 +253,7 @@ async def get_artifact(hub, t_name, t_type, art_dir, t_os, ver):
     version is not specified, download the latest from pypi
     '''
     art_n = f'salt-{ver}'
-    url = f'https://repo.saltstack.com/salt-bin/{t_os}/{art_n}'
+    url = f'{REPO_URL}/{t_os}/{art_n}'
 
     await getattr(hub, f'tunnel.{t_type}.cmd')(t_name, f'mkdir -p {art_dir}')
 
@@ -69,16 +262,63 @@ async def get_artifact(hub, t_name, t_type, art_dir, t_os, ver):
         log.info(f'The Salt artifact {ver} already exists')
         return True
 
-    # download artifact
-    async with aiohttp.ClientSession() as session:
-        log.info(f'Downloading the artifact {art_n} to {art_dir}')
-        await hub.artifact.salt.fetch(session, url,
-                                      download=True,
-                                      location=os.path.join(art_dir,
-                                                            art_n))
+    # download artifact, targets that need the same artifact share one download
+    key = (t_os, ver)
+    future = hub.artifact.salt.DOWNLOADS.get(key)
+    if future is None:
+        future = asyncio.ensure_future(_download(hub, url, art_dir, t_os, art_n))
+        hub.artifact.salt.DOWNLOADS[key] = future
+        future.add_done_callback(lambda _: hub.artifact.salt.DOWNLOADS.pop(key, None))
+    return await asyncio.shield(future)
+
+
+def _checksum(hub, t_os, art_n):
+    '''
+    Return the sha256 the repo metadata lists for the artifact, if any
+    '''
+    meta = hub.artifact.salt.REPO.get('data', {}).get(t_os, {}).get(art_n, {})
+    for key, val in meta.items():
+        if key.lower() == 'sha256':
+            return val
+    return None
+
+
+async def _download(hub, url, art_dir, t_os, art_n):
+    '''
+    Download the artifact to a partial file next to its final location and
+    rename it into place once it is complete. Interrupted downloads are
+    retried and resume where they stopped
+    '''
+    os.makedirs(art_dir, exist_ok=True)
+    location = os.path.join(art_dir, art_n)
+    part = os.path.join(art_dir, f'.{art_n}.part')
+    sha256 = _checksum(hub, t_os, art_n)
+    if not sha256:
+        log.warning(f'The repo does not list a sha256 for {art_n}, it will not be verified')
+    log.info(f'Downloading the artifact {art_n} to {art_dir}')
+    ret = False
+    interrupted = False
+    for _ in range(hub.OPT['heist']['download_retries'] + 1):
+        try:
+            ret = await hub.artifact.salt.fetch(hub.artifact.salt.session(), url,
+                                                download=True,
+                                                location=part,
+                                                sha256=sha256)
+            interrupted = False
+            break
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            # Keep the partial file so the next attempt can resume it
+            interrupted = True
+            log.warning(f'Download of {art_n} was interrupted: {exc!r}')
+    if ret:
+        os.replace(part, location)
+        hub.heist.salt_master.invalidate(art_dir)
+    elif not interrupted and os.path.exists(part):
+        # The download failed outright, the partial file cannot be resumed
+        os.remove(part)
     # ensure artifact was downloaded
-    if not any(ver in x for x in os.listdir(art_dir)):
-        log.critical(f'Did not find the {ver} artifact in {art_dir}.'
-                     f' Untarring the artifact failed or did not include version')
+    if not os.path.isfile(location):
+        log.critical(f'Did not find the {art_n} artifact in {art_dir}.'
+                     f' Downloading the artifact failed')
         return False
     return True
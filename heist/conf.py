@@ -31,11 +31,141 @@ CLI_CONFIG = {
         'type': int,
         'help': 'The number of seconds between checking to see if the managed system needs to get an updated binary or agent restart.'
         },
+    'checkin_tick': {
+        'default': 1.0,
+        'type': float,
+        'help': 'The number of seconds between turns of the scheduler that runs the check-ins of all targets, check-ins are accurate to within this resolution.'
+        },
+    'checkin_jitter': {
+        'default': 0.1,
+        'type': float,
+        'help': 'The fraction of checkin_time that each check-in is randomly moved by so targets do not check in at the same moment.'
+        },
+    'checkin_batch': {
+        'default': 256,
+        'type': int,
+        'help': 'The maximum number of check-ins that run at once when many fall due on the same turn of the scheduler.'
+        },
+    'max_in_flight': {
+        'default': 128,
+        'type': int,
+        'help': 'The maximum number of targets to deploy to at once, the remaining targets wait in a queue ordered by their roster priority.'
+        },
+    'connect_limit': {
+        'default': 64,
+        'type': int,
+        'help': 'The maximum number of targets in the connect stage at once, this bounds the CPU spent on SSH handshakes.'
+        },
+    'detect_limit': {
+        'default': 256,
+        'type': int,
+        'help': 'The maximum number of targets in the detect stage at once, where the os and artifact version are found.'
+        },
+    'transfer_limit': {
+        'default': 16,
+        'type': int,
+        'help': 'The maximum number of targets in the transfer stage at once, this bounds the uplink bandwidth used for uploads.'
+        },
+    'start_limit': {
+        'default': 256,
+        'type': int,
+        'help': 'The maximum number of targets in the start stage at once, where the tunnels are created and the minion is started.'
+        },
+    'aimd_initial': {
+        'default': 8,
+        'type': int,
+        'help': 'The number of concurrent SSH handshakes each subnet or roster group starts with.'
+        },
+    'aimd_min': {
+        'default': 1,
+        'type': int,
+        'help': 'The lowest number of concurrent SSH handshakes a subnet or roster group is cut back to.'
+        },
+    'aimd_max': {
+        'default': 256,
+        'type': int,
+        'help': 'The highest number of concurrent SSH handshakes a subnet or roster group can grow to.'
+        },
+    'aimd_increase': {
+        'default': 1.0,
+        'type': float,
+        'help': 'How much the handshake limit of a group grows for each full window of healthy handshakes.'
+        },
+    'aimd_decrease': {
+        'default': 0.5,
+        'type': float,
+        'help': 'The factor the handshake limit of a group is multiplied by when handshakes fail or slow down.'
+        },
+    'aimd_latency_factor': {
+        'default': 3.0,
+        'type': float,
+        'help': 'A handshake slower than this multiple of the fastest handshake in its group counts as congestion.'
+        },
+    'aimd_prefix': {
+        'default': 24,
+        'type': int,
+        'help': 'The prefix length used to group IPv4 targets without a roster group into subnets.'
+        },
+    'aimd_prefix6': {
+        'default': 64,
+        'type': int,
+        'help': 'The prefix length used to group IPv6 targets without a roster group into subnets.'
+        },
+    'start_timeout': {
+        'default': 30,
+        'type': int,
+        'help': 'The number of seconds a minion started in the background has to write its pidfile before its start counts as failed.'
+        },
+    'ready_timeout': {
+        'default': 60,
+        'type': int,
+        'help': 'The number of seconds a running minion has to connect to the publish and return ports of the master before it counts as stuck.'
+        },
+    'ready_retries': {
+        'default': 1,
+        'type': int,
+        'help': 'The number of times a minion that got stuck on its way to a connected minion is started again.'
+        },
     'dynamic_upgrade': {
         'default': False,
         'action': 'store_true',
         'help': 'Tell heist to detect when new binaries are available and dynamically upgrade target systems'
         },
+    'rolling_upgrade': {
+        'default': False,
+        'action': 'store_true',
+        'help': 'Roll new binaries out to the targets in waves, starting with a canary set, instead of upgrading every target at once'
+        },
+    'rollout_canary': {
+        'default': 1,
+        'type': int,
+        'help': 'The number of targets that are upgraded first in a rolling upgrade, the rest wait until the canary set has upgraded.'
+        },
+    'rollout_wave_size': {
+        'default': 50,
+        'type': int,
+        'help': 'The number of targets upgraded in each wave of a rolling upgrade after the canary set.'
+        },
+    'rollout_max_in_flight': {
+        'default': 10,
+        'type': int,
+        'help': 'The maximum number of targets that are upgraded at once during a rolling upgrade.'
+        },
+    'rollout_bandwidth': {
+        'default': 0,
+        'type': int,
+        'help': 'The number of bytes per second the uploads of a rolling upgrade may use, 0 does not limit the bandwidth.'
+        },
+    'rollout_failure_threshold': {
+        'default': 0.2,
+        'type': float,
+        'help': 'The share of failed upgrades in the canary set or a wave above which a rolling upgrade is halted.'
+        },
+    'watch_interval': {
+        'default': 5,
+        'type': int,
+        'help': 'The number of seconds between scans of the artifacts directory for new binaries when inotify is not available.'
+        },
     'renderer': {
         'default': 'yaml',
         'help': 'Specify the renderer to use to render heist roster files'
@@ -60,6 +190,69 @@ CLI_CONFIG = {
         'default': [22],
         'help': 'Comma-separated list of ports to scan in the scan roster.'
         },
+    'scan_concurrency': {
+        'default': 512,
+        'type': int,
+        'help': 'The maximum number of connection probes the scan roster keeps in flight at once.'
+        },
+    'scan_timeout': {
+        'default': 3.0,
+        'type': float,
+        'help': 'The number of seconds the scan roster waits for a connection to be established.'
+        },
+    'scan_banner_timeout': {
+        'default': 3.0,
+        'type': float,
+        'help': 'The number of seconds the scan roster waits for the SSH banner after connecting.'
+        },
+    'sftp_block_size': {
+        'default': 0,
+        'type': int,
+        'help': 'The size in bytes of each SFTP write request when uploading to targets, 0 uses 64 KiB. Can also be set per target in the roster.'
+        },
+    'sftp_max_requests': {
+        'default': 0,
+        'type': int,
+        'help': 'The number of SFTP write requests kept outstanding during an upload, 0 sizes it from the measured latency and bandwidth of each connection. Can also be set per target in the roster.'
+        },
+    'compression': {
+        'default': 'auto',
+        'help': 'How to compress artifacts sent to targets: auto picks zstd, xz or no compression per target from its link speed and the decompressors it has, or use one of zstd, xz or none. Can also be set per target in the roster.'
+        },
+    'persistent_shell': {
+        'default': False,
+        'action': 'store_true',
+        'help': 'Run the commands for each target in one long lived shell, elevated with sudo once, instead of a new channel and shell per command. Can also be set per target in the roster.'
+        },
+    'cache_dir': {
+        'default': '/var/cache/heist',
+        'help': 'The directory of the cache of the facts and deployments of each target, it lets a restarted heist skip detection and reattach to running minions. An empty value disables the cache.'
+        },
+    'repo_ttl': {
+        'default': 3600,
+        'type': int,
+        'help': 'The number of seconds the salt repo index is used for before it is revalidated with the repo.'
+        },
+    'download_retries': {
+        'default': 3,
+        'type': int,
+        'help': 'The number of times an interrupted artifact download is resumed before giving up.'
+        },
+    'dns_ttl': {
+        'default': 300,
+        'type': int,
+        'help': 'The number of seconds a resolved hostname is cached for.'
+        },
+    'dns_negative_ttl': {
+        'default': 30,
+        'type': int,
+        'help': 'The number of seconds a hostname that failed to resolve is cached for.'
+        },
+    'dns_concurrency': {
+        'default': 64,
+        'type': int,
+        'help': 'The maximum number of hostname lookups to run at once.'
+        },
     'artifact_version': {
         'options': ['-a, --artifact'],
         'default': '',
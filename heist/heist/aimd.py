@@ -0,0 +1,122 @@
+'''
+Adaptive concurrency control for connection setup. Every group of targets,
+a roster group or a subnet, gets its own connect limit that grows additively
+while handshakes succeed quickly and is cut multiplicatively when handshakes
+fail or their latency climbs well above the fastest handshake seen
+'''
+# Import python libs
+import ipaddress
+import logging
+import time
+from typing import Any, Dict
+
+log = logging.getLogger(__name__)
+
+# The weight of a new latency sample in the moving average
+EWMA_WEIGHT = 0.2
+# The lowest baseline latency, a handshake measured as taking no time at
+# all would otherwise make every later handshake count as congestion
+BASELINE_MIN = 0.001
+
+
+def __init__(hub):
+    '''
+    Set up the controller state for each group
+    '''
+    hub.heist.aimd.GROUPS = {}
+
+
+async def group(hub, remote: Dict[str, Any]) -> str:
+    '''
+    Return the name of the group the remote is controlled in, this is the
+    roster group if one is set, otherwise the subnet of the remote's address
+    '''
+    if remote.get('group'):
+        return str(remote['group'])
+    host = remote.get('host', remote.get('id'))
+    try:
+        addr = ipaddress.ip_address(host)
+    except ValueError:
+        resolved = await hub.heist.dns.resolve(host)
+        if not resolved:
+            return str(host)
+        addr = ipaddress.ip_address(resolved)
+    if addr.version == 4:
+        prefix = hub.OPT['heist']['aimd_prefix']
+    else:
+        prefix = hub.OPT['heist']['aimd_prefix6']
+    return str(ipaddress.ip_network(f'{addr}/{prefix}', strict=False))
+
+
+def _state(hub, name: str) -> Dict[str, Any]:
+    '''
+    Return the controller state of the named group, creating it and its
+    gate on first use
+    '''
+    if name not in hub.heist.aimd.GROUPS:
+        limit = float(hub.OPT['heist']['aimd_initial'])
+        hub.heist.aimd.GROUPS[name] = {
+            'limit': limit,
+            'latency': None,
+            'baseline': None,
+            'successes': 0,
+            'failures': 0,
+            'decreases': 0,
+            'last_decrease': 0.0}
+        hub.heist.gate.create(f'connect:{name}', int(limit))
+    return hub.heist.aimd.GROUPS[name]
+
+
+async def acquire(hub, name: str):
+    '''
+    Wait until the named group allows another connection attempt
+    '''
+    _state(hub, name)
+    await hub.heist.gate.acquire(f'connect:{name}')
+
+
+def release(hub, name: str, latency: float, ok: bool):
+    '''
+    Finish a connection attempt in the named group and feed its outcome into
+    the controller
+    '''
+    state = _state(hub, name)
+    hub.heist.gate.release(f'connect:{name}')
+    opts = hub.OPT['heist']
+    now = time.monotonic()
+    if ok:
+        state['successes'] += 1
+        if state['latency'] is None:
+            state['latency'] = latency
+        else:
+            state['latency'] += EWMA_WEIGHT * (latency - state['latency'])
+        if state['baseline'] is None or latency < state['baseline']:
+            state['baseline'] = max(latency, BASELINE_MIN)
+        congested = latency > state['baseline'] * opts['aimd_latency_factor']
+    else:
+        state['failures'] += 1
+        congested = True
+
+    if congested:
+        # Only cut once per round trip so a burst of failures from a single
+        # overload is not counted more than once
+        if now - state['last_decrease'] >= (state['latency'] or 0):
+            state['limit'] = max(float(opts['aimd_min']),
+                                 state['limit'] * opts['aimd_decrease'])
+            state['decreases'] += 1
+            state['last_decrease'] = now
+            log.debug(f'Reduced the connect limit for {name} to {int(state["limit"])}')
+    else:
+        state['limit'] = min(float(opts['aimd_max']),
+                             state['limit'] + opts['aimd_increase'] / state['limit'])
+    hub.heist.gate.set_limit(f'connect:{name}', int(state['limit']))
+
+
+def status(hub) -> Dict[str, Dict[str, Any]]:
+    '''
+    Return the current controller state of every group
+    '''
+    ret = {}
+    for name, state in hub.heist.aimd.GROUPS.items():
+        ret[name] = dict(state, **hub.heist.gate.status(f'connect:{name}'))
+    return ret
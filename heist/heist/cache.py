@@ -0,0 +1,124 @@
+'''
+A cache of what heist knows about each target that outlives a heist run.
+Every host is recorded under its address and the fingerprint of its host
+key together with its facts and its deployment, the binary hash, the run_dir
+and the minion pid, so a restarted heist skips detection and reattaches to
+the minions that are still running. A host that presents a different host
+key is a different host to the cache
+'''
+# Import python libs
+import json
+import logging
+import os
+import sqlite3
+import time
+from typing import Any, Dict, Optional
+
+log = logging.getLogger(__name__)
+
+DB_NAME = 'hosts.db'
+# The deployment fields recorded for each host
+FIELDS = ('user', 'facts', 'sha', 'bin', 'run_dir', 'pid')
+
+SCHEMA = '''CREATE TABLE IF NOT EXISTS hosts (
+    host TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    user TEXT,
+    facts TEXT,
+    sha TEXT,
+    bin TEXT,
+    run_dir TEXT,
+    pid INTEGER,
+    updated REAL,
+    PRIMARY KEY (host, fingerprint))
+'''
+
+
+def __init__(hub):
+    '''
+    Set up the database connection, it is opened on first use
+    '''
+    hub.heist.cache.DB = None
+    hub.heist.cache.DISABLED = False
+
+
+def _db(hub) -> Optional[sqlite3.Connection]:
+    '''
+    Return the connection to the cache database, None if there is no cache
+    '''
+    if hub.heist.cache.DB is not None or hub.heist.cache.DISABLED:
+        return hub.heist.cache.DB
+    cache_dir = hub.OPT['heist'].get('cache_dir')
+    if not cache_dir:
+        hub.heist.cache.DISABLED = True
+        return None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        db = sqlite3.connect(os.path.join(cache_dir, DB_NAME))
+        # Every deploy writes a row, the write ahead log without a sync per
+        # commit keeps those writes from holding up the loop
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute(SCHEMA)
+        db.commit()
+    except (OSError, sqlite3.Error) as exc:
+        log.warning(f'Not caching what is known about targets in {cache_dir}: {exc}')
+        hub.heist.cache.DISABLED = True
+        return None
+    hub.heist.cache.DB = db
+    return db
+
+
+def get(hub, host: str, fingerprint: str) -> Optional[Dict[str, Any]]:
+    '''
+    Return what is cached about the host with the given host key, None if
+    nothing is
+    '''
+    db = _db(hub)
+    if db is None or not fingerprint:
+        return None
+    row = db.execute(f'SELECT {", ".join(FIELDS)} FROM hosts WHERE host = ? AND fingerprint = ?',
+                     (host, fingerprint)).fetchone()
+    if row is None:
+        return None
+    entry = dict(zip(FIELDS, row))
+    entry['facts'] = json.loads(entry['facts']) if entry['facts'] else None
+    return entry
+
+
+def put(hub, host: str, fingerprint: str, **fields):
+    '''
+    Record the given fields for the host with the given host key, the other
+    fields keep what was cached before
+    '''
+    db = _db(hub)
+    if db is None or not fingerprint:
+        return
+    entry = hub.heist.cache.get(host, fingerprint) or dict.fromkeys(FIELDS)
+    entry.update(fields)
+    if entry['facts'] is not None:
+        entry = dict(entry, facts=json.dumps(entry['facts'], sort_keys=True))
+    db.execute(f'INSERT OR REPLACE INTO hosts (host, fingerprint, {", ".join(FIELDS)}, updated) '
+               f'VALUES (?, ?, {", ".join("?" for _ in FIELDS)}, ?)',
+               (host, fingerprint, *(entry[field] for field in FIELDS), time.time()))
+    db.commit()
+
+
+def drop(hub, host: str, fingerprint: str):
+    '''
+    Forget the host with the given host key
+    '''
+    db = _db(hub)
+    if db is None:
+        return
+    db.execute('DELETE FROM hosts WHERE host = ? AND fingerprint = ?', (host, fingerprint))
+    db.commit()
+
+
+def close(hub):
+    '''
+    Close the cache database
+    '''
+    if hub.heist.cache.DB is not None:
+        hub.heist.cache.DB.close()
+        hub.heist.cache.DB = None
@@ -0,0 +1,120 @@
+'''
+Shared name resolution for heist. Lookups are run through the event loop's
+executor so they never block in-flight connections, concurrent lookups of
+the same name are collapsed into one and results, including failures, are
+cached for the configured ttl
+'''
+# Import python libs
+import asyncio
+import logging
+import socket
+import time
+from typing import Dict, Iterable, Optional
+
+log = logging.getLogger(__name__)
+
+
+def __init__(hub):
+    '''
+    Set up the resolver cache and the table of lookups in flight
+    '''
+    hub.heist.dns.CACHE = {}
+    hub.heist.dns.INFLIGHT = {}
+
+
+def _store(hub, key, addr: Optional[str]):
+    '''
+    Cache the result of a lookup, failed lookups are cached with the
+    negative ttl
+    '''
+    if addr:
+        ttl = hub.OPT['heist']['dns_ttl']
+    else:
+        ttl = hub.OPT['heist']['dns_negative_ttl']
+    hub.heist.dns.CACHE[key] = (addr, time.monotonic() + ttl)
+
+
+def cached(hub, host: str, family: int = socket.AF_UNSPEC):
+    '''
+    Return a tuple of (hit, addr) for the host from the cache without
+    resolving it, addr is None for cached failures
+    '''
+    entry = hub.heist.dns.CACHE.get((host, family))
+    if entry is None:
+        return False, None
+    addr, expires = entry
+    if expires < time.monotonic():
+        hub.heist.dns.CACHE.pop((host, family), None)
+        return False, None
+    return True, addr
+
+
+def lookup(hub, host: str, family: int = socket.AF_UNSPEC) -> Optional[str]:
+    '''
+    Synchronously resolve the host, this only blocks on a cache miss. Code
+    running on the loop should await resolve first to warm the cache
+    '''
+    hit, addr = hub.heist.dns.cached(host, family)
+    if hit:
+        return addr
+    try:
+        info = socket.getaddrinfo(host, 0, family)
+        addr = info[0][-1][0]
+    except (socket.gaierror, UnicodeError):
+        addr = None
+    _store(hub, (host, family), addr)
+    return addr
+
+
+async def _resolve(hub, host: str, family: int) -> Optional[str]:
+    '''
+    Resolve the host in the loop's executor
+    '''
+    loop = asyncio.get_event_loop()
+    try:
+        info = await loop.getaddrinfo(host, 0, family=family)
+    except (socket.gaierror, UnicodeError):
+        log.debug(f'Could not resolve host: {host}')
+        return None
+    return info[0][-1][0]
+
+
+async def resolve(hub, host: str, family: int = socket.AF_UNSPEC) -> Optional[str]:
+    '''
+    Resolve the host to an address, returns None if the host cannot be
+    resolved. Results are cached and concurrent lookups of the same host
+    share a single query
+    '''
+    key = (host, family)
+    hit, addr = hub.heist.dns.cached(host, family)
+    if hit:
+        return addr
+    future = hub.heist.dns.INFLIGHT.get(key)
+    if future is None:
+        future = asyncio.ensure_future(_resolve(hub, host, family))
+        hub.heist.dns.INFLIGHT[key] = future
+        try:
+            addr = await asyncio.shield(future)
+        finally:
+            hub.heist.dns.INFLIGHT.pop(key, None)
+        _store(hub, key, addr)
+        return addr
+    return await asyncio.shield(future)
+
+
+async def resolve_many(hub, hosts: Iterable[str],
+                       family: int = socket.AF_UNSPEC) -> Dict[str, Optional[str]]:
+    '''
+    Resolve all of the hosts concurrently, at most dns_concurrency lookups
+    are run at once. Return a dict mapping each host to its address in the
+    order the hosts were given
+    '''
+    hosts = list(hosts)
+    sem = asyncio.Semaphore(max(1, hub.OPT['heist']['dns_concurrency']))
+
+    async def _bound(host):
+        async with sem:
+            return await hub.heist.dns.resolve(host, family)
+
+    addrs = await asyncio.gather(*[_bound(host) for host in hosts])
+    return dict(zip(hosts, addrs))
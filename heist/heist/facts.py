@@ -0,0 +1,123 @@
+'''
+Gather the facts about a target that a deployment needs in one round trip.
+A single script run on the target reports the os, the architecture, the
+init system, the tools that are installed, the free space for the
+deployment and the heist deployments already there, the manager uses the
+resulting record instead of probing the target for each of them
+'''
+# Import python libs
+import logging
+from typing import Any, Dict, FrozenSet, NamedTuple, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+# The tools the manager may use on a target
+TOOLS = ('systemctl', 'setsid', 'nohup', 'sha256sum', 'shasum', 'tar', 'xz', 'zstd')
+# The directory heist deploys into on a target
+DEPLOY_DIR = '/var/tmp'
+
+PROBE = '; '.join((
+    'echo "os=$(uname -s)"',
+    'echo "arch=$(uname -m)"',
+    'echo "kernel=$(uname -a)"',
+    f'for t in {" ".join(TOOLS)}; do command -v $t >/dev/null 2>&1 && echo "tool=$t"; done',
+    '[ -d /run/systemd/system ] && echo init=systemd',
+    f'df -Pk {DEPLOY_DIR} 2>/dev/null | {{ read h; read f b u a r; echo "free=$a"; }}',
+    f'for d in {DEPLOY_DIR}/heist_*/*; do '
+    '[ -d "$d" ] && [ "${d##*/}" != store ] && echo "deployment=$d"; done',
+    'true'))
+
+
+class Facts(NamedTuple):
+    '''
+    The facts about a target
+    '''
+    # linux or darwin, empty if the os is not supported
+    os: str
+    arch: str
+    # The full output of uname -a
+    kernel: str
+    # systemd if it runs the target, empty otherwise
+    init: str
+    tools: FrozenSet[str]
+    # The bytes free for the deployment, -1 if it is not known
+    free: int
+    # The run_dirs of heist deployments found on the target
+    deployments: Tuple[str, ...]
+
+
+def __init__(hub):
+    '''
+    Set up the facts of each target
+    '''
+    hub.heist.facts.FACTS = {}
+
+
+def parse(hub, output: str) -> Facts:
+    '''
+    Turn the output of the probe into facts
+    '''
+    values = {'os': '', 'arch': '', 'kernel': '', 'init': '', 'free': ''}
+    tools = set()
+    deployments = []
+    for line in output.splitlines():
+        key, sep, value = line.partition('=')
+        if not sep:
+            continue
+        if key == 'tool':
+            tools.add(value)
+        elif key == 'deployment':
+            deployments.append(value)
+        elif key in values:
+            values[key] = value.strip()
+    t_os = values['os'].lower()
+    try:
+        free = int(values['free']) * 1024
+    except ValueError:
+        free = -1
+    return Facts(os=t_os if t_os in ('linux', 'darwin') else '',
+                 arch=values['arch'],
+                 kernel=values['kernel'],
+                 init=values['init'],
+                 tools=frozenset(tools),
+                 free=free,
+                 deployments=tuple(sorted(deployments)))
+
+
+async def gather(hub, t_name: str, t_type: str) -> Facts:
+    '''
+    Run the probe on the target and keep the facts it reports
+    '''
+    ret = await getattr(hub, f'tunnel.{t_type}.cmd')(t_name, f"sh -c '{PROBE}'")
+    facts = hub.heist.facts.parse(ret.stdout or '')
+    if not facts.os:
+        log.critical('Could not determine the OS')
+    hub.heist.facts.FACTS[t_name] = facts
+    return facts
+
+
+def get(hub, t_name: str) -> Optional[Facts]:
+    '''
+    Return the facts gathered for the target, None if there are none
+    '''
+    return hub.heist.facts.FACTS.get(t_name)
+
+
+def dump(hub, facts: Facts) -> Dict[str, Any]:
+    '''
+    Turn the facts into plain data that can be stored as json
+    '''
+    return dict(facts._asdict(),
+                tools=sorted(facts.tools),
+                deployments=list(facts.deployments))
+
+
+def load(hub, t_name: str, data: Dict[str, Any]) -> Facts:
+    '''
+    Keep the facts from data stored by dump for the target without probing it
+    '''
+    facts = Facts(**dict(data,
+                         tools=frozenset(data['tools']),
+                         deployments=tuple(data['deployments'])))
+    hub.heist.facts.FACTS[t_name] = facts
+    return facts
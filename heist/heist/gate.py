@@ -0,0 +1,98 @@
+'''
+Named admission gates, a gate hands out a limited number of slots and
+waiters are served highest priority first, then in the order they arrived
+'''
+# Import python libs
+import asyncio
+import heapq
+import itertools
+import logging
+from typing import Any, Dict
+
+log = logging.getLogger(__name__)
+
+
+def __init__(hub):
+    '''
+    Set up the table of gates
+    '''
+    hub.heist.gate.GATES = {}
+
+
+def create(hub, name: str, limit: int):
+    '''
+    Create the named gate with the given number of slots, an existing gate
+    of the same name keeps its holders and waiters and only has its limit
+    changed
+    '''
+    if name in hub.heist.gate.GATES:
+        hub.heist.gate.set_limit(name, limit)
+        return
+    hub.heist.gate.GATES[name] = {
+        'limit': max(1, limit),
+        'active': 0,
+        'waiters': [],
+        'seq': itertools.count()}
+
+
+def _wake(gate: Dict[str, Any]):
+    '''
+    Hand free slots to the waiters at the front of the queue
+    '''
+    while gate['waiters'] and gate['active'] < gate['limit']:
+        _, _, future = heapq.heappop(gate['waiters'])
+        if future.done():
+            # The waiter was cancelled
+            continue
+        gate['active'] += 1
+        future.set_result(True)
+
+
+async def acquire(hub, name: str, priority: int = 0):
+    '''
+    Wait for a slot on the named gate, waiters with a higher priority are
+    served first
+    '''
+    gate = hub.heist.gate.GATES[name]
+    if gate['active'] < gate['limit'] and not gate['waiters']:
+        gate['active'] += 1
+        return
+    future = asyncio.get_event_loop().create_future()
+    heapq.heappush(gate['waiters'], (-priority, next(gate['seq']), future))
+    try:
+        await future
+    except asyncio.CancelledError:
+        if future.done() and not future.cancelled():
+            # The slot was handed over just as we were cancelled, pass it on
+            hub.heist.gate.release(name)
+        raise
+
+
+def release(hub, name: str):
+    '''
+    Give a slot back to the named gate
+    '''
+    gate = hub.heist.gate.GATES[name]
+    gate['active'] -= 1
+    _wake(gate)
+
+
+def set_limit(hub, name: str, limit: int):
+    '''
+    Change the number of slots on the named gate, lowering the limit does
+    not revoke slots that are already held
+    '''
+    gate = hub.heist.gate.GATES[name]
+    gate['limit'] = max(1, limit)
+    _wake(gate)
+
+
+def status(hub, name: str) -> Dict[str, int]:
+    '''
+    Return the limit, the number of held slots and the number of waiters of
+    the named gate
+    '''
+    gate = hub.heist.gate.GATES[name]
+    return {'limit': gate['limit'],
+            'active': gate['active'],
+            'waiting': sum(1 for _, _, f in gate['waiters'] if not f.done())}
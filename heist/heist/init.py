@@ -6,7 +6,6 @@ spine is set up
 import asyncio
 import ipaddress
 import logging
-import socket
 
 log = logging.getLogger(__name__)
 
@@ -44,11 +43,23 @@ async def run(hub):
     remote system calls
     '''
     roster = hub.OPT['heist']['roster']
-    remotes = await hub.roster.init.read(roster)
     manager = hub.OPT['heist']['manager']
-    if not remotes:
+    remotes = hub.roster.init.stream(roster)
+    # Wait for the first target so that an empty roster never starts the manager
+    try:
+        first = await remotes.__anext__()
+    except StopAsyncIteration:
         return False
-    await getattr(hub, f'heist.{manager}.run')(remotes)
+    await getattr(hub, f'heist.{manager}.run')(_prepend(first, remotes))
+
+
+async def _prepend(first, remotes):
+    '''
+    Yield first and then the rest of the remotes
+    '''
+    yield first
+    async for remote in remotes:
+        yield remote
 
 
 async def clean(hub, signal: int = None):
@@ -57,6 +68,10 @@ async def clean(hub, signal: int = None):
     '''
     if signal:
         log.warning(f'Got signal {signal}! Cleaning up connections')
+    # Stop the check-ins so nothing is redeployed while cleaning up
+    await hub.heist.schedule.stop()
+    await hub.heist.rollout.stop()
+    await hub.heist.ready.stop()
     coros = []
     # First clean up the remote systems
     for _, r_vals in hub.heist.ROSTERS.items():
@@ -71,6 +86,12 @@ async def clean(hub, signal: int = None):
         t_type = vals['t_type']
         coros.append(getattr(hub, f'tunnel.{t_type}.destroy')(t_name))
     await asyncio.gather(*coros)
+    await hub.heist.watch.stop()
+    hub.heist.cache.close()
+    # Close the shared client sessions of the artifact plugins
+    for mod in hub.artifact:
+        if hasattr(mod, 'close'):
+            await mod.close()
     tasks = [t for t in asyncio.all_tasks() if t is not
              asyncio.current_task()]
     for task in tasks:
@@ -84,8 +105,11 @@ def ip_is_loopback(hub, addr):
     or hostname is a loopback address
     '''
     try:
-        info = socket.getaddrinfo(addr, 0)
-    except socket.gaierror:
+        return ipaddress.ip_address(addr).is_loopback
+    except ValueError:
+        pass
+    resolved = hub.heist.dns.lookup(addr)
+    if not resolved:
         log.critical('Could not determine if addr is loopback')
         return False
-    return ipaddress.ip_address(info[0][-1][0]).is_loopback
+    return ipaddress.ip_address(resolved).is_loopback
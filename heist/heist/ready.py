@@ -0,0 +1,165 @@
+'''
+Track how far each started minion got. A minion moves from starting to
+started once its start command went out, to alive once its pidfile names a
+running process and to connected once it holds connections to the master's
+publish and return ports. Every transition has a deadline and the time it
+took is recorded, so the start latency of the whole fleet can be read off
+the distributions and only the targets that got stuck are retried
+'''
+# Import python libs
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List
+
+log = logging.getLogger(__name__)
+
+# The states a minion passes through, in order
+STATES = ('starting', 'started', 'alive', 'connected')
+
+
+def __init__(hub):
+    '''
+    Set up the readiness of each target and the tasks tracking it
+    '''
+    hub.heist.ready.TARGETS = {}
+    hub.heist.ready.TASKS = {}
+
+
+def begin(hub, t_name: str, retry: bool = False) -> Dict[str, Any]:
+    '''
+    Start tracking the start of the minion of the target, a retry counts as
+    another attempt of the start before it
+    '''
+    prev = hub.heist.ready.TARGETS.get(t_name)
+    now = time.monotonic()
+    record = {'state': 'starting',
+              'attempts': prev['attempts'] + 1 if retry and prev else 1,
+              'entered': {'starting': now},
+              'latency': {},
+              'failed': None}
+    hub.heist.ready.TARGETS[t_name] = record
+    return record
+
+
+def advance(hub, t_name: str, state: str):
+    '''
+    Move the target on to the given state and record how long it took to
+    get there from the state before it
+    '''
+    record = hub.heist.ready.TARGETS[t_name]
+    if record['state'] == 'failed':
+        return
+    now = time.monotonic()
+    record['latency'][state] = now - record['entered'][record['state']]
+    record['entered'][state] = now
+    record['state'] = state
+    if state == STATES[-1]:
+        record['latency']['total'] = now - record['entered']['starting']
+        log.debug(f'The minion on {t_name} connected after {record["latency"]["total"]:.2f} seconds')
+
+
+def fail(hub, t_name: str, state: str):
+    '''
+    Mark the target as stuck before it reached the given state
+    '''
+    record = hub.heist.ready.TARGETS[t_name]
+    log.error(f'The minion on {t_name} did not get from {record["state"]} to {state} in time')
+    record['failed'] = state
+    record['state'] = 'failed'
+
+
+def state(hub, t_name: str) -> str:
+    '''
+    Return the state of the target, None if no minion was started on it
+    '''
+    record = hub.heist.ready.TARGETS.get(t_name)
+    return record['state'] if record else None
+
+
+def stragglers(hub) -> List[str]:
+    '''
+    Return the targets whose minion got stuck
+    '''
+    return sorted(t_name for t_name, record in hub.heist.ready.TARGETS.items()
+                  if record['state'] == 'failed')
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    '''
+    Return the given percentile of the sorted values
+    '''
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+def status(hub) -> Dict[str, Any]:
+    '''
+    Return the number of targets in each state and, for each transition and
+    the whole way to connected, the distribution of the time it took
+    '''
+    counts = {name: 0 for name in STATES + ('failed',)}
+    samples = {name: [] for name in STATES[1:] + ('total',)}
+    for record in hub.heist.ready.TARGETS.values():
+        counts[record['state']] += 1
+        for name, latency in record['latency'].items():
+            samples[name].append(latency)
+    latency = {}
+    for name, values in samples.items():
+        if not values:
+            continue
+        values.sort()
+        latency[name] = {'count': len(values),
+                         'min': values[0],
+                         'p50': _percentile(values, 0.5),
+                         'p90': _percentile(values, 0.9),
+                         'p99': _percentile(values, 0.99),
+                         'max': values[-1]}
+    return {'states': counts, 'latency': latency}
+
+
+def track(hub, t_name: str, func, *args):
+    '''
+    Run the coroutine function func with args to follow the target through
+    its states, it replaces the one that ran for the target before
+    '''
+    hub.heist.ready.cancel(t_name)
+    task = asyncio.ensure_future(func(*args))
+    hub.heist.ready.TASKS[t_name] = task
+
+    def _done(done):
+        if hub.heist.ready.TASKS.get(t_name) is done:
+            del hub.heist.ready.TASKS[t_name]
+    task.add_done_callback(_done)
+
+
+async def wait(hub, t_name: str) -> str:
+    '''
+    Wait until the target is connected or has used up its retries and
+    return the state it ended in
+    '''
+    while True:
+        task = hub.heist.ready.TASKS.get(t_name)
+        if task is None:
+            return hub.heist.ready.state(t_name)
+        # A straggler that is started again is followed by a new task
+        await asyncio.wait([task])
+
+
+def cancel(hub, t_name: str):
+    '''
+    Stop following the target
+    '''
+    task = hub.heist.ready.TASKS.pop(t_name, None)
+    if task is not None and task is not asyncio.current_task():
+        task.cancel()
+
+
+async def stop(hub):
+    '''
+    Stop following every target
+    '''
+    tasks = list(hub.heist.ready.TASKS.values())
+    hub.heist.ready.TASKS.clear()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,155 @@
+'''
+Roll a new artifact out to the deployed targets a few at a time. A small
+canary set is upgraded first and the rest follow in waves, within a wave
+only a limited number of targets are upgraded at once and the uploads are
+held to a bandwidth budget. When the share of failed upgrades in a wave
+crosses the failure threshold the rollout halts and the remaining targets
+stay on the artifact they run
+'''
+# Import python libs
+import asyncio
+import logging
+import os
+from typing import Any, Dict, List
+
+log = logging.getLogger(__name__)
+
+
+def __init__(hub):
+    '''
+    Set up the table of rollouts and the bandwidth budget
+    '''
+    hub.heist.rollout.ROLLOUTS = {}
+    hub.heist.rollout.BUDGET = {'next': 0.0}
+
+
+def start(hub, art_dir: str, path: str) -> Dict[str, Any]:
+    '''
+    Start rolling the artifact at path out to every target deployed from
+    art_dir that does not run it yet. Starting a rollout that is running or
+    has halted does nothing and returns its state
+    '''
+    state = hub.heist.rollout.ROLLOUTS.get(path)
+    if state and state['status'] in ('running', 'halted'):
+        return state
+    targets = sorted(t_name for t_name, con in hub.heist.CONS.items()
+                     if con.get('art_dir') == art_dir and con.get('bin') != path)
+    if not targets:
+        return state
+    hub.heist.gate.create('rollout', hub.OPT['heist']['rollout_max_in_flight'])
+    state = {'path': path,
+             'status': 'running',
+             'targets': targets,
+             'upgraded': [],
+             'failed': [],
+             'waves': []}
+    hub.heist.rollout.ROLLOUTS[path] = state
+    state['task'] = asyncio.ensure_future(_roll(hub, state))
+    return state
+
+
+def _waves(hub, targets: List[str]) -> List[List[str]]:
+    '''
+    Split the targets into the canary set and the waves that follow it
+    '''
+    canary = max(0, hub.OPT['heist']['rollout_canary'])
+    size = max(1, hub.OPT['heist']['rollout_wave_size'])
+    waves = [targets[:canary]]
+    waves.extend(targets[i:i + size] for i in range(canary, len(targets), size))
+    return [wave for wave in waves if wave]
+
+
+async def _roll(hub, state: Dict[str, Any]):
+    '''
+    Upgrade the targets wave by wave, halting when a wave fails too often
+    '''
+    threshold = hub.OPT['heist']['rollout_failure_threshold']
+    waves = _waves(hub, state['targets'])
+    for num, wave in enumerate(waves):
+        kind = 'canary' if num == 0 and hub.OPT['heist']['rollout_canary'] > 0 else 'wave'
+        try:
+            results = await asyncio.gather(*[_upgrade(hub, state, t_name) for t_name in wave])
+        except asyncio.CancelledError:
+            state['status'] = 'cancelled'
+            raise
+        failed = results.count(False)
+        state['waves'].append({'kind': kind, 'size': len(wave), 'failed': failed})
+        log.info(f'Rollout of {state["path"]}: {kind} {num} upgraded '
+                 f'{len(wave) - failed} of {len(wave)} targets')
+        if failed / len(wave) > threshold:
+            state['status'] = 'halted'
+            log.error(f'Halted the rollout of {state["path"]}, {failed} of '
+                      f'{len(wave)} upgrades in the {kind} failed')
+            return
+    state['status'] = 'done'
+
+
+async def _spend(hub, size: int):
+    '''
+    Wait until the bandwidth budget allows size more bytes to be sent
+    '''
+    budget = hub.OPT['heist']['rollout_bandwidth']
+    if budget <= 0:
+        return
+    now = asyncio.get_event_loop().time()
+    # Reserve the bytes, uploads start no faster than the budget refills
+    start = max(now, hub.heist.rollout.BUDGET['next'])
+    hub.heist.rollout.BUDGET['next'] = start + size / budget
+    await asyncio.sleep(start - now)
+
+
+async def _upgrade(hub, state: Dict[str, Any], t_name: str) -> bool:
+    '''
+    Upgrade one target, returns False if the upgrade failed or the upgraded
+    minion did not connect to the master
+    '''
+    con = hub.heist.CONS.get(t_name)
+    if con is None:
+        # The target went away before its wave
+        return True
+    path = state['path']
+    await hub.heist.gate.acquire('rollout')
+    try:
+        await _spend(hub, os.path.getsize(path))
+        await hub.heist.salt_master.update(t_name, con['t_type'], path,
+                                           con['tgt'], con['run_dir'])
+        # The upgrade only counts once the new minion is connected
+        ready = await hub.heist.ready.wait(t_name)
+    except asyncio.CancelledError:
+        raise
+    except Exception as exc:  # pylint: disable=broad-except
+        log.error(f'Failed to upgrade {t_name} to {path}: {exc}')
+        state['failed'].append(t_name)
+        return False
+    finally:
+        hub.heist.gate.release('rollout')
+    if ready != 'connected':
+        log.error(f'The minion on {t_name} did not connect after the upgrade to {path}')
+        state['failed'].append(t_name)
+        return False
+    con['bin'] = path
+    state['upgraded'].append(t_name)
+    return True
+
+
+def status(hub) -> Dict[str, Dict[str, Any]]:
+    '''
+    Return the progress of every rollout
+    '''
+    return {path: {'status': state['status'],
+                   'targets': len(state['targets']),
+                   'upgraded': len(state['upgraded']),
+                   'failed': len(state['failed']),
+                   'waves': list(state['waves'])}
+            for path, state in hub.heist.rollout.ROLLOUTS.items()}
+
+
+async def stop(hub):
+    '''
+    Cancel the rollouts that are still running
+    '''
+    tasks = [state['task'] for state in hub.heist.rollout.ROLLOUTS.values()
+             if not state['task'].done()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -4,11 +4,14 @@
 # Import python libs
 import secrets
 import asyncio
+import functools
+import hashlib
 import logging
 import os
 import tempfile
+import time
 from distutils.version import StrictVersion
-from typing import Any, Dict, List
+from typing import Any, AsyncIterable, Dict, Iterable, Set, Union
 
 log = logging.getLogger(__name__)
 
@@ -35,75 +38,224 @@ WantedBy=multi-user.target
 '''
 
 
+# The stages of a deployment, each stage has its own concurrency limit
+STAGES = ('connect', 'detect', 'transfer', 'start')
+# The pidfile of a minion started in the background is polled this often
+# at first, backing off to the maximum
+START_POLL_MIN = 0.1
+START_POLL_MAX = 1.0
+
+
 def __init__(hub):
     '''
     Set up data structures for this module to use
     '''
     hub.heist.salt_master.FUTURES = {}
+    hub.heist.salt_master.ARTIFACTS = {}
+    hub.heist.salt_master.FOLLOWERS = {}
+    hub.heist.salt_master.DIGESTS = {}
 
 
 async def _get_start_cmd(hub, t_type, t_name, tgt, run_dir, pfile):
     '''
     determine which command to use when starting the salt-minion
     '''
-    at_f = os.path.join(run_dir, 'at-minion-scheduler.sh')
-    startup = {'systemctl': {'conf_tgt': os.path.join(os.sep, 'etc',
-                                                      'systemd', 'system',
-                                                      'salt-minion.service'),
-                             'conf': 'systemd',
-                             'start_cmd': 'systemctl start salt-minion'},
-               'at': {'conf_tgt': at_f,
-                      'conf': 'at',
-                      'start_cmd': f'at -f {at_f} now + 1 minute'}}
-    if hub.heist.ROSTERS[t_name].get('bootstrap'):
-        for cmd in startup:
-            ret = await getattr(hub, f'tunnel.{t_type}.cmd')(t_name, f'which {cmd}')
-            if ret.returncode == 0:
-                log.debug(f'Using {cmd} to startup the minion service')
-                config = hub.heist.salt_master.mk_startup_conf(cmd, tgt, run_dir, pfile)
-                conf_tgt = startup[cmd]['conf_tgt']
-                await getattr(hub, f'tunnel.{t_type}.send')(t_name, config, conf_tgt)
-                return startup[cmd]['start_cmd']
-    return f' {tgt} minion --config-dir {os.path.join(run_dir, "conf")} --pid-file={pfile}'
+    minion = f'{tgt} minion --config-dir {os.path.join(run_dir, "conf")} --pid-file={pfile}'
+    if not hub.heist.ROSTERS[t_name].get('bootstrap'):
+        return f' {minion}'
+    facts = hub.heist.facts.get(t_name)
+    if facts.init == 'systemd' and 'systemctl' in facts.tools:
+        log.debug('Using systemctl to startup the minion service')
+        config = hub.heist.salt_master.mk_startup_conf('systemctl', tgt, run_dir, pfile)
+        conf_tgt = os.path.join(os.sep, 'etc', 'systemd', 'system', 'salt-minion.service')
+        await getattr(hub, f'tunnel.{t_type}.send')(t_name, config, conf_tgt)
+        return 'systemctl start salt-minion'
+    # Without systemd the minion is started in a session of its own with
+    # nothing tying it to the ssh session, the command returns at once
+    if 'setsid' in facts.tools:
+        log.debug('Using setsid to startup the minion')
+        minion = f'setsid {minion}'
+    elif 'nohup' in facts.tools:
+        log.debug('Using nohup to startup the minion')
+        minion = f'nohup {minion}'
+    else:
+        minion = f"sh -c 'trap \"\" HUP; exec {minion}'"
+    return f'{minion} </dev/null >>{os.path.join(run_dir, "minion.log")} 2>&1 &'
+
+
+async def _poll(hub, t_type, t_name, command, parse, timeout):
+    '''
+    Run the command on the target until parse finds what it looks for in
+    the result and return that, or None when timeout seconds passed
+    '''
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    delay = START_POLL_MIN
+    while True:
+        ret = await getattr(hub, f'tunnel.{t_type}.cmd')(t_name, command)
+        found = parse(ret)
+        if found:
+            return found
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            return None
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * 2, START_POLL_MAX)
+
+
+def _pid(ret):
+    '''
+    Return the pid printed by a command, None if it printed none
+    '''
+    if ret.returncode == 0 and ret.stdout.strip().isdigit():
+        return int(ret.stdout)
+    return None
+
+
+def _established(ret) -> Set[int]:
+    '''
+    Return the remote ports of the established tcp connections listed in
+    /proc/net/tcp or by netstat
+    '''
+    ports = set()
+    for line in (ret.stdout or '').splitlines():
+        fields = line.split()
+        try:
+            if len(fields) > 3 and ':' in fields[2] and fields[3] == '01':
+                ports.add(int(fields[2].rsplit(':', 1)[1], 16))
+            elif len(fields) > 5 and fields[5] == 'ESTABLISHED':
+                ports.add(int(fields[4].rsplit('.', 1)[1]))
+        except ValueError:
+            continue
+    return ports
+
+
+async def _wait_alive(hub, t_type, t_name, pfile):
+    '''
+    Wait until the pidfile of the minion names a live process, returns its
+    pid or None when the minion did not come up within start_timeout seconds
+    '''
+    pid = await _poll(hub, t_type, t_name,
+                      f'''sh -c 'p=$(cat {pfile}) && kill -0 "$p" && echo "$p"' ''',
+                      _pid, hub.OPT['heist']['start_timeout'])
+    if pid is None:
+        hub.heist.ready.fail(t_name, 'alive')
+        return None
+    hub.heist.ready.advance(t_name, 'alive')
+    await _remember_pid(hub, t_name, pid)
+    return pid
+
+
+async def _wait_connected(hub, t_type, t_name):
+    '''
+    Wait until the target holds connections to the publish and return ports
+    of the master, returns False when it did not within ready_timeout seconds
+    '''
+    roster = hub.heist.ROSTERS[t_name]
+    ports = {int(roster.get('master_port', 44506)), int(roster.get('publish_port', 44505))}
+    connected = await _poll(hub, t_type, t_name,
+                            "sh -c 'cat /proc/net/tcp /proc/net/tcp6 2>/dev/null "
+                            "|| netstat -an -p tcp'",
+                            lambda ret: ports <= _established(ret),
+                            hub.OPT['heist']['ready_timeout'])
+    if not connected:
+        hub.heist.ready.fail(t_name, 'connected')
+        return False
+    hub.heist.ready.advance(t_name, 'connected')
+    return True
+
+
+async def _track(hub, t_type, t_name, tgt, run_dir):
+    '''
+    Follow the minion of the target until it is connected to the master, a
+    minion that gets stuck is started again as long as ready_retries allows
+    '''
+    pfile = os.path.join(run_dir, 'pfile')
+    if hub.heist.ready.state(t_name) == 'started':
+        await _wait_alive(hub, t_type, t_name, pfile)
+    if hub.heist.ready.state(t_name) == 'alive':
+        await _wait_connected(hub, t_type, t_name)
+    if hub.heist.ready.state(t_name) != 'failed':
+        return
+    attempts = hub.heist.ready.TARGETS[t_name]['attempts']
+    if attempts > hub.OPT['heist']['ready_retries']:
+        log.error(f'Giving up on the minion on {t_name} after {attempts} attempts')
+        return
+    log.warning(f'Starting the minion on {t_name} again')
+    await getattr(hub, f'tunnel.{t_type}.cmd')(t_name, f'kill `cat {pfile}`')
+    await _start_minion(hub, t_type, t_name, tgt, run_dir, retry=True)
 
 
-async def _start_minion(hub, t_type, t_name, tgt, run_dir):
+async def _start_minion(hub, t_type, t_name, tgt, run_dir, retry=False):
     '''
-    Start a minion on the remote system and store the future
+    Start a minion on the remote system and store the future, a minion
+    started in the background is waited for until it is up. The way to a
+    minion connected to the master is followed from then on
     '''
     pfile = os.path.join(run_dir, 'pfile')
     cmd = await _get_start_cmd(hub, t_type, t_name, tgt, run_dir, pfile)
 
+    hub.heist.ready.begin(t_name, retry)
     future = asyncio.ensure_future(getattr(hub, f'tunnel.{t_type}.cmd')(
         t_name, cmd))
     hub.heist.salt_master.FUTURES[t_name] = future
     # Call an await to give the future a chance to run
     await asyncio.sleep(0)
+    if hub.heist.ROSTERS[t_name].get('bootstrap'):
+        await future
+        hub.heist.ready.advance(t_name, 'started')
+        await _wait_alive(hub, t_type, t_name, pfile)
+    else:
+        hub.heist.ready.advance(t_name, 'started')
+    hub.heist.ready.track(t_name, _track, hub, t_type, t_name, tgt, run_dir)
 
 
-async def detect_os(hub, t_name, t_type):
+async def _iter_remotes(remotes):
     '''
-    Detect the os on the target system
+    Iterate over a list or an async iterator of remotes
     '''
-    ret = await getattr(hub, f'tunnel.{t_type}.cmd')(t_name, 'uname -a')
-    if ret.returncode == 0:
-        if ret.stdout.lower().startswith('linux'):
-            return 'linux'
-        elif ret.stdout.lower().startswith('darwin'):
-            return 'darwin'
-    log.critical('Could not determine the OS')
-    return False
+    if hasattr(remotes, '__aiter__'):
+        async for remote in remotes:
+            yield remote
+    else:
+        for remote in remotes:
+            yield remote
 
 
-async def run(hub, remotes: List[Dict[str, Any]]):
+async def run(hub, remotes: Union[Iterable[Dict[str, Any]], AsyncIterable[Dict[str, Any]]]):
     '''
     This plugin creates the salt specific tunnel, and then starts the remote
-    minion and attatches it to a currently running master
+    minion and attatches it to a currently running master. Remotes can be
+    streamed in, each one is started as soon as it is received
+    '''
+    hub.heist.gate.create('deploy', hub.OPT['heist']['max_in_flight'])
+    if hub.OPT['heist']['dynamic_upgrade']:
+        hub.heist.watch.start(hub.OPT['heist']['artifacts_dir'])
+    for stage in STAGES:
+        hub.heist.gate.create(f'stage:{stage}', hub.OPT['heist'][f'{stage}_limit'])
+    futures = []
+    try:
+        async for remote in _iter_remotes(remotes):
+            future = asyncio.ensure_future(hub.heist.salt_master.single(remote))
+            future.add_done_callback(functools.partial(_log_failure, remote))
+            futures.append(future)
+        await asyncio.gather(*futures, return_exceptions=True)
+        # Stay up while the deployed targets are checked in on
+        await hub.heist.schedule.join()
+    finally:
+        for follower in hub.heist.salt_master.FOLLOWERS.values():
+            follower.cancel()
+        hub.heist.salt_master.FOLLOWERS.clear()
+
+
+def _log_failure(remote: Dict[str, Any], future: asyncio.Future):
+    '''
+    Log the failure of a single target without disturbing the others
     '''
-    coros = []
-    for remote in remotes:
-        coros.append(hub.heist.salt_master.single(remote))
-    await asyncio.gather(*coros)
+    if future.cancelled() or not future.exception():
+        return
+    host = remote.get('host', remote.get('id'))
+    log.error(f'Deployment to {host} failed: {future.exception()!r}')
 
 
 def mk_startup_conf(hub, cmd, tgt, run_dir, pfile):
@@ -117,10 +269,6 @@ def mk_startup_conf(hub, cmd, tgt, run_dir, pfile):
             wfp.write(SYSTEMD_CONF.format(tgt=tgt,
                                           conf=os.path.join(run_dir, "conf"),
                                           pfile=pfile))
-    elif cmd == 'at':
-        with open(path, 'w+') as wfp:
-            wfp.write(f'{tgt} minion --config-dir {os.path.join(run_dir, "conf")} --pid-file={pfile}')
-        return path
 
     return path
 
@@ -145,114 +293,493 @@ def mk_config(hub, root_dir: str, t_name):
     return path
 
 
+def index(hub, a_dir: str) -> Dict[str, Dict[str, Any]]:
+    '''
+    Return the index of the artifacts in the given directory, a dict mapping
+    each artifact name to its versions in ascending order and the file for
+    each version. The index is only rebuilt when the directory changes
+    '''
+    try:
+        mtime = os.stat(a_dir).st_mtime_ns
+    except FileNotFoundError:
+        hub.heist.salt_master.ARTIFACTS.pop(a_dir, None)
+        return {}
+    cached = hub.heist.salt_master.ARTIFACTS.get(a_dir)
+    if cached and cached['mtime'] == mtime:
+        return cached['names']
+    names = {}
+    for fn in os.listdir(a_dir):
+        name, sep, ver = fn.rpartition('-')
+        if not sep:
+            continue
+        try:
+            key = StrictVersion(ver)
+        except ValueError:
+            log.debug(f'Skipping artifact with an invalid version: {fn}')
+            continue
+        entry = names.setdefault(name, {'versions': [], 'paths': {}})
+        entry['versions'].append((key, ver))
+        entry['paths'][ver] = os.path.join(a_dir, fn)
+    for entry in names.values():
+        entry['versions'] = [ver for _, ver in sorted(entry['versions'])]
+    hub.heist.salt_master.ARTIFACTS[a_dir] = {'mtime': mtime, 'names': names}
+    return names
+
+
+def invalidate(hub, a_dir: str):
+    '''
+    Drop the index of the given artifacts directory
+    '''
+    hub.heist.salt_master.ARTIFACTS.pop(a_dir, None)
+
+
 def latest(hub, name: str, a_dir: str, version=False):
     '''
     Given the artifacts directory return the latest desired artifact
 
     :param str version: Return the artifact for a specific version.
     '''
-    names = []
-    paths = {}
-    for fn in os.listdir(a_dir):
-        if fn.startswith(name):
-            ver = fn[len(name)+1:]
-            names.append(ver)
-            paths[ver] = fn
-    names = sorted(names, key=StrictVersion)
-    if version:
-        if version in names:
-            return os.path.join(a_dir, paths[version])
+    entry = hub.heist.salt_master.index(a_dir).get(name)
+    if not entry:
         return False
-    return os.path.join(a_dir, paths[names[-1]])
+    if version:
+        return entry['paths'].get(version, False)
+    return entry['paths'][entry['versions'][-1]]
+
+
+def _hash(path: str) -> str:
+    '''
+    Return the sha256 of the file at path
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def _digest(hub, path: str) -> str:
+    '''
+    Return the sha256 of a local artifact, an artifact is only hashed once
+    for as long as its size and modification time do not change
+    '''
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    future = hub.heist.salt_master.DIGESTS.get(key)
+    if future is None:
+        loop = asyncio.get_event_loop()
+        future = asyncio.ensure_future(loop.run_in_executor(None, _hash, path))
+        hub.heist.salt_master.DIGESTS[key] = future
+    try:
+        return await asyncio.shield(future)
+    except Exception:
+        hub.heist.salt_master.DIGESTS.pop(key, None)
+        raise
 
 
-async def deploy(hub, t_name, t_type, bin_, run_dir):
+async def _remote_digest(hub, t_name, t_type, path: str):
+    '''
+    Return the sha256 of a file on the target, or None if it is missing
+    '''
+    progs = ('sha256sum', 'shasum -a 256')
+    facts = hub.heist.facts.get(t_name)
+    if facts is not None:
+        progs = [prog for prog in progs if prog.split()[0] in facts.tools]
+    for prog in progs:
+        ret = await getattr(hub, f'tunnel.{t_type}.cmd')(t_name, f'{prog} {path}')
+        if ret.returncode == 127:
+            # The program is not installed, try the next one
+            continue
+        if ret.returncode == 0 and ret.stdout:
+            return ret.stdout.split()[0]
+        return None
+    return None
+
+
+async def _send_each(hub, t_name, t_type, base, files):
+    '''
+    Create the files that send_many would unpack under base one at a time,
+    for targets without tar
+    '''
+    dirs = set()
+    links = []
+    for path, spec in files.items():
+        path = os.path.join(base, path)
+        dirs.add(path if spec is None else os.path.dirname(path))
+        if isinstance(spec, dict):
+            links.append(f'ln -sfn {spec["symlink"]} {path}')
+    ret = await getattr(hub, f'tunnel.{t_type}.cmd')(t_name, f'mkdir -p {" ".join(sorted(dirs))}')
+    if ret.returncode != 0:
+        raise OSError(f'Creating the directories under {base} failed: {ret.stderr}')
+    for path, spec in files.items():
+        if isinstance(spec, str):
+            await getattr(hub, f'tunnel.{t_type}.send')(t_name, spec, os.path.join(base, path))
+    if links:
+        ret = await getattr(hub, f'tunnel.{t_type}.cmd')(t_name, ' && '.join(links))
+        if ret.returncode != 0:
+            raise OSError(f'Linking the files under {base} failed: {ret.stderr}')
+
+
+async def deploy(hub, t_name, t_type, bin_, run_dir, basis=None):
     '''
     Deploy the salt minion to the remote system
+
+    :param str basis: The path of an older binary on the remote system to
+        send the new binary as a delta against
     '''
     tgt = os.path.join(run_dir, os.path.basename(bin_))
     root_dir = os.path.join(run_dir, 'root')
+    # Resolve the master without blocking the loop, mk_config reads it from the cache
+    await hub.heist.dns.resolve(hub.heist.ROSTERS[t_name].get('master', '127.0.0.1'))
     config = hub.heist.salt_master.mk_config(root_dir, t_name)
-    conf_tgt = os.path.join(run_dir, 'conf', 'minion')
-
-    # run salt deployment
-    await getattr(hub, f'tunnel.{t_type}.cmd')(t_name, f'mkdir -p {os.path.join(run_dir, "conf")}')
-    await getattr(hub, f'tunnel.{t_type}.cmd')(t_name, f'mkdir -p {os.path.join(run_dir, "root")}')
+    base = os.path.dirname(run_dir)
+    run = os.path.basename(run_dir)
+
+    # The binary is kept in a store on the target named by its sha256 and
+    # linked into the run_dir, it is only uploaded when it is not there yet
+    sha = await _digest(hub, bin_)
+    stored = os.path.join(base, 'store', sha)
+    present = await _remote_digest(hub, t_name, t_type, stored) == sha
+
+    # The directories, the config and the link to the binary are all sent as
+    # one archive, unless the target has no tar to unpack it with
+    files = {os.path.join(run, 'conf', 'minion'): config,
+             os.path.join(run, 'root'): None,
+             'store': None,
+             os.path.join(run, os.path.basename(bin_)): {'symlink': stored}}
+    facts = hub.heist.facts.get(t_name)
     try:
-        await getattr(hub, f'tunnel.{t_type}.send')(t_name, config, conf_tgt)
-    except Exception:
-        host = hub.heist.CONS[t_name]
-        log.error(f'Failed to send {config} to {t_name} at {conf_tgt}')
+        if facts is not None and 'tar' not in facts.tools:
+            await _send_each(hub, t_name, t_type, base, files)
+        else:
+            await getattr(hub, f'tunnel.{t_type}.send_many')(t_name, base, files)
+    except Exception as exc:
+        log.error(f'Failed to send {config} to {t_name} at {run_dir}: {exc}')
+        raise
+    finally:
         os.remove(config)
-    await getattr(hub, f'tunnel.{t_type}.send')(t_name, bin_, tgt)
-    await getattr(hub, f'tunnel.{t_type}.cmd')(t_name, f'chmod +x {tgt}')
-    os.remove(config)
+
+    if present:
+        log.debug(f'{bin_} is already stored on {t_name}, skipping the upload')
+    else:
+        part = f'{stored}.{secrets.token_hex()[:8]}.part'
+        if basis:
+            await getattr(hub, f'tunnel.{t_type}.send')(t_name, bin_, part, basis=basis)
+        else:
+            await getattr(hub, f'tunnel.{t_type}.send')(t_name, bin_, part)
+        await getattr(hub, f'tunnel.{t_type}.cmd')(t_name, f'chmod +x {part} && mv -f {part} {stored}')
     return tgt
 
 
+def _remember(hub, t_name, **fields):
+    '''
+    Record the given fields of the target in the cache
+    '''
+    con = hub.heist.CONS.get(t_name, {})
+    if con.get('fingerprint'):
+        hub.heist.cache.put(con['host'], con['fingerprint'], **fields)
+
+
+async def _find_running(hub, t_name, t_type, bin_, run_dirs):
+    '''
+    Look for a minion that heist deployed into one of run_dirs and that
+    still runs bin_, all of them are checked in one command. A run_dir
+    matches when the pid in its pidfile is alive, the binary in it has the
+    same sha256 as bin_ and its config is the one deploy would send there.
+    Returns a tuple of (run_dir, pid) or None
+    '''
+    if not run_dirs:
+        return None
+    sha = await _digest(hub, bin_)
+    # A minion with another config, like one pointed at another master, is
+    # deployed again
+    await hub.heist.dns.resolve(hub.heist.ROSTERS[t_name].get('master', '127.0.0.1'))
+    configs = {}
+    for run_dir in run_dirs:
+        config = hub.heist.salt_master.mk_config(os.path.join(run_dir, 'root'), t_name)
+        try:
+            configs[run_dir] = _hash(config)
+        finally:
+            os.remove(config)
+    prog = 'sha256sum'
+    facts = hub.heist.facts.get(t_name)
+    if facts is not None and 'sha256sum' not in facts.tools and 'shasum' in facts.tools:
+        prog = 'shasum -a 256'
+    name = os.path.basename(bin_)
+    script = (f'for d in {" ".join(run_dirs)}; do '
+              f'p=$(cat "$d/pfile" 2>/dev/null) && kill -0 "$p" 2>/dev/null && '
+              f'echo "$d $p $({prog} "$d/{name}" 2>/dev/null) '
+              f'$({prog} "$d/conf/minion" 2>/dev/null)"; done; true')
+    ret = await getattr(hub, f'tunnel.{t_type}.cmd')(t_name, f"sh -c '{script}'")
+    for line in (ret.stdout or '').splitlines():
+        # The run_dir, the pid and the sha256 and path of the binary and the config
+        fields = line.split()
+        if (len(fields) >= 5 and fields[1].isdigit() and fields[2] == sha
+                and fields[4] == configs.get(fields[0])):
+            return fields[0], int(fields[1])
+    return None
+
+
+async def _record_pid(hub, t_name):
+    '''
+    Read the pid of the minion from its pidfile and cache it together with
+    the binary it runs
+    '''
+    con = hub.heist.CONS[t_name]
+    pfile = os.path.join(con['run_dir'], 'pfile')
+    ret = await getattr(hub, f'tunnel.{con["t_type"]}.cmd')(t_name, f'cat {pfile}')
+    if ret.returncode != 0 or not ret.stdout.strip().isdigit():
+        # The minion has not written it yet
+        return
+    await _remember_pid(hub, t_name, int(ret.stdout))
+
+
+async def _remember_pid(hub, t_name, pid):
+    '''
+    Keep the pid of the minion of the target and cache it together with the
+    binary it runs
+    '''
+    con = hub.heist.CONS.get(t_name)
+    if con is None:
+        return
+    con['pid'] = pid
+    _remember(hub, t_name, pid=pid, bin=con['bin'], sha=await _digest(hub, con['bin']))
+
+
+async def checkin(hub, t_name):
+    '''
+    Check in on a deployed target, when dynamic upgrades are enabled the
+    minion is upgraded if a newer artifact is available
+    '''
+    con = hub.heist.CONS[t_name]
+    if con.get('pid') is None:
+        await _record_pid(hub, t_name)
+    if not hub.OPT['heist']['dynamic_upgrade']:
+        return
+    latest = hub.heist.salt_master.latest('salt', con['art_dir'])
+    if latest and latest != con['bin']:
+        if hub.OPT['heist']['rolling_upgrade']:
+            # The rollout upgrades this target in its turn
+            hub.heist.rollout.start(con['art_dir'], latest)
+            return
+        await hub.heist.salt_master.update(t_name, con['t_type'], latest,
+                                           con['tgt'], con['run_dir'])
+        con['bin'] = latest
+
+
+def _follow(hub, t_os):
+    '''
+    Make sure the targets running t_os are checked in on as soon as the
+    watcher finds a new salt artifact for it, one follower runs per os
+    '''
+    if t_os not in hub.heist.salt_master.FOLLOWERS:
+        hub.heist.salt_master.FOLLOWERS[t_os] = asyncio.ensure_future(_wake(hub, t_os))
+
+
+async def _wake(hub, t_os):
+    '''
+    Wake the check-in of every target running t_os whenever a new salt
+    artifact is published for it
+    '''
+    updates = hub.heist.watch.subscribe(t_os)
+    try:
+        while True:
+            name, _ = await updates.get()
+            if name != 'salt':
+                continue
+            for t_name, con in list(hub.heist.CONS.items()):
+                if con.get('t_os') == t_os:
+                    hub.heist.schedule.wake(t_name)
+    finally:
+        hub.heist.watch.unsubscribe(t_os, updates)
+
+
 async def update(hub, t_name, t_type, bin_, tgt, run_dir):
     '''
     Re-deploy the latest minion to the remote system
     '''
     # TODO: When updating clean out the old deployment
     await hub.heist.salt_master.clean(t_name)
-    tgt = await hub.heist.salt_master.deploy(t_name, t_type, bin_, run_dir)
+    # The binary being replaced stays in the store of the target, the new
+    # one is sent as a delta against it
+    old = hub.heist.CONS[t_name].get('bin')
+    basis = None
+    if old and old != bin_ and os.path.exists(old):
+        basis = os.path.join(os.path.dirname(run_dir), 'store', await _digest(hub, old))
+    tgt = await hub.heist.salt_master.deploy(t_name, t_type, bin_, run_dir, basis=basis)
     hub.heist.CONS[t_name]['tgt'] = tgt
     await _start_minion(hub, t_type, t_name, tgt, run_dir)
 
 
 async def clean(hub, t_name):
+    # The minion is stopped on purpose, it must not be started again
+    hub.heist.ready.cancel(t_name)
     run_dir = hub.heist.CONS[t_name]['run_dir']
     t_type = hub.heist.CONS[t_name]['t_type']
     pfile = os.path.join(run_dir, 'pfile')
     await getattr(hub, f'tunnel.{t_type}.cmd')(t_name, f'kill `cat {pfile}`')
     await getattr(hub, f'tunnel.{t_type}.cmd')(t_name, f'rm -rf {run_dir}')
-    await hub.heist.salt_master.FUTURES[t_name]
+    hub.heist.CONS[t_name]['pid'] = None
+    _remember(hub, t_name, sha=None, pid=None)
+    # A minion that heist reattached to was not started by this run
+    future = hub.heist.salt_master.FUTURES.get(t_name)
+    if future is not None:
+        await future
 
 
-async def single(hub, remote: Dict[str, Any]):
+async def _stage(hub, stage: str, priority: int, func, *args):
     '''
-    Execute a single async connection
+    Run one stage of a deployment while holding a slot of that stage, each
+    stage has its own limit so a target waiting on a slow stage never holds
+    a slot that another target could use in a different stage
     '''
-    # create tunnel
-    t_name = secrets.token_hex()
-    hub.heist.ROSTERS[t_name] = remote
-    user = hub.heist.ROSTERS[t_name].get('user')
-    if not user:
-        user = 'root'
-    run_dir = os.path.join(os.sep, 'var', 'tmp', f'heist_{user}',
-                           f'{secrets.token_hex()[:4]}')
-    t_type = remote.get('tunnel', 'asyncssh')
-    a_type = remote.get('artifact', 'salt')
-    created = await getattr(hub, f'tunnel.{t_type}.create')(t_name, remote)
-    if not created:
-        log.error(f'Connection to host {remote["host"]} failed')
-        return
-    t_os = await hub.heist.salt_master.detect_os(t_name, t_type)
-    art_dir = os.path.join(hub.OPT['heist']['artifacts_dir'], t_os)
+    await hub.heist.gate.acquire(f'stage:{stage}', priority)
+    try:
+        return await func(hub, *args)
+    finally:
+        hub.heist.gate.release(f'stage:{stage}')
+
+
+async def _connect(hub, t_name, t_type, remote):
+    '''
+    Connect to the target, the number of concurrent handshakes is tuned per
+    subnet or roster group
+    '''
+    group = await hub.heist.aimd.group(remote)
+    await hub.heist.aimd.acquire(group)
+    start = time.monotonic()
+    created = False
+    try:
+        created = await getattr(hub, f'tunnel.{t_type}.create')(t_name, remote)
+    finally:
+        hub.heist.aimd.release(group, time.monotonic() - start, created)
+    return created
+
+
+async def _detect(hub, t_name, t_type, a_type, cached=None):
+    '''
+    Gather the facts of the target, or take them from the cache, and find
+    the version of the artifact to deploy for its os
+    '''
+    if cached and cached['facts']:
+        facts = hub.heist.facts.load(t_name, cached['facts'])
+    else:
+        facts = await hub.heist.facts.gather(t_name, t_type)
+    t_os = facts.os or False
     ver = await getattr(hub, f'artifact.{a_type}.get_version')(t_os)
+    return t_os, ver
+
+
+async def _transfer(hub, t_name, t_type, a_type, t_os, ver, run_dir, cached=None):
+    '''
+    Make sure the artifact is available locally and deploy it to the target.
+    Nothing is deployed when a minion of this artifact that heist deployed
+    before still runs on the target, from the cached run_dir or any other
+    run_dir of the same user. Returns None when there is no artifact
+    '''
+    art_dir = os.path.join(hub.OPT['heist']['artifacts_dir'], t_os)
     if ver:
         await getattr(hub, f'artifact.{a_type}.get_artifact')(t_name, t_type,
                                                               art_dir, t_os, ver=ver)
-    # Deploy
     bin_ = hub.heist.salt_master.latest('salt', art_dir, version=ver)
-    tgt = await hub.heist.salt_master.deploy(t_name, t_type, bin_, run_dir)
+    if not bin_:
+        log.error(f'No salt artifact{f" of version {ver}" if ver else ""} found in {art_dir}')
+        return None
+    facts = hub.heist.facts.get(t_name)
+    if facts is not None and 0 <= facts.free < os.path.getsize(bin_):
+        log.warning(f'{t_name} has {facts.free} bytes free in {os.path.dirname(run_dir)}, '
+                    f'which is not enough for {bin_}')
+    run_dirs = [run_dir] if cached and cached['run_dir'] == run_dir else []
+    if facts is not None:
+        run_dirs.extend(d for d in facts.deployments
+                        if os.path.dirname(d) == os.path.dirname(run_dir) and d not in run_dirs)
+    found = await _find_running(hub, t_name, t_type, bin_, run_dirs)
+    if found:
+        run_dir, pid = found
+        log.info(f'Reattached to the minion {pid} running in {run_dir} on {t_name}')
+        tgt = os.path.join(run_dir, os.path.basename(bin_))
+    else:
+        pid = None
+        tgt = await hub.heist.salt_master.deploy(t_name, t_type, bin_, run_dir)
     hub.heist.CONS[t_name] = {
         'run_dir': run_dir,
         't_type': t_type,
+        't_os': t_os,
         'manager': 'salt_master',
+        'art_dir': art_dir,
         'bin': bin_,
-        'tgt': tgt}
-    # Create tunnel back to master
+        'tgt': tgt,
+        'pid': pid}
+    return art_dir, bin_, tgt
+
+
+async def _start(hub, t_name, t_type, tgt, run_dir):
+    '''
+    Create the tunnels back to the master and start the minion
+    '''
     if not hub.heist.ROSTERS[t_name].get('bootstrap'):
         await getattr(hub, f'tunnel.{t_type}.tunnel')(t_name, 44505, 4505)
         await getattr(hub, f'tunnel.{t_type}.tunnel')(t_name, 44506, 4506)
-    # Start minion
+    if hub.heist.CONS[t_name].get('pid'):
+        # The minion from an earlier run of heist is still running
+        return
     await _start_minion(hub, t_type, t_name, tgt, run_dir)
-    while True:
-        await asyncio.sleep(hub.OPT['heist']['checkin_time'])
-        if hub.OPT['heist']['dynamic_upgrade']:
-            latest = hub.heist.salt_master.latest('salt', art_dir)
-            if latest != bin_:
-                bin_ = latest
-                await hub.heist.salt_master.update(t_name, t_type, latest, tgt, run_dir)
+
+
+async def single(hub, remote: Dict[str, Any]):
+    '''
+    Execute a single async connection
+    '''
+    # create tunnel
+    t_name = secrets.token_hex()
+    hub.heist.ROSTERS[t_name] = remote
+    user = hub.heist.ROSTERS[t_name].get('user')
+    if not user:
+        user = 'root'
+    run_dir = os.path.join(os.sep, 'var', 'tmp', f'heist_{user}',
+                           f'{secrets.token_hex()[:4]}')
+    t_type = remote.get('tunnel', 'asyncssh')
+    a_type = remote.get('artifact', 'salt')
+    # Hold a deployment slot until the minion is started, targets with a
+    # higher priority in the roster get a slot first
+    priority = remote.get('priority', 0)
+    await hub.heist.gate.acquire('deploy', priority)
+    try:
+        created = await _stage(hub, 'connect', priority, _connect, t_name, t_type, remote)
+        if not created:
+            log.error(f'Connection to host {remote["host"]} failed')
+            return
+        # A host is known to the cache by its address and host key
+        host = remote.get('host', remote.get('id'))
+        fingerprint = getattr(hub, f'tunnel.{t_type}.fingerprint')(t_name)
+        cached = hub.heist.cache.get(host, fingerprint)
+        if cached and cached['user'] != user:
+            cached = None
+        if cached and cached['run_dir']:
+            # Deploy where the last run did so a minion still running there is found
+            run_dir = cached['run_dir']
+        t_os, ver = await _stage(hub, 'detect', priority, _detect, t_name, t_type, a_type, cached)
+        transferred = await _stage(hub, 'transfer', priority, _transfer,
+                                   t_name, t_type, a_type, t_os, ver, run_dir, cached)
+        if not transferred:
+            return
+        _, _, tgt = transferred
+        hub.heist.CONS[t_name].update(host=host, fingerprint=fingerprint)
+        # The minion found running may be in another run_dir
+        run_dir = hub.heist.CONS[t_name]['run_dir']
+        await _stage(hub, 'start', priority, _start, t_name, t_type, tgt, run_dir)
+    finally:
+        hub.heist.gate.release('deploy')
+    fields = {'user': user,
+              'facts': hub.heist.facts.dump(hub.heist.facts.get(t_name)),
+              'run_dir': run_dir}
+    if not hub.heist.CONS[t_name]['pid']:
+        # The pid and the binary are cached once the new minion wrote its pidfile
+        fields.update(sha=None, bin=None, pid=None)
+    _remember(hub, t_name, **fields)
+    # Check-ins for every target run from one timer wheel rather than a
+    # sleeping coroutine per target
+    if hub.OPT['heist']['dynamic_upgrade']:
+        _follow(hub, t_os)
+    hub.heist.schedule.add(t_name, hub.OPT['heist']['checkin_time'],
+                           hub.heist.salt_master.checkin, t_name)
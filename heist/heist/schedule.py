@@ -0,0 +1,199 @@
+'''
+A hashed timer wheel that runs the periodic work of every target from a
+single task. Each target is an entry in one slot of the wheel instead of a
+coroutine of its own that sleeps between check-ins, the first run of an
+entry is spread randomly across its interval so targets deployed together
+do not all wake at once, and the entries that fall due on a tick are run
+in batches
+'''
+# Import python libs
+import asyncio
+import logging
+import random
+from typing import Any, Dict
+
+log = logging.getLogger(__name__)
+
+# The number of slots in the wheel, entries further away than one turn of
+# the wheel wait out the extra turns in their slot
+SLOTS = 512
+
+
+def __init__(hub):
+    '''
+    Set up the wheel
+    '''
+    hub.heist.schedule.WHEEL = {
+        'slots': [{} for _ in range(SLOTS)],
+        'pos': 0,
+        'entries': {},
+        'running': 0,
+        'runs': 0,
+        'failures': 0}
+    hub.heist.schedule.TASK = None
+    hub.heist.schedule.BATCHES = set()
+
+
+def _place(hub, entry: Dict[str, Any], delay: float):
+    '''
+    Put the entry in the slot that comes due after delay seconds
+    '''
+    wheel = hub.heist.schedule.WHEEL
+    ticks = max(1, int(round(delay / hub.OPT['heist']['checkin_tick'])))
+    entry['slot'] = (wheel['pos'] + ticks) % SLOTS
+    entry['rounds'] = (ticks - 1) // SLOTS
+    wheel['slots'][entry['slot']][entry['key']] = entry
+
+
+def _unplace(hub, entry: Dict[str, Any]):
+    '''
+    Take the entry out of its slot
+    '''
+    if entry['slot'] is not None:
+        hub.heist.schedule.WHEEL['slots'][entry['slot']].pop(entry['key'], None)
+        entry['slot'] = None
+
+
+def add(hub, key: str, interval: float, func, *args):
+    '''
+    Run the coroutine function func with args every interval seconds, an
+    existing entry with the same key is replaced. The first run happens at a
+    random point within the first interval
+    '''
+    hub.heist.schedule.remove(key)
+    entry = {'key': key,
+             'interval': interval,
+             'func': func,
+             'args': args,
+             'slot': None,
+             'rounds': 0}
+    hub.heist.schedule.WHEEL['entries'][key] = entry
+    _place(hub, entry, random.uniform(0, interval))
+    hub.heist.schedule.start()
+
+
+def remove(hub, key: str):
+    '''
+    Stop running the entry with the given key, a run in progress finishes
+    but is not scheduled again
+    '''
+    entry = hub.heist.schedule.WHEEL['entries'].pop(key, None)
+    if entry:
+        _unplace(hub, entry)
+
+
+def wake(hub, key: str):
+    '''
+    Run the entry with the given key on the next tick instead of waiting
+    for the rest of its interval
+    '''
+    entry = hub.heist.schedule.WHEEL['entries'].get(key)
+    if entry and entry['slot'] is not None:
+        _unplace(hub, entry)
+        _place(hub, entry, 0)
+
+
+async def _run(hub, entry: Dict[str, Any]):
+    '''
+    Run one entry and put it back on the wheel for its next interval
+    '''
+    wheel = hub.heist.schedule.WHEEL
+    wheel['running'] += 1
+    try:
+        await entry['func'](*entry['args'])
+    except asyncio.CancelledError:
+        raise
+    except Exception as exc:  # pylint: disable=broad-except
+        wheel['failures'] += 1
+        log.error(f'Scheduled work for {entry["key"]} failed: {exc}')
+    finally:
+        wheel['running'] -= 1
+    wheel['runs'] += 1
+    if wheel['entries'].get(entry['key']) is entry:
+        jitter = hub.OPT['heist']['checkin_jitter'] * entry['interval']
+        _place(hub, entry, entry['interval'] + random.uniform(-jitter, jitter))
+
+
+async def _run_due(hub, due):
+    '''
+    Run the entries that came due in batches of checkin_batch
+    '''
+    size = max(1, hub.OPT['heist']['checkin_batch'])
+    for start in range(0, len(due), size):
+        await asyncio.gather(*[_run(hub, entry) for entry in due[start:start + size]])
+
+
+async def _drive(hub):
+    '''
+    Turn the wheel one slot every checkin_tick seconds and start the
+    entries that came due
+    '''
+    wheel = hub.heist.schedule.WHEEL
+    loop = asyncio.get_event_loop()
+    tick = hub.OPT['heist']['checkin_tick']
+    next_tick = loop.time()
+    while True:
+        next_tick += tick
+        await asyncio.sleep(max(0, next_tick - loop.time()))
+        wheel['pos'] = (wheel['pos'] + 1) % SLOTS
+        slot = wheel['slots'][wheel['pos']]
+        due = []
+        for key, entry in list(slot.items()):
+            if entry['rounds']:
+                entry['rounds'] -= 1
+                continue
+            del slot[key]
+            entry['slot'] = None
+            due.append(entry)
+        if due:
+            # Slow work must not hold up the wheel
+            batches = asyncio.ensure_future(_run_due(hub, due))
+            hub.heist.schedule.BATCHES.add(batches)
+            batches.add_done_callback(hub.heist.schedule.BATCHES.discard)
+
+
+def start(hub):
+    '''
+    Start turning the wheel, only one task drives it at a time
+    '''
+    if hub.heist.schedule.TASK is not None and not hub.heist.schedule.TASK.done():
+        return
+    hub.heist.schedule.TASK = asyncio.ensure_future(_drive(hub))
+
+
+async def join(hub):
+    '''
+    Wait for the wheel to stop turning, returns at once when nothing is
+    scheduled
+    '''
+    task = hub.heist.schedule.TASK
+    if task is None or not hub.heist.schedule.WHEEL['entries']:
+        return
+    await asyncio.wait([task])
+
+
+async def stop(hub):
+    '''
+    Stop turning the wheel, cancel the work in progress and drop every entry
+    '''
+    for key in list(hub.heist.schedule.WHEEL['entries']):
+        hub.heist.schedule.remove(key)
+    tasks = list(hub.heist.schedule.BATCHES)
+    if hub.heist.schedule.TASK is not None:
+        tasks.append(hub.heist.schedule.TASK)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    hub.heist.schedule.TASK = None
+
+
+def status(hub) -> Dict[str, int]:
+    '''
+    Return the number of scheduled entries, the number running now and the
+    number of runs and failed runs so far
+    '''
+    wheel = hub.heist.schedule.WHEEL
+    return {'entries': len(wheel['entries']),
+            'running': wheel['running'],
+            'runs': wheel['runs'],
+            'failures': wheel['failures']}
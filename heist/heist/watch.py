@@ -0,0 +1,194 @@
+'''
+Watch the artifacts directory and tell subscribers when a new artifact
+becomes the latest for an os. On Linux the directory is watched with
+inotify, everywhere else, or if inotify cannot be set up, it is polled
+'''
+# Import python libs
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+
+log = logging.getLogger(__name__)
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT = struct.Struct('iIII')
+
+
+def __init__(hub):
+    '''
+    Set up the subscriber queues, the latest artifacts seen and the watcher
+    '''
+    hub.heist.watch.SUBSCRIBERS = {}
+    hub.heist.watch.LATEST = {}
+    hub.heist.watch.TASK = None
+
+
+def subscribe(hub, t_os: str) -> asyncio.Queue:
+    '''
+    Return a queue that receives a tuple of (name, path) whenever a new
+    artifact becomes the latest for the given os
+    '''
+    queue = asyncio.Queue()
+    hub.heist.watch.SUBSCRIBERS.setdefault(t_os, set()).add(queue)
+    return queue
+
+
+def unsubscribe(hub, t_os: str, queue: asyncio.Queue):
+    '''
+    Stop sending events to the given queue
+    '''
+    hub.heist.watch.SUBSCRIBERS.get(t_os, set()).discard(queue)
+
+
+def publish(hub, t_os: str, name: str, path: str):
+    '''
+    Tell every subscriber of the os that path is the latest artifact
+    '''
+    log.info(f'New {name} artifact available for {t_os}: {path}')
+    for queue in hub.heist.watch.SUBSCRIBERS.get(t_os, ()):
+        queue.put_nowait((name, path))
+
+
+def scan(hub, a_dir: str, notify: bool = True):
+    '''
+    Find the latest artifacts for every os in the artifacts directory and
+    publish the ones that changed since the last scan
+    '''
+    try:
+        oses = [d for d in os.listdir(a_dir)
+                if os.path.isdir(os.path.join(a_dir, d))]
+    except FileNotFoundError:
+        return
+    for t_os in oses:
+        names = hub.heist.salt_master.index(os.path.join(a_dir, t_os))
+        for name, entry in names.items():
+            path = entry['paths'][entry['versions'][-1]]
+            key = (t_os, name)
+            if hub.heist.watch.LATEST.get(key) == path:
+                continue
+            hub.heist.watch.LATEST[key] = path
+            if notify:
+                hub.heist.watch.publish(t_os, name, path)
+
+
+def _libc():
+    '''
+    Return the C library if it supports inotify
+    '''
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+async def _watch_inotify(hub, libc, a_dir: str):
+    '''
+    Scan the artifacts directory whenever inotify reports a change in it
+    '''
+    fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+    wds = {}
+
+    def _add(path):
+        wd = libc.inotify_add_watch(fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            log.warning(f'Could not watch {path}: {os.strerror(ctypes.get_errno())}')
+            return
+        wds[wd] = path
+
+    def _read():
+        try:
+            data = os.read(fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + EVENT.size <= len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0')
+            offset += EVENT.size + length
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and wds.get(wd) == a_dir:
+                # A new os directory
+                _add(os.path.join(a_dir, os.fsdecode(name)))
+            elif mask & IN_CREATE and not mask & IN_ISDIR:
+                # Wait for the file to be closed or moved into place
+                continue
+            changed.set()
+
+    changed = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    try:
+        _add(a_dir)
+        if not wds:
+            raise OSError(f'Could not watch {a_dir}')
+        for t_os in os.listdir(a_dir):
+            if os.path.isdir(os.path.join(a_dir, t_os)):
+                _add(os.path.join(a_dir, t_os))
+        loop.add_reader(fd, _read)
+        while True:
+            await changed.wait()
+            changed.clear()
+            hub.heist.watch.scan(a_dir)
+    finally:
+        loop.remove_reader(fd)
+        os.close(fd)
+
+
+async def _watch_poll(hub, a_dir: str):
+    '''
+    Scan the artifacts directory every watch_interval seconds
+    '''
+    while True:
+        await asyncio.sleep(hub.OPT['heist']['watch_interval'])
+        hub.heist.watch.scan(a_dir)
+
+
+async def _watch(hub, a_dir: str):
+    '''
+    Watch the artifacts directory with inotify if it is available and fall
+    back to polling it
+    '''
+    libc = _libc()
+    if libc is not None:
+        try:
+            await _watch_inotify(hub, libc, a_dir)
+        except OSError as exc:
+            log.warning(f'Could not watch {a_dir} with inotify, polling it instead: {exc}')
+    await _watch_poll(hub, a_dir)
+
+
+def start(hub, a_dir: str):
+    '''
+    Start watching the artifacts directory, only one watcher runs at a time
+    '''
+    if hub.heist.watch.TASK is not None and not hub.heist.watch.TASK.done():
+        return
+    hub.heist.watch.scan(a_dir, notify=False)
+    hub.heist.watch.TASK = asyncio.ensure_future(_watch(hub, a_dir))
+
+
+async def stop(hub):
+    '''
+    Stop watching the artifacts directory
+    '''
+    task = hub.heist.watch.TASK
+    if task is None:
+        return
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    hub.heist.watch.TASK = None
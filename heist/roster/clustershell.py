@@ -18,42 +18,44 @@ import asyncio
 import ipaddress
 import logging
 import socket
-from typing import Any, Dict
+from typing import Any, AsyncIterator, Dict, Tuple
 
 # Import 3rd-party libs
 from ClusterShell.NodeSet import NodeSet
 
 log = logging.getLogger(__name__)
 
-async def read(hub) -> Dict[str, Any]:
+
+async def _scan(hub):
     '''
-    Resolve hostname in a clustershell style
-    and query the ports for SSH
+    Resolve the hosts in the target and yield a tuple of (addr, target) for
+    every addr with an open SSH port, in the order they are found
     '''
-    ret = {}
     tgt = hub.OPT['heist'].get('target')
     if not tgt:
         log.critical('Need to define a target for the scan roster')
-        return ret
+        return
     ports = hub.OPT['heist']['ssh_scan_ports']
     if not isinstance(ports, list):
         # Comma-separate list of integers
         ports = list(map(int, str(ports).split(',')))
 
     hosts = list(NodeSet(tgt))
-    host_addrs = dict([(h, socket.gethostbyname(h)) for h in hosts])
+    host_addrs = await hub.heist.dns.resolve_many(hosts, family=socket.AF_INET)
 
     for host, addr in host_addrs.items():
+        if not addr:
+            log.critical(f'Could not resolve host: {host}')
+            continue
         addr = ipaddress.ip_address(addr)
+        if addr.version == 4:
+            fam = socket.AF_INET
+        elif addr.version == 6:
+            fam = socket.AF_INET6
+        addr = addr.exploded
         for port in ports:
             log.debug(f'Scanning host: {addr} on port: {port}')
             try:
-                if addr.version == 4:
-                    fam = socket.AF_INET
-                elif addr.version == 6:
-                    fam = socket.AF_INET6
-
-                addr = addr.exploded
                 reader, writer = await asyncio.open_connection(
                     addr, port, family=fam)
                 data = await reader.read(100)
@@ -61,10 +63,30 @@ async def read(hub) -> Dict[str, Any]:
                     log.critical(f'Connection successful to {addr} '
                                  f'but SSH information not returned.'
                                  f'Port {port} might not be an SSH port.')
-                ret[addr] = ({'host': addr, 'port': port})
                 writer.close()
                 await writer.wait_closed()
             except ConnectionRefusedError:
                 log.critical(f'Not able to connect to host: {addr} on port: {port}')
-                pass
+                continue
+            yield addr, {'host': addr, 'port': port}
+            break
+
+
+async def read(hub) -> Dict[str, Any]:
+    '''
+    Resolve hostname in a clustershell style
+    and query the ports for SSH
+    '''
+    ret = {}
+    async for addr, target in _scan(hub):
+        ret[addr] = target
     return ret
+
+
+async def stream(hub) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+    '''
+    Resolve hostname in a clustershell style and yield each host as soon as
+    an SSH port is found on it
+    '''
+    async for addr, target in _scan(hub):
+        yield addr, target
@@ -3,7 +3,7 @@
 
 # Import python libs
 import logging
-from typing import Any, Dict, List
+from typing import Any, AsyncIterator, Dict, List
 
 # Import pop libs
 import rend.exc
@@ -39,3 +39,26 @@ async def read(hub, roster: str) -> List[Dict[str, Any]]:
             condition['id'] = id_
         ret.append(condition)
     return ret
+
+
+async def stream(hub, roster: str) -> AsyncIterator[Dict[str, Any]]:
+    '''
+    Yield the targets from the given roster as they are discovered. Rosters
+    that define a ``stream`` function are consumed incrementally, all other
+    rosters are read in full and then yielded
+    '''
+    if not hasattr(getattr(hub, f'roster.{roster}'), 'stream'):
+        for condition in await hub.roster.init.read(roster) or []:
+            yield condition
+        return
+
+    try:
+        async for id_, condition in getattr(hub, f'roster.{roster}.stream')():
+            if not isinstance(condition, dict):
+                log.critical(f'The roster {roster} returned a target that is not formatted correctly: {id_}')
+                continue
+            if 'id' not in condition:
+                condition['id'] = id_
+            yield condition
+    except rend.exc.RenderException as exc:
+        log.critical(f'Could not render the {roster} roster, error: {exc.args[0]}')
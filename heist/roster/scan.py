@@ -1,18 +1,127 @@
 # -*- coding: utf-8 -*-
 '''
 Scan a netmask or ipaddr for open ssh ports
+
+The scan runs a bounded number of probes concurrently, each probe has its own
+connect and banner read timeouts so that filtered hosts do not stall the rest
+of the scan:
+
+.. code-block:: bash
+
+    heist --roster scan --target 10.0.0.0/16 --scan-concurrency 2048 --scan-timeout 2
 '''
 
 # Import python libs
 import asyncio
 import ipaddress
+import itertools
 import logging
 import socket
-from typing import Any, Dict
+from typing import Any, AsyncIterator, Dict, Iterable, List, Tuple
 
 log = logging.getLogger(__name__)
 
 
+def _get_ports(hub) -> List[int]:
+    '''
+    Return the configured ssh ports as a list of integers
+    '''
+    ports = hub.OPT['heist']['ssh_scan_ports']
+    if not isinstance(ports, list):
+        # Comma-separate list of integers
+        ports = list(map(int, str(ports).split(',')))
+    return ports
+
+
+def _get_addrs(target: str) -> Iterable:
+    '''
+    Return an iterable of the addresses described by the target, the network
+    hosts are generated lazily so that large networks are never expanded in
+    memory
+    '''
+    try:
+        return [ipaddress.ip_address(target)]
+    except ValueError:
+        pass
+    try:
+        return ipaddress.ip_network(target).hosts()
+    except ValueError:
+        log.critical(f'The target {target} is not a valid address or network')
+        return []
+
+
+async def _probe(hub, addr: str, port: int, family: int = socket.AF_INET) -> bool:
+    '''
+    Connect to the given addr and port and read the banner, return True if
+    the port is open. The connect and the banner read are each bound by
+    their own timeout
+    '''
+    log.debug(f'Scanning host: {addr} on port: {port}')
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(addr, port, family=family),
+            timeout=hub.OPT['heist']['scan_timeout'])
+    except asyncio.TimeoutError:
+        log.debug(f'Timed out connecting to host: {addr} on port: {port}')
+        return False
+    except OSError:
+        log.debug(f'Not able to connect to host: {addr} on port: {port}')
+        return False
+    try:
+        data = await asyncio.wait_for(
+            reader.read(100),
+            timeout=hub.OPT['heist']['scan_banner_timeout'])
+    except (asyncio.TimeoutError, OSError):
+        data = b''
+    if 'ssh' not in data.decode(errors='replace').lower():
+        log.critical(f'Connection successful to {addr} '
+                     f'but SSH information not returned.'
+                     f'Port {port} might not be an SSH port.')
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return True
+
+
+async def _scan(hub, addrs: Iterable, ports: List[int]):
+    '''
+    Probe every port on every addr with at most ``scan_concurrency`` probes
+    in flight. Yield a tuple of (index, addr, port) for every open port as soon
+    as it is found, the index is the position of the probe in the scan order
+    and can be used to restore a stable ordering
+    '''
+    probes = enumerate(itertools.product(addrs, ports))
+    found = asyncio.Queue()
+    done = object()
+
+    async def _worker():
+        for index, (addr, port) in probes:
+            if addr.version == 4:
+                fam = socket.AF_INET
+            else:
+                fam = socket.AF_INET6
+            if await _probe(hub, addr.exploded, port, fam):
+                await found.put((index, addr.exploded, port))
+        await found.put(done)
+
+    workers = [asyncio.ensure_future(_worker())
+               for _ in range(max(1, hub.OPT['heist']['scan_concurrency']))]
+    try:
+        running = len(workers)
+        while running:
+            item = await found.get()
+            if item is done:
+                running -= 1
+                continue
+            yield item
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+
 async def read(hub) -> Dict[str, Any]:
     '''
     read data from connection to specified ports
@@ -23,39 +132,27 @@ async def read(hub) -> Dict[str, Any]:
     if not target:
         log.critical('Need to define a target for the scan roster')
         return ret
-    ports = hub.OPT['heist']['ssh_scan_ports']
-    if not isinstance(ports, list):
-        # Comma-separate list of integers
-        ports = list(map(int, str(ports).split(',')))
-    try:
-        addrs = [ipaddress.ip_address(target)]
-    except ValueError:
-        try:
-            addrs = ipaddress.ip_network(hub.OPT['heist']['target']).hosts()
-        except ValueError:
-            pass
-
-    for addr in addrs:
-        for port in ports:
-            log.debug(f'Scanning host: {addr} on port: {port}')
-            try:
-                if addr.version == 4:
-                    fam = socket.AF_INET
-                elif addr.version == 6:
-                    fam = socket.AF_INET6
-
-                addr = addr.exploded
-                reader, writer = await asyncio.open_connection(
-                    addr, port, family=fam)
-                data = await reader.read(100)
-                if 'ssh' not in data.decode().lower():
-                    log.critical(f'Connection successful to {addr} '
-                                 f'but SSH information not returned.'
-                                 f'Port {port} might not be an SSH port.')
-                ret[addr] = ({'host': addr, 'port': port})
-                writer.close()
-                await writer.wait_closed()
-            except ConnectionRefusedError:
-                log.critical(f'Not able to connect to host: {addr} on port: {port}')
-                pass
+    ports = _get_ports(hub)
+    addrs = _get_addrs(target)
+
+    results = [item async for item in _scan(hub, addrs, ports)]
+    for _, addr, port in sorted(results):
+        ret.setdefault(addr, {'host': addr, 'port': port})
     return ret
+
+
+async def stream(hub) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+    '''
+    Yield a tuple of (addr, target) for each host as soon as an SSH port is
+    found on it, hosts are yielded in the order they answer
+    '''
+    target = hub.OPT['heist'].get('target')
+    if not target:
+        log.critical('Need to define a target for the scan roster')
+        return
+    seen = set()
+    async for _, addr, port in _scan(hub, _get_addrs(target), _get_ports(hub)):
+        if addr in seen:
+            continue
+        seen.add(addr)
+        yield addr, {'host': addr, 'port': port}
@@ -1,19 +1,69 @@
-# Import third party libs
-import asyncssh
+# Import python libs
+import asyncio
+import hashlib
 import inspect
 import logging
-from typing import Any, Dict
+import lzma
+import math
+import mmap
+import os
+import secrets
+import shutil
+import tarfile
+import tempfile
+import time
+from typing import Any, Dict, Iterator, List, Tuple
+
+# Import third party libs
+import asyncssh
+
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
 
 __virtualname__ = 'asyncssh'
 
 log = logging.getLogger(__name__)
 
+# Delta transfers compare the new file with the basis in blocks of this size
+DELTA_BLOCK_SIZE = 64 * 1024
+# SFTP uploads that are tuned automatically use blocks of this size and keep
+# enough write requests outstanding to fill twice the bandwidth-delay
+# product of the connection, between the minimum and maximum
+SFTP_BLOCK_SIZE = 64 * 1024
+SFTP_MIN_REQUESTS = 16
+SFTP_MAX_REQUESTS = 1024
+# The bandwidth assumed for a connection before a transfer was measured on it
+SFTP_BANDWIDTH = 100 * 1000 * 1000 // 8
+# The size of the upload timed to measure the bandwidth of a connection
+# before a codec is picked for it
+PROBE_SIZE = 1024 * 1024
+# Files smaller than this are never compressed for the transfer
+COMPRESS_MIN_SIZE = 1024 * 1024
+# The codecs a transfer can be compressed with, the share of the size that
+# is left after compression and the speed a target decompresses at in bytes
+# per second are estimates used to pick the fastest way to send a file
+CODECS = {
+    'zstd': {'ext': 'zst', 'ratio': 0.35, 'speed': 400 * 1000 * 1000, 'cmd': 'zstd -dc'},
+    'xz': {'ext': 'xz', 'ratio': 0.25, 'speed': 40 * 1000 * 1000, 'cmd': 'xz -dc'},
+}
+# Compressed data is streamed to the decompressor on the target in chunks
+# of this size
+STREAM_CHUNK_SIZE = 256 * 1024
+# A delta that needs more than this share of the file sent as new data is
+# not worth the extra round trips, the whole file is sent instead
+DELTA_MAX_RATIO = 0.5
+
 
 def __init__(hub):
     '''
     Set up the objects to hold connection instances
     '''
     hub.tunnel.asyncssh.CONS = {}
+    hub.tunnel.asyncssh.BUFFERS = {}
+    hub.tunnel.asyncssh.COMPRESSED = {}
 
 
 def _autodetect_asyncssh_opt(hub, option: str) -> Any:
@@ -75,16 +125,424 @@ async def create(hub, name: str, target: Dict[str, Any]):
     hub.tunnel.asyncssh.CONS[name] = {
         'con': conn,
         'sftp': sftp,
-        'sudo': target.get('sudo', None)}
+        'sudo': target.get('sudo', None),
+        # 0 tunes the SFTP upload settings for the connection
+        'block_size': int(_get_asyncssh_opt(hub, target, 'sftp_block_size', 0)),
+        'max_requests': int(_get_asyncssh_opt(hub, target, 'sftp_max_requests', 0)),
+        'compression': _get_asyncssh_opt(hub, target, 'compression', 'auto'),
+        'decompressors': None,
+        'rtt': None,
+        'bandwidth': SFTP_BANDWIDTH,
+        # Whether the bandwidth was measured on the connection
+        'measured': False,
+        'stats': {'transfers': 0, 'bytes': 0, 'seconds': 0.0, 'last': None},
+        # Commands run in one long lived shell on the target when enabled
+        'persistent_shell': bool(_get_asyncssh_opt(hub, target, 'persistent_shell', False)),
+        'shell': None,
+        'shell_lock': asyncio.Lock()}
     return True
 
 
-async def send(hub, name: str, source: str, dest: str):
+async def send(hub, name: str, source: str, dest: str, basis: str = None):
     '''
-    Take the file located at source and send it to the remote system
+    Take the file located at source and send it to the remote system. If the
+    path of an older version of the file on the remote system is given as
+    the basis, only the blocks that changed are sent when that saves enough
+    '''
+    if basis:
+        try:
+            if await _send_delta(hub, name, source, dest, basis):
+                return
+        except (OSError, asyncssh.Error) as exc:
+            log.debug(f'Delta transfer of {source} to {name} failed, sending it whole: {exc}')
+    codec = await _codec(hub, name, os.path.getsize(source), dest)
+    if codec:
+        try:
+            if await _send_compressed(hub, name, source, dest, codec):
+                return
+        except (OSError, asyncssh.Error, lzma.LZMAError) as exc:
+            log.debug(f'Compressed transfer of {source} to {name} failed, sending it as it is: {exc}')
+    key, view = _open_buffer(hub, source)
+    try:
+        await hub.tunnel.asyncssh.send_buffer(name, view, dest)
+    finally:
+        _close_buffer(hub, key)
+
+
+async def send_buffer(hub, name: str, buffer, dest: str):
+    '''
+    Send the contents of a buffer, like bytes, a memoryview or an mmap, to
+    dest on the remote system. The blocks are written straight out of the
+    buffer without copying it
     '''
     sftp = hub.tunnel.asyncssh.CONS[name]['sftp']
-    await sftp.put(source, dest)
+    view = memoryview(buffer)
+    block_size, max_requests = await _sftp_opts(hub, name)
+    start = time.monotonic()
+    async with sftp.open(dest, 'wb', block_size=block_size, max_requests=max_requests) as fp:
+        # Writes larger than a block are sent as parallel requests
+        await fp.write(view)
+    _record(hub, name, dest, view.nbytes, time.monotonic() - start, block_size, max_requests)
+
+
+async def _sftp_opts(hub, name: str):
+    '''
+    Return the block size and the number of outstanding requests to upload
+    with. Settings from the roster or the cli are used as they are, the
+    rest are sized so the requests in flight cover the bandwidth-delay
+    product of the connection
+    '''
+    con = hub.tunnel.asyncssh.CONS[name]
+    block_size = con.get('block_size') or SFTP_BLOCK_SIZE
+    if con.get('max_requests'):
+        return block_size, con['max_requests']
+    if con.get('rtt') is None:
+        # One round trip to measure the latency of the connection
+        start = time.monotonic()
+        await con['sftp'].realpath('.')
+        con['rtt'] = time.monotonic() - start
+    bdp = con['rtt'] * con.get('bandwidth', SFTP_BANDWIDTH)
+    max_requests = math.ceil(2 * bdp / block_size)
+    return block_size, min(SFTP_MAX_REQUESTS, max(SFTP_MIN_REQUESTS, max_requests))
+
+
+def _record(hub, name: str, dest: str, size: int, seconds: float, block_size: int, max_requests: int,
+            estimate: bool = True):
+    '''
+    Keep the throughput statistics of an upload and, unless estimate is
+    False, update the bandwidth estimate of the connection from it
+    '''
+    con = hub.tunnel.asyncssh.CONS[name]
+    stats = con['stats']
+    rate = size / seconds if seconds > 0 else 0.0
+    stats['transfers'] += 1
+    stats['bytes'] += size
+    stats['seconds'] += seconds
+    stats['last'] = {'dest': dest, 'bytes': size, 'seconds': seconds, 'rate': rate,
+                     'block_size': block_size, 'max_requests': max_requests}
+    log.debug(f'Sent {size} bytes to {name} at {dest} in {seconds:.2f}s, '
+              f'{rate / 1e6:.2f} MB/s with {max_requests} requests of {block_size} bytes')
+    # Small uploads finish before the window opens up and say little about
+    # the bandwidth
+    if estimate and con.get('rtt') and size >= block_size * max_requests:
+        window = block_size * max_requests / con['rtt']
+        if rate >= window * 0.8:
+            # The requests in flight were the limit, probe for more
+            con['bandwidth'] = max(con['bandwidth'], rate * 2)
+        else:
+            con['bandwidth'] = rate
+        con['measured'] = True
+
+
+async def _measure(hub, name: str, dest: str):
+    '''
+    Measure the bandwidth of the connection by timing an upload of
+    PROBE_SIZE bytes next to dest with every block of it in flight at once
+    '''
+    con = hub.tunnel.asyncssh.CONS[name]
+    block_size, _ = await _sftp_opts(hub, name)
+    probe = f'{dest}.probe'
+    data = memoryview(os.urandom(PROBE_SIZE))
+    start = time.monotonic()
+    async with con['sftp'].open(probe, 'wb', block_size=block_size,
+                                max_requests=math.ceil(PROBE_SIZE / block_size)) as fp:
+        await fp.write(data)
+    seconds = time.monotonic() - start
+    await con['sftp'].remove(probe)
+    # Opening and closing the file take a round trip each, the data at least one
+    transfer = max(seconds - 2 * con['rtt'], con['rtt'], 1e-6)
+    con['bandwidth'] = PROBE_SIZE / transfer
+    con['measured'] = True
+    log.debug(f'Measured {con["bandwidth"] / 1e6:.2f} MB/s to {name}')
+
+
+async def _codec(hub, name: str, size: int, dest: str):
+    '''
+    Return the codec to compress a transfer of size bytes to dest on the
+    target with, or None to send it as it is. Unless the roster or the cli
+    pick a codec, the one that is expected to finish first given the
+    measured bandwidth of the connection and the decompressors on the
+    target is used. A connection whose bandwidth can not be measured is
+    sent to as it is
+    '''
+    con = hub.tunnel.asyncssh.CONS[name]
+    choice = con.get('compression', 'auto')
+    if choice == 'none' or size < COMPRESS_MIN_SIZE:
+        return None
+    if con.get('decompressors') is None:
+        ret = await hub.tunnel.asyncssh.cmd(name, "sh -c 'command -v zstd xz'")
+        con['decompressors'] = {os.path.basename(line.strip())
+                                for line in (ret.stdout or '').splitlines()}
+    available = [codec for codec in CODECS
+                 if codec in con['decompressors'] and (codec != 'zstd' or HAS_ZSTD)]
+    if choice != 'auto':
+        return choice if choice in available else None
+    if not available:
+        return None
+    if not con.get('measured'):
+        try:
+            await _measure(hub, name, dest)
+        except (OSError, asyncssh.Error) as exc:
+            log.debug(f'Could not measure the bandwidth to {name}, sending as it is: {exc}')
+            return None
+    bandwidth = con['bandwidth']
+    best, best_time = None, size / bandwidth
+    for codec in available:
+        # Decompression runs while the data streams in
+        est = max(size * CODECS[codec]['ratio'] / bandwidth, size / CODECS[codec]['speed'])
+        if est < best_time:
+            best, best_time = codec, est
+    return best
+
+
+def _compress(source: str, codec: str, dest: str):
+    '''
+    Write the compressed contents of source to dest
+    '''
+    part = f'{dest}.part'
+    with open(source, 'rb') as src:
+        if codec == 'xz':
+            with lzma.open(part, 'wb') as dst:
+                shutil.copyfileobj(src, dst, STREAM_CHUNK_SIZE)
+        else:
+            with open(part, 'wb') as dst:
+                zstandard.ZstdCompressor(level=19, threads=-1).copy_stream(src, dst)
+    os.replace(part, dest)
+
+
+async def _compressed(hub, source: str, codec: str) -> str:
+    '''
+    Return the path of the compressed copy of source, it is made once next
+    to source and reused for as long as source does not change
+    '''
+    dest = os.path.join(os.path.dirname(source),
+                        f'.{os.path.basename(source)}.{CODECS[codec]["ext"]}')
+    try:
+        if os.stat(dest).st_mtime_ns >= os.stat(source).st_mtime_ns:
+            return dest
+    except FileNotFoundError:
+        pass
+    future = hub.tunnel.asyncssh.COMPRESSED.get(dest)
+    if future is None:
+        loop = asyncio.get_event_loop()
+        future = asyncio.ensure_future(loop.run_in_executor(None, _compress, source, codec, dest))
+        hub.tunnel.asyncssh.COMPRESSED[dest] = future
+        future.add_done_callback(lambda _: hub.tunnel.asyncssh.COMPRESSED.pop(dest, None))
+    await asyncio.shield(future)
+    return dest
+
+
+async def _send_compressed(hub, name: str, source: str, dest: str, codec: str) -> bool:
+    '''
+    Stream the compressed copy of source into the decompressor on the target,
+    the target never stores the compressed data
+    '''
+    compressed = await _compressed(hub, source, codec)
+    con = hub.tunnel.asyncssh.CONS[name]['con']
+    key, view = _open_buffer(hub, compressed)
+    start = time.monotonic()
+    try:
+        proc = await con.create_process(f'{CODECS[codec]["cmd"]} > {dest}', encoding=None)
+        for offset in range(0, view.nbytes, STREAM_CHUNK_SIZE):
+            proc.stdin.write(bytes(view[offset:offset + STREAM_CHUNK_SIZE]))
+            await proc.stdin.drain()
+        proc.stdin.write_eof()
+        ret = await proc.wait()
+        size = view.nbytes
+    finally:
+        _close_buffer(hub, key)
+    if ret.exit_status != 0:
+        log.warning(f'Decompressing {dest} on {name} failed: {ret.stderr}')
+        return False
+    # The decompressor on the target may be what held the transfer up, it
+    # says nothing about the link
+    _record(hub, name, dest, size, time.monotonic() - start, size, 1, estimate=False)
+    log.info(f'Sent {source} to {name} compressed with {codec}, '
+             f'{size} of {os.path.getsize(source)} bytes')
+    return True
+
+
+def _open_buffer(hub, path: str):
+    '''
+    Return a read only view of the file at path, every upload of the same
+    file that runs at the same time shares one memory map of it
+    '''
+    stat = os.stat(path)
+    key = (path, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    buf = hub.tunnel.asyncssh.BUFFERS.get(key)
+    if buf is None:
+        if stat.st_size:
+            with open(path, 'rb') as fp:
+                map_ = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # Empty files can not be mapped
+            map_ = b''
+        buf = {'map': map_, 'view': memoryview(map_), 'refs': 0}
+        hub.tunnel.asyncssh.BUFFERS[key] = buf
+    buf['refs'] += 1
+    return key, buf['view']
+
+
+def _close_buffer(hub, key):
+    '''
+    Give back a view from _open_buffer, the map is closed when the last
+    upload using it is done
+    '''
+    buf = hub.tunnel.asyncssh.BUFFERS[key]
+    buf['refs'] -= 1
+    if buf['refs']:
+        return
+    del hub.tunnel.asyncssh.BUFFERS[key]
+    try:
+        buf['view'].release()
+        if isinstance(buf['map'], mmap.mmap):
+            buf['map'].close()
+    except BufferError:
+        # A cancelled write still holds a slice, the map is closed when
+        # that is collected
+        pass
+
+
+def _delta(source: str, blocks: Dict[str, int], literal) -> Tuple[List[Tuple[str, int, int]], int, str]:
+    '''
+    Compare the aligned blocks of source with the sha256 sums of the
+    aligned blocks of the basis. The blocks the basis does not have are written to the literal
+    file. Returns the runs of blocks to copy from the basis or the literal
+    file, the number of literal bytes and the sha256 of source
+    '''
+    runs = []
+    size = 0
+    digest = hashlib.sha256()
+    with open(source, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(DELTA_BLOCK_SIZE), b''):
+            digest.update(chunk)
+            index = blocks.get(hashlib.sha256(chunk).hexdigest())
+            if index is None:
+                kind, index = 'literal', size // DELTA_BLOCK_SIZE
+                literal.write(chunk)
+                size += len(chunk)
+            else:
+                kind = 'basis'
+            if runs and runs[-1][0] == kind and runs[-1][1] + runs[-1][2] == index:
+                runs[-1] = (kind, runs[-1][1], runs[-1][2] + 1)
+            else:
+                runs.append((kind, index, 1))
+    return runs, size, digest.hexdigest()
+
+
+async def _send_delta(hub, name: str, source: str, dest: str, basis: str) -> bool:
+    '''
+    Send source as the blocks of the basis on the remote system it shares
+    plus the blocks that are new. The remote system needs GNU split and
+    sha256sum, returns False when the delta could not be used.
+
+    This is not a full rsync: only the strong sums of the aligned blocks
+    of both files are compared, there is no rolling checksum to find a
+    block of the basis at any other offset of source. A block moved by a
+    whole number of blocks is still found, but an insertion or removal
+    that shifts the rest of the file by any other amount makes every block
+    after it literal, and such a delta falls back to sending source whole
+    once it is over DELTA_MAX_RATIO
+    '''
+    ret = await hub.tunnel.asyncssh.cmd(
+        name, f'split -b {DELTA_BLOCK_SIZE} --filter=sha256sum {basis}')
+    if ret.returncode != 0 or not ret.stdout:
+        return False
+    blocks = {}
+    for index, line in enumerate(ret.stdout.splitlines()):
+        blocks.setdefault(line.split()[0], index)
+
+    loop = asyncio.get_event_loop()
+    total = os.path.getsize(source)
+    with tempfile.NamedTemporaryFile(suffix='.delta') as literal:
+        runs, size, sha = await loop.run_in_executor(None, _delta, source, blocks, literal)
+        if size > total * DELTA_MAX_RATIO:
+            log.debug(f'{source} shares too little with {basis} on {name}, sending it whole')
+            return False
+        literal.flush()
+        lines = ['set -e', f'exec > {dest}']
+        for kind, start, count in runs:
+            if_ = basis if kind == 'basis' else f'{dest}.delta'
+            lines.append(f'dd if={if_} bs={DELTA_BLOCK_SIZE} skip={start} count={count} 2>/dev/null')
+        script = '\n'.join(lines) + '\n'
+        sftp = hub.tunnel.asyncssh.CONS[name]['sftp']
+        if size:
+            await sftp.put(literal.name, f'{dest}.delta')
+        with tempfile.NamedTemporaryFile('w', suffix='.sh') as fp:
+            fp.write(script)
+            fp.flush()
+            await sftp.put(fp.name, f'{dest}.sh')
+    ret = await hub.tunnel.asyncssh.cmd(
+        name, f'sh {dest}.sh; rm -f {dest}.sh {dest}.delta; sha256sum {dest}')
+    if ret.returncode != 0 or not ret.stdout or ret.stdout.split()[0] != sha:
+        log.warning(f'Rebuilding {dest} on {name} from {basis} failed, sending it whole')
+        return False
+    sent = size + len(script)
+    hub.tunnel.asyncssh.CONS[name]['saved'] = \
+        hub.tunnel.asyncssh.CONS[name].get('saved', 0) + total - sent
+    log.info(f'Sent {source} to {name} as a delta of {sent} bytes, '
+             f'saved {total - sent} of {total} bytes')
+    return True
+
+
+async def send_many(hub, name: str, dest: str, files: Dict[str, Any]):
+    '''
+    Send many files to the remote system at once, they are streamed as one
+    tar archive into a single tar process that unpacks it under dest. files
+    maps each path, relative to dest, to what is created there:
+
+        - a local path, the file is sent with its local mode
+        - a dict with the local path under source and the mode to give it
+        - a dict with the target of a symlink under symlink
+        - None, a directory
+    '''
+    con = hub.tunnel.asyncssh.CONS[name]['con']
+    proc = await con.create_process(f'mkdir -p {dest} && tar -xf - -C {dest}', encoding=None)
+    keys = []
+    try:
+        for chunk in _tar_stream(hub, files, keys):
+            proc.stdin.write(bytes(chunk))
+            await proc.stdin.drain()
+        proc.stdin.write_eof()
+        ret = await proc.wait()
+    finally:
+        for key in keys:
+            _close_buffer(hub, key)
+    if ret.exit_status != 0:
+        raise OSError(f'Unpacking files in {dest} on {name} failed: {ret.stderr}')
+
+
+def _tar_stream(hub, files: Dict[str, Any], keys: List[Any]) -> Iterator[Any]:
+    '''
+    Yield the blocks of a tar archive of files, the contents of each file
+    come straight from its shared buffer
+    '''
+    for path, spec in files.items():
+        info = tarfile.TarInfo(path)
+        info.mtime = int(time.time())
+        view = None
+        if spec is None:
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+        elif isinstance(spec, dict) and 'symlink' in spec:
+            info.type = tarfile.SYMTYPE
+            info.linkname = spec['symlink']
+            info.mode = 0o777
+        else:
+            if not isinstance(spec, dict):
+                spec = {'source': spec}
+            key, view = _open_buffer(hub, spec['source'])
+            keys.append(key)
+            info.size = view.nbytes
+            info.mode = spec.get('mode', os.stat(spec['source']).st_mode) & 0o7777
+        yield info.tobuf(format=tarfile.PAX_FORMAT)
+        if view is not None:
+            for offset in range(0, view.nbytes, STREAM_CHUNK_SIZE):
+                yield view[offset:offset + STREAM_CHUNK_SIZE]
+            if view.nbytes % tarfile.BLOCKSIZE:
+                yield tarfile.NUL * (tarfile.BLOCKSIZE - view.nbytes % tarfile.BLOCKSIZE)
+    # The end of an archive is two empty blocks
+    yield tarfile.NUL * tarfile.BLOCKSIZE * 2
 
 
 async def get(hub, name: str, source: str, dest: str):
@@ -99,11 +557,103 @@ async def cmd(hub, name: str, command: str):
     '''
     Execute the given command on the machine associated with the named connection
     '''
-    sudo = hub.tunnel.asyncssh.CONS[name].get('sudo')
+    con = hub.tunnel.asyncssh.CONS[name]
+    # A command that comes in while the shell is busy, like a minion running
+    # in the foreground, gets a channel of its own
+    if con.get('persistent_shell') and not con['shell_lock'].locked():
+        async with con['shell_lock']:
+            try:
+                shell, marker = await _shell_send(hub, name, command)
+            except (OSError, asyncssh.Error) as exc:
+                # Nothing reached the shell, the command can run on its own
+                log.debug(f'No shell on {name}, running the command on its own: {exc}')
+                _close_shell(hub, name)
+            else:
+                try:
+                    return await _shell_result(shell, marker, command)
+                except BaseException:
+                    # The command may have run already, running it again could
+                    # repeat what it did. The output of the command would be
+                    # read as that of the next one, so the shell goes too
+                    _close_shell(hub, name)
+                    raise
+    sudo = con.get('sudo')
     if sudo:
         command = f'sudo {command}'
-    con = hub.tunnel.asyncssh.CONS[name]['con']
-    return await con.run(command)
+    return await con['con'].run(command)
+
+
+async def _shell_send(hub, name: str, command: str):
+    '''
+    Send the command to the persistent shell of the connection, it is
+    started on first use and elevated with sudo once. Each command runs in
+    a subshell and is followed by a marker with its return code on stdout
+    and a marker on stderr, the output up to the markers belongs to the
+    command. Returns the shell and the marker, nothing was sent to the
+    shell when this raises
+    '''
+    con = hub.tunnel.asyncssh.CONS[name]
+    if con['shell'] is not None and con['shell'].returncode is not None:
+        # The shell exited since the last command
+        _close_shell(hub, name)
+    if con['shell'] is None:
+        shell = 'sudo sh' if con.get('sudo') else 'sh'
+        con['shell'] = await con['con'].create_process(shell, encoding=None)
+    shell = con['shell']
+    marker = f'heist-{secrets.token_hex(8)}'
+    shell.stdin.write(f'( {command}\n) </dev/null; '
+                      f'printf \'\\n%s %d\\n\' {marker} $?; '
+                      f'printf \'\\n%s\\n\' {marker} >&2\n'.encode())
+    return shell, marker
+
+
+async def _shell_result(shell, marker: str, command: str):
+    '''
+    Read the output and the return code of the command sent to the shell
+    with the marker. stdout and stderr are read at the same time, one of
+    them filling up while the other is read would hold up the shell
+    '''
+    async def _stdout():
+        out = await shell.stdout.readuntil(f'\n{marker} '.encode())
+        return out, int(await shell.stdout.readline())
+
+    reads = [asyncio.ensure_future(_stdout()),
+             asyncio.ensure_future(shell.stderr.readuntil(f'\n{marker}\n'.encode()))]
+    try:
+        await shell.stdin.drain()
+        (stdout, returncode), stderr = await asyncio.gather(*reads)
+    except asyncio.IncompleteReadError as exc:
+        raise EOFError(f'The shell exited running {command}') from exc
+    finally:
+        for read in reads:
+            read.cancel()
+    stdout = stdout[:-len(marker) - 2].decode(errors='replace')
+    stderr = stderr[:-len(marker) - 2].decode(errors='replace')
+    return asyncssh.process.SSHCompletedProcess(
+        command=command, exit_status=returncode, returncode=returncode,
+        stdout=stdout, stderr=stderr)
+
+
+def fingerprint(hub, name: str) -> str:
+    '''
+    Return the fingerprint of the host key the remote system presented
+    '''
+    key = hub.tunnel.asyncssh.CONS[name]['con'].get_server_host_key()
+    return key.get_fingerprint() if key else ''
+
+
+def _close_shell(hub, name: str):
+    '''
+    Close the persistent shell of the connection, the next command starts a
+    new one
+    '''
+    con = hub.tunnel.asyncssh.CONS[name]
+    shell, con['shell'] = con.get('shell'), None
+    if shell is not None:
+        try:
+            shell.stdin.write_eof()
+        except (OSError, asyncssh.Error):
+            pass
 
 
 async def tunnel(hub, name: str, remote: str, local: str):
@@ -118,6 +668,7 @@ async def destroy(hub, name: str):
     '''
     Destroy the named connection
     '''
+    _close_shell(hub, name)
     con = hub.tunnel.asyncssh.CONS[name]['con']
     con.close()
     await con.wait_closed()
@@ -6,7 +6,15 @@ async def sig_create(hub, name: str, target: Dict[str, Any]):
     pass
 
 
-async def sig_send(hub, name: str, source: str, dest: str):
+async def sig_send(hub, name: str, source: str, dest: str, basis: str = None):
+    pass
+
+
+async def sig_send_buffer(hub, name: str, buffer, dest: str):
+    pass
+
+
+async def sig_send_many(hub, name: str, dest: str, files: Dict[str, Any]):
     pass
 
 
@@ -18,6 +26,10 @@ async def sig_cmd(hub, name: str, command: str):
     pass
 
 
+def sig_fingerprint(hub, name: str):
+    pass
+
+
 async def sig_tunnel(hub, name: str, remote: str, local: str):
     pass
 
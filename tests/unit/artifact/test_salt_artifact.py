@@ -2,16 +2,69 @@
     unit tests for the clustershell roster
 '''
 # Import Python libs
+import asyncio
+import hashlib
 import os
 import secrets
+import unittest.mock as mock
 
 # Import Local libs
 import heist.artifact.salt_artifact
 
 # Import 3rd-party libs
+import aiohttp
+import aiohttp.test_utils
+import aiohttp.web
 import pop.mods.pop.testing as testing
 import pytest
 
+BINARY = os.urandom(3 * 1024 * 1024 + 17)
+SHA256 = hashlib.sha256(BINARY).hexdigest()
+
+
+@pytest.fixture
+async def repo(tmp_path):
+    '''
+    A local stand-in for repo.saltstack.com that serves a salt binary with
+    range support and can cut the first download short
+    '''
+    src = tmp_path / 'src'
+    src.mkdir()
+    (src / 'salt-2019.2.1').write_bytes(BINARY)
+    state = {'requests': [], 'index_requests': [], 'interrupt': False}
+
+    async def _binary(request):
+        state['requests'].append(request.headers.get('Range'))
+        if state['interrupt']:
+            state['interrupt'] = False
+            resp = aiohttp.web.StreamResponse(headers={'Content-Length': str(len(BINARY))})
+            await resp.prepare(request)
+            await resp.write(BINARY[:len(BINARY) // 2])
+            request.transport.close()
+            return resp
+        return aiohttp.web.FileResponse(src / 'salt-2019.2.1')
+
+    async def _index(request):
+        etag = request.headers.get('If-None-Match')
+        state['index_requests'].append(etag)
+        if etag == 'salt-etag':
+            return aiohttp.web.Response(status=304)
+        return aiohttp.web.json_response(
+            {'linux': {'salt-2019.2.1': {'version': '2019.2.1', 'SHA256': SHA256}}},
+            headers={'ETag': 'salt-etag'})
+
+    app = aiohttp.web.Application()
+    app.router.add_get('/salt-bin/repo.json', _index)
+    app.router.add_get('/salt-bin/linux/salt-2019.2.1', _binary)
+    server = aiohttp.test_utils.TestServer(app)
+    await server.start_server()
+    async with aiohttp.ClientSession() as session:
+        state['session'] = session
+        state['url'] = str(server.make_url('/salt-bin/linux/salt-2019.2.1'))
+        state['base'] = str(server.make_url('/salt-bin'))
+        yield state
+    await server.close()
+
 
 class TestSaltArtifact:
     @pytest.mark.asyncio
@@ -35,15 +88,80 @@ class TestSaltArtifact:
         with artifact_version not set and returns latest
         '''
         mock_hub.OPT = {'heist': {'artifact_version': ''}}
-        data = {'linux': {'salt-2019.2.1': {'version': '2019.2.1'},
-                          'salt-2019.2.3': {'version': '2019.2.3'},
-                          'salt-2019.2.2': {'version': '2019.2.2'}}}
-        mock_hub.artifact.salt.fetch.return_value = data
+        mock_hub.artifact.salt.repo.return_value = {'latest': {'linux': '2019.2.3'}}
 
         ver = await heist.artifact.salt_artifact.get_version(mock_hub, 'linux')
-        mock_hub.artifact.salt.fetch.assert_called()
+        mock_hub.artifact.salt.repo.assert_called_once_with()
         assert ver == '2019.2.3'
 
+    @pytest.mark.asyncio
+    async def test_get_version_repo_failed(self,
+                                           mock_hub):
+        '''
+        test heist.artifact.salt_version.get_version when the repo index
+        cannot be loaded
+        '''
+        mock_hub.OPT = {'heist': {'artifact_version': ''}}
+        mock_hub.artifact.salt.repo.return_value = {}
+
+        assert not await heist.artifact.salt_artifact.get_version(mock_hub, 'linux')
+
+    def test_latest_versions(self):
+        '''
+        test the newest version is found for every os in the repo data
+        '''
+        data = {'linux': {'salt-2019.2.1': {'version': '2019.2.1'},
+                          'salt-2019.2.3': {'version': '2019.2.3'},
+                          'salt-2019.2.2': {'version': '2019.2.2'}},
+                'darwin': {'salt-2019.2.10': {'version': '2019.2.10'},
+                           'salt-2019.2.9': {'version': '2019.2.9'}}}
+        assert heist.artifact.salt_artifact._latest_versions(data) == {
+            'linux': '2019.2.3', 'darwin': '2019.2.10'}
+
+    @pytest.mark.asyncio
+    async def test_repo(self, mock_hub, repo, tmp_path):
+        '''
+        test the repo index is loaded once, persisted and revalidated with
+        a conditional request once its ttl has passed
+        '''
+        mock_hub.OPT = {'heist': {'artifacts_dir': str(tmp_path / 'art'),
+                                  'repo_ttl': 3600}}
+        mock_hub.artifact.salt.REPO = {}
+        mock_hub.artifact.salt.REPO_FUTURE = None
+        mock_hub.artifact.salt.session.return_value = repo['session']
+
+        with mock.patch.object(heist.artifact.salt_artifact, 'REPO_URL', repo['base']):
+            rets = await asyncio.gather(*[heist.artifact.salt_artifact.repo(mock_hub)
+                                          for _ in range(50)])
+            assert repo['index_requests'] == [None]
+            assert rets[0]['latest'] == {'linux': '2019.2.1'}
+            assert all(ret is rets[0] for ret in rets)
+
+            # A new run within the ttl uses the index persisted on disk
+            mock_hub.artifact.salt.REPO = {}
+            ret = await heist.artifact.salt_artifact.repo(mock_hub)
+            assert repo['index_requests'] == [None]
+            assert ret['latest'] == {'linux': '2019.2.1'}
+
+            # Once the ttl has passed the index is revalidated
+            mock_hub.OPT['heist']['repo_ttl'] = 0
+            mock_hub.artifact.salt.REPO['expires'] = 0
+            ret = await heist.artifact.salt_artifact.repo(mock_hub)
+            assert repo['index_requests'] == [None, 'salt-etag']
+            assert ret['data']['linux']['salt-2019.2.1']['SHA256'] == SHA256
+
+    @pytest.mark.asyncio
+    async def test_session(self, mock_hub):
+        '''
+        test the client session is shared until it is closed
+        '''
+        mock_hub.artifact.salt.SESSION = None
+        session = heist.artifact.salt_artifact.session(mock_hub)
+        assert heist.artifact.salt_artifact.session(mock_hub) is session
+        await heist.artifact.salt_artifact.close(mock_hub)
+        assert session.closed
+        assert mock_hub.artifact.salt.SESSION is None
+
     @pytest.mark.asyncio
     async def test_get_artifact(self,
                                 mock_hub: testing.MockHub,
@@ -56,14 +174,79 @@ class TestSaltArtifact:
         ver = '2019.2.1'
 
         art_l = os.path.join(tmp_path, f'salt-{ver}')
-        os.mknod(art_l)
 
-        mock_hub.artifact.salt.fetch.return_value = art_l
+        async def _fetch(session, url, download=False, location=False, sha256=None):
+            os.mknod(location)
+            return location
+
+        mock_hub.OPT = {'heist': {'download_retries': 1}}
+        mock_hub.artifact.salt.DOWNLOADS = {}
+        mock_hub.artifact.salt.REPO = {}
+        mock_hub.artifact.salt.fetch.side_effect = _fetch
         mock_hub.heist.salt_master.latest.return_value = False
         ret = await heist.artifact.salt_artifact.get_artifact(mock_hub, t_name,
                                                               'asyncssh', tmp_path,
                                                               'linux', ver)
         assert ret
+        assert os.listdir(tmp_path) == [f'salt-{ver}']
+        assert not mock_hub.artifact.salt.DOWNLOADS
+
+    @pytest.mark.asyncio
+    async def test_get_artifact_single_flight(self,
+                                              mock_hub: testing.MockHub,
+                                              tmp_path):
+        '''
+        test concurrent targets that need the same artifact share one download
+        '''
+        ver = '2019.2.1'
+        release = asyncio.Event()
+
+        async def _fetch(session, url, download=False, location=False, sha256=None):
+            await release.wait()
+            with open(location, 'wb') as fp:
+                fp.write(b'salt')
+            return location
+
+        mock_hub.OPT = {'heist': {'download_retries': 1}}
+        mock_hub.artifact.salt.DOWNLOADS = {}
+        mock_hub.artifact.salt.REPO = {}
+        mock_hub.artifact.salt.fetch.side_effect = _fetch
+        mock_hub.heist.salt_master.latest.return_value = False
+        coros = [heist.artifact.salt_artifact.get_artifact(mock_hub, secrets.token_hex(),
+                                                           'asyncssh', tmp_path,
+                                                           'linux', ver)
+                 for _ in range(20)]
+        futures = asyncio.gather(*coros)
+        await asyncio.sleep(0)
+        # Nothing is visible at the final location until the download completes
+        assert not os.path.exists(os.path.join(tmp_path, f'salt-{ver}'))
+        release.set()
+        assert all(await futures)
+        assert mock_hub.artifact.salt.fetch.call_count == 1
+        assert os.listdir(tmp_path) == [f'salt-{ver}']
+
+    @pytest.mark.asyncio
+    async def test_get_artifact_failed(self,
+                                       mock_hub: testing.MockHub,
+                                       tmp_path):
+        '''
+        test a failed download leaves nothing behind
+        '''
+        async def _fetch(session, url, download=False, location=False, sha256=None):
+            with open(location, 'wb') as fp:
+                fp.write(b'partial')
+            return False
+
+        mock_hub.OPT = {'heist': {'download_retries': 1}}
+        mock_hub.artifact.salt.DOWNLOADS = {}
+        mock_hub.artifact.salt.REPO = {}
+        mock_hub.artifact.salt.fetch.side_effect = _fetch
+        mock_hub.heist.salt_master.latest.return_value = False
+        ret = await heist.artifact.salt_artifact.get_artifact(mock_hub, secrets.token_hex(),
+                                                              'asyncssh', tmp_path,
+                                                              'linux', '2019.2.1')
+        assert not ret
+        assert os.listdir(tmp_path) == []
 
     @pytest.mark.asyncio
     async def test_get_artifact_exists(self,
@@ -85,3 +268,71 @@ class TestSaltArtifact:
                                                               'linux', ver)
         assert ret
         mock_hub.artifact.salt.fetch.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_fetch_download(self, mock_hub, repo, tmp_path):
+        '''
+        test an artifact is streamed to disk and verified
+        '''
+        location = str(tmp_path / 'salt')
+        ret = await heist.artifact.salt_artifact.fetch(mock_hub, repo['session'], repo['url'],
+                                                       download=True, location=location,
+                                                       sha256=SHA256)
+        assert ret == location
+        with open(location, 'rb') as fp:
+            assert fp.read() == BINARY
+        assert repo['requests'] == [None]
+
+    @pytest.mark.asyncio
+    async def test_fetch_resume(self, mock_hub, repo, tmp_path):
+        '''
+        test a partial artifact is resumed with a range request
+        '''
+        location = str(tmp_path / 'salt')
+        with open(location, 'wb') as fp:
+            fp.write(BINARY[:1000])
+        ret = await heist.artifact.salt_artifact.fetch(mock_hub, repo['session'], repo['url'],
+                                                       download=True, location=location,
+                                                       sha256=SHA256)
+        assert ret == location
+        with open(location, 'rb') as fp:
+            assert fp.read() == BINARY
+        assert repo['requests'] == ['bytes=1000-']
+
+    @pytest.mark.asyncio
+    async def test_fetch_bad_checksum(self, mock_hub, repo, tmp_path):
+        '''
+        test an artifact that does not match the repo checksum is removed
+        '''
+        location = str(tmp_path / 'salt')
+        ret = await heist.artifact.salt_artifact.fetch(mock_hub, repo['session'], repo['url'],
+                                                       download=True, location=location,
+                                                       sha256='0' * 64)
+        assert not ret
+        assert not os.path.exists(location)
+
+    @pytest.mark.asyncio
+    async def test_get_artifact_interrupted(self, mock_hub, call_through, repo, tmp_path):
+        '''
+        test an interrupted download is resumed and checked against the
+        checksum in the repo metadata
+        '''
+        art_dir = str(tmp_path / 'linux')
+        repo['interrupt'] = True
+        mock_hub.OPT = {'heist': {'download_retries': 2}}
+        mock_hub.artifact.salt.DOWNLOADS = {}
+        mock_hub.artifact.salt.REPO = {'data': {'linux': {'salt-2019.2.1': {'version': '2019.2.1',
+                                                                            'SHA256': SHA256}}}}
+        mock_hub.artifact.salt.session.return_value = repo['session']
+        call_through(mock_hub.artifact.salt, heist.artifact.salt_artifact, 'fetch')
+        mock_hub.heist.salt_master.latest.return_value = False
+
+        ret = await heist.artifact.salt_artifact._download(
+            mock_hub, repo['url'], art_dir, 'linux', 'salt-2019.2.1')
+
+        assert ret
+        assert repo['requests'][0] is None
+        assert repo['requests'][-1].startswith('bytes=')
+        assert os.listdir(art_dir) == ['salt-2019.2.1']
+        with open(os.path.join(art_dir, 'salt-2019.2.1'), 'rb') as fp:
+            assert hashlib.sha256(fp.read()).hexdigest() == SHA256
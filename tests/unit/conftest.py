@@ -6,6 +6,7 @@
     Provide mock_hub fixture for all unit tests.
 '''
 
+import inspect
 import sys
 import unittest.mock as mock
 
@@ -30,3 +31,31 @@ def _hub():
 @pytest.fixture
 def mock_hub(_hub):
     return testing.MockHub(_hub)
+
+
+def _call_through(hub, func):
+    '''
+    Return a side effect that runs func on hub, a coroutine function gets a
+    coroutine function side effect so the mock awaits it
+    '''
+    if inspect.iscoroutinefunction(func):
+        async def _call(*args, **kwargs):
+            return await func(hub, *args, **kwargs)
+    else:
+        def _call(*args, **kwargs):
+            return func(hub, *args, **kwargs)
+    return _call
+
+
+@pytest.fixture
+def call_through(mock_hub):
+    '''
+    Return a function that makes the named functions of a mocked module run
+    the real functions of the module on mock_hub::
+
+        call_through(mock_hub.heist.gate, heist.heist.gate, 'acquire', 'release')
+    '''
+    def _wire(mocked, mod, *names):
+        for name in names:
+            getattr(mocked, name).side_effect = _call_through(mock_hub, getattr(mod, name))
+    return _wire
@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+'''
+    unit tests for heist.heist.aimd
+'''
+# Import Python libs
+import time
+
+# Import Local libs
+import heist.heist.aimd
+import heist.heist.gate
+
+# Import 3rd-party libs
+import pop.mods.pop.testing as testing
+import pytest
+
+
+@pytest.fixture
+def aimd_hub(mock_hub: testing.MockHub, call_through):
+    '''
+    A mock hub where the controller drives real gates
+    '''
+    mock_hub.OPT = {'heist': {'aimd_initial': 4,
+                              'aimd_min': 1,
+                              'aimd_max': 6,
+                              'aimd_increase': 1.0,
+                              'aimd_decrease': 0.5,
+                              'aimd_latency_factor': 3.0,
+                              'aimd_prefix': 24,
+                              'aimd_prefix6': 64}}
+    mock_hub.heist.aimd.GROUPS = {}
+    mock_hub.heist.gate.GATES = {}
+    call_through(mock_hub.heist.gate, heist.heist.gate,
+                 'create', 'acquire', 'release', 'set_limit', 'status')
+    return mock_hub
+
+
+class TestAimd:
+    @pytest.mark.parametrize('remote,expected',
+                             [({'host': '10.1.2.3'}, '10.1.2.0/24'),
+                              ({'host': '10.1.2.3', 'group': 'dc1'}, 'dc1'),
+                              ({'host': 'fe80::1'}, 'fe80::/64')])
+    @pytest.mark.asyncio
+    async def test_group(self, aimd_hub, remote, expected):
+        '''
+        test targets are grouped by roster group or subnet
+        '''
+        assert await heist.heist.aimd.group(aimd_hub, remote) == expected
+
+    @pytest.mark.asyncio
+    async def test_group_hostname(self, aimd_hub):
+        '''
+        test hostnames are grouped by the subnet they resolve to
+        '''
+        aimd_hub.heist.dns.resolve.return_value = '192.168.7.9'
+        assert await heist.heist.aimd.group(aimd_hub, {'host': 'web'}) == '192.168.7.0/24'
+
+    @pytest.mark.asyncio
+    async def test_additive_increase(self, aimd_hub):
+        '''
+        test healthy handshakes grow the limit up to the maximum
+        '''
+        for _ in range(40):
+            await heist.heist.aimd.acquire(aimd_hub, 'net')
+            heist.heist.aimd.release(aimd_hub, 'net', 0.1, True)
+        status = heist.heist.aimd.status(aimd_hub)['net']
+        assert status['limit'] == 6
+        assert status['successes'] == 40
+        assert status['active'] == 0
+
+    @pytest.mark.asyncio
+    async def test_zero_baseline(self, aimd_hub):
+        '''
+        test a first handshake measured at no time at all does not make the
+        handshakes after it count as congestion
+        '''
+        await heist.heist.aimd.acquire(aimd_hub, 'net')
+        heist.heist.aimd.release(aimd_hub, 'net', 0.0, True)
+        for _ in range(4):
+            await heist.heist.aimd.acquire(aimd_hub, 'net')
+            heist.heist.aimd.release(aimd_hub, 'net', 0.002, True)
+        status = heist.heist.aimd.status(aimd_hub)['net']
+        assert status['baseline'] == heist.heist.aimd.BASELINE_MIN
+        assert status['decreases'] == 0
+        assert status['limit'] > 4
+
+    @pytest.mark.asyncio
+    async def test_multiplicative_decrease(self, aimd_hub):
+        '''
+        test failures cut the limit once per round trip
+        '''
+        await heist.heist.aimd.acquire(aimd_hub, 'net')
+        heist.heist.aimd.release(aimd_hub, 'net', 10, True)
+        for _ in range(3):
+            await heist.heist.aimd.acquire(aimd_hub, 'net')
+            heist.heist.aimd.release(aimd_hub, 'net', 10, False)
+        state = aimd_hub.heist.aimd.GROUPS['net']
+        # The burst of failures only counts once
+        assert state['decreases'] == 1
+        assert heist.heist.gate.status(aimd_hub, 'connect:net')['limit'] == 2
+
+        state['last_decrease'] = time.monotonic() - 60
+        await heist.heist.aimd.acquire(aimd_hub, 'net')
+        heist.heist.aimd.release(aimd_hub, 'net', 10, False)
+        assert heist.heist.gate.status(aimd_hub, 'connect:net')['limit'] == 1
+
+    @pytest.mark.asyncio
+    async def test_latency_decrease(self, aimd_hub):
+        '''
+        test handshakes much slower than the baseline cut the limit
+        '''
+        await heist.heist.aimd.acquire(aimd_hub, 'net')
+        heist.heist.aimd.release(aimd_hub, 'net', 0.0, True)
+        await heist.heist.aimd.acquire(aimd_hub, 'net')
+        heist.heist.aimd.release(aimd_hub, 'net', 5.0, True)
+        status = heist.heist.aimd.status(aimd_hub)['net']
+        assert status['decreases'] == 1
+        assert status['failures'] == 0
@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+'''
+    unit tests for heist.heist.cache
+'''
+# Import Local libs
+import heist.heist.cache
+
+# Import 3rd-party libs
+import pop.mods.pop.testing as testing
+import pytest
+
+
+@pytest.fixture
+def cache_hub(mock_hub: testing.MockHub, call_through, tmp_path):
+    '''
+    A mock hub with its cache under tmp_path
+    '''
+    mock_hub.OPT = {'heist': {'cache_dir': str(tmp_path / 'cache')}}
+    mock_hub.heist.cache.DB = None
+    mock_hub.heist.cache.DISABLED = False
+    call_through(mock_hub.heist.cache, heist.heist.cache, 'get')
+    yield mock_hub
+    heist.heist.cache.close(mock_hub)
+
+
+class TestCache:
+    def test_put_get(self, cache_hub):
+        '''
+        test heist.heist.cache.put merges the fields into what was cached
+        for the host before
+        '''
+        facts = {'os': 'linux', 'tools': ['at', 'tar']}
+        heist.heist.cache.put(cache_hub, 'host', 'SHA256:key', user='root', facts=facts,
+                              run_dir='/var/tmp/heist_root/abcd')
+        heist.heist.cache.put(cache_hub, 'host', 'SHA256:key', sha='abc', bin='salt', pid=42)
+
+        assert heist.heist.cache.get(cache_hub, 'host', 'SHA256:key') == {
+            'user': 'root',
+            'facts': facts,
+            'sha': 'abc',
+            'bin': 'salt',
+            'run_dir': '/var/tmp/heist_root/abcd',
+            'pid': 42}
+
+    def test_host_key(self, cache_hub):
+        '''
+        test a host that presents another host key is not known to the cache
+        '''
+        heist.heist.cache.put(cache_hub, 'host', 'SHA256:key', user='root')
+
+        assert heist.heist.cache.get(cache_hub, 'host', 'SHA256:other') is None
+        assert heist.heist.cache.get(cache_hub, 'other', 'SHA256:key') is None
+        assert heist.heist.cache.get(cache_hub, 'host', '') is None
+
+    def test_restart(self, cache_hub):
+        '''
+        test what is cached survives closing the cache, as in a restart of
+        heist, and can be dropped
+        '''
+        heist.heist.cache.put(cache_hub, 'host', 'SHA256:key', pid=42)
+        heist.heist.cache.close(cache_hub)
+
+        assert heist.heist.cache.get(cache_hub, 'host', 'SHA256:key')['pid'] == 42
+        heist.heist.cache.drop(cache_hub, 'host', 'SHA256:key')
+        assert heist.heist.cache.get(cache_hub, 'host', 'SHA256:key') is None
+
+    def test_disabled(self, cache_hub, tmp_path):
+        '''
+        test nothing is cached without a usable cache directory
+        '''
+        (tmp_path / 'file').write_text('')
+        cache_hub.OPT['heist']['cache_dir'] = str(tmp_path / 'file')
+
+        heist.heist.cache.put(cache_hub, 'host', 'SHA256:key', pid=42)
+
+        assert heist.heist.cache.get(cache_hub, 'host', 'SHA256:key') is None
+        assert cache_hub.heist.cache.DISABLED
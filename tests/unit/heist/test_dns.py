@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+'''
+    unit tests for heist.heist.dns
+'''
+# Import Python libs
+import asyncio
+import socket
+import unittest.mock as mock
+
+# Import Local libs
+import heist.heist.dns
+
+# Import 3rd-party libs
+import pop.mods.pop.testing as testing
+import pytest
+
+
+@pytest.fixture
+def dns_hub(mock_hub: testing.MockHub, call_through):
+    '''
+    A mock hub where the resolver functions call through to the real ones
+    '''
+    mock_hub.OPT = {'heist': {'dns_ttl': 300,
+                              'dns_negative_ttl': 30,
+                              'dns_concurrency': 4}}
+    mock_hub.heist.dns.CACHE = {}
+    mock_hub.heist.dns.INFLIGHT = {}
+    call_through(mock_hub.heist.dns, heist.heist.dns, 'cached', 'resolve')
+    return mock_hub
+
+
+class TestDns:
+    @pytest.mark.asyncio
+    async def test_resolve(self, dns_hub):
+        '''
+        test heist.heist.dns.resolve resolves and caches the result
+        '''
+        ret = await heist.heist.dns.resolve(dns_hub, 'localhost', socket.AF_INET)
+        assert ret == '127.0.0.1'
+        assert dns_hub.heist.dns.CACHE[('localhost', socket.AF_INET)][0] == '127.0.0.1'
+        assert not dns_hub.heist.dns.INFLIGHT
+
+    @pytest.mark.asyncio
+    async def test_resolve_single_flight(self, dns_hub):
+        '''
+        test concurrent lookups of the same host share one query and later
+        lookups are served from the cache
+        '''
+        with mock.patch.object(heist.heist.dns, '_resolve',
+                               mock.Mock(wraps=heist.heist.dns._resolve)) as _resolve:
+            rets = await asyncio.gather(*[heist.heist.dns.resolve(dns_hub, 'localhost')
+                                          for _ in range(10)])
+            await heist.heist.dns.resolve(dns_hub, 'localhost')
+        assert len(set(rets)) == 1
+        assert _resolve.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_resolve_negative(self, dns_hub):
+        '''
+        test failed lookups are cached with the negative ttl
+        '''
+        async def _fail(*args, **kwargs):
+            raise socket.gaierror
+
+        loop = asyncio.get_event_loop()
+        with mock.patch.object(loop, 'getaddrinfo', _fail):
+            assert await heist.heist.dns.resolve(dns_hub, 'missing.invalid') is None
+        assert dns_hub.heist.dns.cached('missing.invalid') == (True, None)
+
+    def test_cached_expired(self, dns_hub):
+        '''
+        test expired entries are treated as a miss and evicted
+        '''
+        dns_hub.heist.dns.CACHE[('old', socket.AF_UNSPEC)] = ('10.0.0.1', 0)
+        assert heist.heist.dns.cached(dns_hub, 'old') == (False, None)
+        assert not dns_hub.heist.dns.CACHE
+
+    def test_lookup_cached(self, dns_hub):
+        '''
+        test the synchronous lookup does not resolve cached hosts
+        '''
+        dns_hub.heist.dns.CACHE[('master', socket.AF_UNSPEC)] = ('10.0.0.1', float('inf'))
+        with mock.patch.object(socket, 'getaddrinfo') as getaddrinfo:
+            assert heist.heist.dns.lookup(dns_hub, 'master') == '10.0.0.1'
+        getaddrinfo.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_resolve_many(self, dns_hub):
+        '''
+        test heist.heist.dns.resolve_many keeps the host order
+        '''
+        hosts = ['localhost', '127.0.0.2', '::1']
+        ret = await heist.heist.dns.resolve_many(dns_hub, hosts)
+        assert list(ret) == hosts
+        assert ret['127.0.0.2'] == '127.0.0.2'
+        assert ret['::1'] == '::1'
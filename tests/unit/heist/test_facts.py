@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+'''
+    unit tests for heist.heist.facts
+'''
+# Import Python libs
+import json
+import os
+import platform
+import shutil
+import subprocess
+
+# Import Local libs
+import heist.heist.facts
+
+# Import 3rd-party libs
+import asyncssh.process
+import pop.mods.pop.testing as testing
+import pytest
+
+
+@pytest.fixture
+def facts_hub(mock_hub: testing.MockHub, call_through):
+    '''
+    A mock hub whose tunnel commands run on this host
+    '''
+    async def _cmd(name, command):
+        ret = subprocess.run(command, shell=True, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, universal_newlines=True)
+        return asyncssh.process.SSHCompletedProcess(
+            command=command, exit_status=ret.returncode, returncode=ret.returncode,
+            stdout=ret.stdout, stderr=ret.stderr)
+
+    mock_hub.heist.facts.FACTS = {}
+    mock_hub.tunnel.asyncssh.cmd.side_effect = _cmd
+    call_through(mock_hub.heist.facts, heist.heist.facts, 'parse')
+    return mock_hub
+
+
+class TestFacts:
+    def test_parse(self, mock_hub):
+        '''
+        test heist.heist.facts.parse reads every fact from the probe output
+        '''
+        output = '\n'.join(('os=Darwin',
+                            'arch=arm64',
+                            'kernel=Darwin host 20.1.0 Darwin Kernel Version 20.1.0',
+                            'tool=shasum',
+                            'tool=nohup',
+                            'free=2048',
+                            'deployment=/var/tmp/heist_root/beef',
+                            'deployment=/var/tmp/heist_root/abcd',
+                            'stray output'))
+        facts = heist.heist.facts.parse(mock_hub, output)
+        assert facts == heist.heist.facts.Facts(
+            os='darwin',
+            arch='arm64',
+            kernel='Darwin host 20.1.0 Darwin Kernel Version 20.1.0',
+            init='',
+            tools=frozenset({'shasum', 'nohup'}),
+            free=2 * 1024 * 1024,
+            deployments=('/var/tmp/heist_root/abcd', '/var/tmp/heist_root/beef'))
+
+    def test_parse_unknown(self, mock_hub):
+        '''
+        test heist.heist.facts.parse leaves the os empty when it is not
+        supported and the free space unknown when df failed
+        '''
+        facts = heist.heist.facts.parse(mock_hub, 'os=SunOS\nfree=\n')
+        assert facts.os == ''
+        assert facts.free == -1
+        assert facts.tools == frozenset()
+
+    @pytest.mark.asyncio
+    async def test_gather(self, facts_hub):
+        '''
+        test heist.heist.facts.gather learns the facts of this host with one
+        command and keeps them
+        '''
+        if platform.system() != 'Linux':
+            pytest.skip('the host is not Linux')
+        facts = await heist.heist.facts.gather(facts_hub, 't', 'asyncssh')
+        assert facts.os == 'linux'
+        assert facts.arch == platform.machine()
+        assert facts.kernel.startswith('Linux')
+        assert 'sh' not in facts.tools
+        assert ('tar' in facts.tools) == bool(shutil.which('tar'))
+        assert facts.init == ('systemd' if os.path.isdir('/run/systemd/system') else '')
+        assert facts.free >= 0
+        assert facts_hub.tunnel.asyncssh.cmd.call_count == 1
+        assert heist.heist.facts.get(facts_hub, 't') is facts
+
+
+    def test_dump_load(self, facts_hub):
+        '''
+        test facts stored with heist.heist.facts.dump are loaded back the same
+        '''
+        facts = heist.heist.facts.parse(facts_hub, 'os=Linux\ntool=tar\ntool=nohup\n'
+                                                   'deployment=/var/tmp/heist_root/abcd')
+        data = json.loads(json.dumps(heist.heist.facts.dump(facts_hub, facts)))
+
+        assert heist.heist.facts.load(facts_hub, 't', data) == facts
+        assert facts_hub.heist.facts.FACTS['t'] == facts
@@ -0,0 +1,98 @@
+#!/usr/bin/python3
+'''
+    unit tests for heist.heist.gate
+'''
+# Import Python libs
+import asyncio
+
+# Import Local libs
+import heist.heist.gate
+
+# Import 3rd-party libs
+import pop.mods.pop.testing as testing
+import pytest
+
+
+@pytest.fixture
+def gate_hub(mock_hub: testing.MockHub, call_through):
+    '''
+    A mock hub where the gate functions call through to the real ones
+    '''
+    mock_hub.heist.gate.GATES = {}
+    call_through(mock_hub.heist.gate, heist.heist.gate, 'acquire', 'release', 'set_limit', 'status')
+    return mock_hub
+
+
+async def _holder(hub, name, priority, order, release):
+    await heist.heist.gate.acquire(hub, name, priority)
+    order.append(priority)
+    await release.wait()
+    heist.heist.gate.release(hub, name)
+
+
+class TestGate:
+    @pytest.mark.asyncio
+    async def test_limit(self, gate_hub):
+        '''
+        test a gate never hands out more slots than its limit
+        '''
+        heist.heist.gate.create(gate_hub, 'deploy', 2)
+        order = []
+        release = asyncio.Event()
+        tasks = [asyncio.ensure_future(_holder(gate_hub, 'deploy', 0, order, release))
+                 for _ in range(5)]
+        await asyncio.sleep(0)
+        assert len(order) == 2
+        assert heist.heist.gate.status(gate_hub, 'deploy') == {
+            'limit': 2, 'active': 2, 'waiting': 3}
+        release.set()
+        await asyncio.gather(*tasks)
+        assert len(order) == 5
+        assert heist.heist.gate.status(gate_hub, 'deploy')['active'] == 0
+
+    @pytest.mark.asyncio
+    async def test_priority(self, gate_hub):
+        '''
+        test waiters are served by priority, then in arrival order
+        '''
+        heist.heist.gate.create(gate_hub, 'deploy', 1)
+        await heist.heist.gate.acquire(gate_hub, 'deploy')
+        order = []
+        release = asyncio.Event()
+        release.set()
+        tasks = [asyncio.ensure_future(_holder(gate_hub, 'deploy', p, order, release))
+                 for p in (0, 5, 1, 5, 10)]
+        await asyncio.sleep(0)
+        assert order == []
+        heist.heist.gate.release(gate_hub, 'deploy')
+        await asyncio.gather(*tasks)
+        assert order == [10, 5, 5, 1, 0]
+
+    @pytest.mark.asyncio
+    async def test_cancelled_waiter(self, gate_hub):
+        '''
+        test a cancelled waiter does not consume a slot
+        '''
+        heist.heist.gate.create(gate_hub, 'deploy', 1)
+        await heist.heist.gate.acquire(gate_hub, 'deploy')
+        waiter = asyncio.ensure_future(heist.heist.gate.acquire(gate_hub, 'deploy'))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        heist.heist.gate.release(gate_hub, 'deploy')
+        assert heist.heist.gate.status(gate_hub, 'deploy') == {
+            'limit': 1, 'active': 0, 'waiting': 0}
+
+    @pytest.mark.asyncio
+    async def test_set_limit(self, gate_hub):
+        '''
+        test raising the limit wakes waiting holders
+        '''
+        heist.heist.gate.create(gate_hub, 'deploy', 1)
+        await heist.heist.gate.acquire(gate_hub, 'deploy')
+        waiter = asyncio.ensure_future(heist.heist.gate.acquire(gate_hub, 'deploy'))
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        heist.heist.gate.create(gate_hub, 'deploy', 2)
+        await asyncio.wait_for(waiter, 1)
+        assert heist.heist.gate.status(gate_hub, 'deploy')['active'] == 2
@@ -15,6 +15,11 @@ import pop.mods.pop.testing as testing
 import pytest
 
 
+async def _stream(targets):
+    for target in targets:
+        yield target
+
+
 class TestSaltMaster:
     def test_start(self, mock_hub: testing.MockHub):
         heist.heist.init.start(mock_hub)
@@ -24,12 +29,20 @@ class TestSaltMaster:
     @pytest.mark.asyncio
     async def test_run(self, mock_hub: testing.MockHub):
         mock_hub.OPT = {'heist': {'roster': mock.sentinel.roster, 'manager': 'salt_master'}}
-        mock_hub.roster.init.read.return_value = {'id': {'host': 'test'}}
+        targets = [{'id': 'test', 'host': 'test'}, {'id': 'test2', 'host': 'test2'}]
+        mock_hub.roster.init.stream.return_value = _stream(targets)
+        seen = []
+
+        async def _run(remotes):
+            async for remote in remotes:
+                seen.append(remote)
+        mock_hub.heist.salt_master.run.side_effect = _run
 
         await heist.heist.init.run(mock_hub)
 
-        mock_hub.roster.init.read.assert_called_with(mock.sentinel.roster)
+        mock_hub.roster.init.stream.assert_called_with(mock.sentinel.roster)
         mock_hub.heist.salt_master.run.assert_called_once()
+        assert seen == targets
 
     @pytest.mark.asyncio
     async def test_run_roster_false(self, mock_hub: testing.MockHub):
@@ -37,33 +50,38 @@ class TestSaltMaster:
         test heist.heist.init when roster does not render correctly
         '''
         mock_hub.OPT = {'heist': {'roster': mock.sentinel.roster, 'manager': 'salt_master'}}
-        mock_hub.roster.init.read.return_value = False
+        mock_hub.roster.init.stream.return_value = _stream([])
 
-        await heist.heist.init.run(mock_hub)
+        assert await heist.heist.init.run(mock_hub) is False
 
-        mock_hub.roster.init.read.assert_called_with(mock.sentinel.roster)
+        mock_hub.roster.init.stream.assert_called_with(mock.sentinel.roster)
         mock_hub.heist.salt_master.run.assert_not_called()
 
 
     @pytest.mark.parametrize('addr',
-                             [('127.0.0.1', True),
-                              ('::1', True),
-                              ('2001:0db8:85a3:0000:0000:8a2e:0370:7334', False),
-                              ('localhost', True),
-                              ('1.1.1.1', False),
-                              ('google.com', False)])
+                             [('127.0.0.1', None, True),
+                              ('::1', None, True),
+                              ('2001:0db8:85a3:0000:0000:8a2e:0370:7334', None, False),
+                              ('localhost', '127.0.0.1', True),
+                              ('1.1.1.1', None, False),
+                              ('google.com', '172.217.0.46', False)])
     def test_ip_is_loopback(self, addr, mock_hub):
         '''
-        Test for function ip_is_loopback
-        when socket error raised, expected
-        return is False
+        Test for function ip_is_loopback, addresses are checked
+        directly and hostnames are resolved through heist.dns
         '''
+        mock_hub.heist.dns.lookup.return_value = addr[1]
         ret = heist.heist.init.ip_is_loopback(mock_hub, addr[0])
-        assert ret == addr[1]
+        assert ret == addr[2]
+        if addr[1]:
+            mock_hub.heist.dns.lookup.assert_called_once_with(addr[0])
+        else:
+            mock_hub.heist.dns.lookup.assert_not_called()
 
     def test_ip_is_loopback_exception(self, mock_hub):
         '''
         Test for function ip_is_loopback
         when address is not valid
         '''
+        mock_hub.heist.dns.lookup.return_value = None
         assert not heist.heist.init.ip_is_loopback(mock_hub, '')
@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+'''
+    unit tests for heist.heist.ready
+'''
+# Import Python libs
+import asyncio
+import unittest.mock as mock
+
+# Import Local libs
+import heist.heist.ready
+
+# Import 3rd-party libs
+import pop.mods.pop.testing as testing
+import pytest
+
+
+@pytest.fixture
+def ready_hub(mock_hub: testing.MockHub, call_through):
+    '''
+    A mock hub where the readiness functions call through to the real ones
+    '''
+    mock_hub.heist.ready.TARGETS = {}
+    mock_hub.heist.ready.TASKS = {}
+    call_through(mock_hub.heist.ready, heist.heist.ready, 'cancel', 'state')
+    return mock_hub
+
+
+class TestReady:
+    def test_advance(self, ready_hub):
+        '''
+        test heist.heist.ready.advance records the time of each transition
+        and the whole time to connected
+        '''
+        with mock.patch('time.monotonic', side_effect=[10.0, 10.5, 12.0, 15.0]):
+            heist.heist.ready.begin(ready_hub, 't')
+            for state in ('started', 'alive', 'connected'):
+                heist.heist.ready.advance(ready_hub, 't', state)
+
+        record = ready_hub.heist.ready.TARGETS['t']
+        assert record['state'] == 'connected'
+        assert record['latency'] == {'started': 0.5, 'alive': 1.5, 'connected': 3.0, 'total': 5.0}
+
+    def test_fail_retry(self, ready_hub):
+        '''
+        test a failed target is a straggler until it is started again, and a
+        retry counts as another attempt while a new start does not
+        '''
+        heist.heist.ready.begin(ready_hub, 'a')
+        heist.heist.ready.begin(ready_hub, 'b')
+        heist.heist.ready.advance(ready_hub, 'b', 'started')
+        heist.heist.ready.fail(ready_hub, 'b', 'alive')
+        # A failed target does not move on
+        heist.heist.ready.advance(ready_hub, 'b', 'alive')
+
+        assert heist.heist.ready.state(ready_hub, 'b') == 'failed'
+        assert ready_hub.heist.ready.TARGETS['b']['failed'] == 'alive'
+        assert heist.heist.ready.stragglers(ready_hub) == ['b']
+        assert heist.heist.ready.begin(ready_hub, 'b', retry=True)['attempts'] == 2
+        assert heist.heist.ready.stragglers(ready_hub) == []
+        assert heist.heist.ready.begin(ready_hub, 'b')['attempts'] == 1
+        assert heist.heist.ready.state(ready_hub, 'c') is None
+
+    def test_status(self, ready_hub):
+        '''
+        test heist.heist.ready.status counts the targets in each state and
+        summarizes the latency of each transition
+        '''
+        for num in range(10):
+            t_name = f't{num}'
+            heist.heist.ready.begin(ready_hub, t_name)
+            ready_hub.heist.ready.TARGETS[t_name].update(
+                state='connected', latency={'connected': float(num + 1)})
+        heist.heist.ready.begin(ready_hub, 'slow')
+
+        ret = heist.heist.ready.status(ready_hub)
+
+        assert ret['states'] == {'starting': 1, 'started': 0, 'alive': 0,
+                                 'connected': 10, 'failed': 0}
+        assert ret['latency'] == {'connected': {'count': 10, 'min': 1.0, 'p50': 6.0,
+                                                'p90': 10.0, 'p99': 10.0, 'max': 10.0}}
+
+    @pytest.mark.asyncio
+    async def test_track(self, ready_hub):
+        '''
+        test tracking a target again replaces the task tracking it before
+        and stop cancels what is left
+        '''
+        first = asyncio.Event()
+
+        heist.heist.ready.track(ready_hub, 't', first.wait)
+        old = ready_hub.heist.ready.TASKS['t']
+        heist.heist.ready.track(ready_hub, 't', asyncio.sleep, 0)
+        new = ready_hub.heist.ready.TASKS['t']
+        await asyncio.sleep(0)
+        assert old.cancelled()
+        await new
+        await asyncio.sleep(0)
+        assert ready_hub.heist.ready.TASKS == {}
+
+        heist.heist.ready.track(ready_hub, 't', first.wait)
+        task = ready_hub.heist.ready.TASKS['t']
+        await heist.heist.ready.stop(ready_hub)
+        assert task.cancelled()
+
+    @pytest.mark.asyncio
+    async def test_wait(self, ready_hub):
+        '''
+        test heist.heist.ready.wait follows a target through a retry until
+        it ends up connected
+        '''
+        async def _retry():
+            heist.heist.ready.fail(ready_hub, 't', 'alive')
+            heist.heist.ready.begin(ready_hub, 't', retry=True)
+            heist.heist.ready.track(ready_hub, 't', _connect)
+
+        async def _connect():
+            await asyncio.sleep(0.01)
+            heist.heist.ready.advance(ready_hub, 't', 'connected')
+
+        heist.heist.ready.begin(ready_hub, 't')
+        heist.heist.ready.track(ready_hub, 't', _retry)
+
+        assert await asyncio.wait_for(heist.heist.ready.wait(ready_hub, 't'), 1) == 'connected'
+        assert ready_hub.heist.ready.TARGETS['t']['attempts'] == 2
+        assert await heist.heist.ready.wait(ready_hub, 'other') is None
@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+'''
+    unit tests for heist.heist.rollout
+'''
+# Import Python libs
+import asyncio
+
+# Import Local libs
+import heist.heist.gate
+import heist.heist.rollout
+
+# Import 3rd-party libs
+import pop.mods.pop.testing as testing
+import pytest
+
+
+@pytest.fixture
+def rollout_hub(mock_hub: testing.MockHub, call_through, tmp_path):
+    '''
+    A mock hub with ten deployed targets, a new artifact to roll out and
+    real admission gates
+    '''
+    mock_hub.OPT = {'heist': {'rollout_canary': 2,
+                              'rollout_wave_size': 3,
+                              'rollout_max_in_flight': 2,
+                              'rollout_bandwidth': 0,
+                              'rollout_failure_threshold': 0.4}}
+    heist.heist.rollout.__init__(mock_hub)
+    mock_hub.heist.gate.GATES = {}
+    call_through(mock_hub.heist.gate, heist.heist.gate, 'create', 'acquire', 'release')
+    mock_hub.heist.ready.wait.return_value = 'connected'
+    path = tmp_path / 'salt-2019.2.2'
+    path.write_bytes(b'salt' * 256)
+    mock_hub.heist.CONS = {f't{i}': {'art_dir': str(tmp_path),
+                                     'bin': str(tmp_path / 'salt-2019.2.1'),
+                                     't_type': 'asyncssh',
+                                     'tgt': 'tgt',
+                                     'run_dir': 'run'}
+                           for i in range(10)}
+    mock_hub.heist.CONS['other'] = {'art_dir': 'elsewhere', 'bin': 'old'}
+    mock_hub.rollout_path = str(path)
+    return mock_hub
+
+
+class TestRollout:
+    def test_waves(self, rollout_hub):
+        '''
+        test the canary set comes first and the rest are split into waves
+        '''
+        targets = [f't{i}' for i in range(10)]
+        assert heist.heist.rollout._waves(rollout_hub, targets) == [
+            ['t0', 't1'], ['t2', 't3', 't4'], ['t5', 't6', 't7'], ['t8', 't9']]
+        rollout_hub.OPT['heist']['rollout_canary'] = 0
+        assert heist.heist.rollout._waves(rollout_hub, targets[:4]) == [
+            ['t0', 't1', 't2'], ['t3']]
+
+    @pytest.mark.asyncio
+    async def test_start(self, rollout_hub):
+        '''
+        test every target of the artifacts directory is upgraded wave by
+        wave without going over the maximum in flight
+        '''
+        path = rollout_hub.rollout_path
+        active = []
+        peak = []
+        order = []
+
+        async def _update(t_name, *args):
+            active.append(t_name)
+            peak.append(len(active))
+            order.append(t_name)
+            await asyncio.sleep(0.01)
+            active.remove(t_name)
+        rollout_hub.heist.salt_master.update.side_effect = _update
+
+        state = heist.heist.rollout.start(rollout_hub, rollout_hub.heist.CONS['t0']['art_dir'], path)
+        # A rollout that is running is not started twice
+        assert heist.heist.rollout.start(rollout_hub, 'ignored', path) is state
+        await asyncio.wait_for(state['task'], 2)
+
+        assert state['status'] == 'done'
+        assert sorted(order) == sorted(f't{i}' for i in range(10))
+        assert set(order[:2]) == {'t0', 't1'}
+        assert max(peak) == 2
+        assert rollout_hub.heist.CONS['other']['bin'] == 'old'
+        assert all(rollout_hub.heist.CONS[f't{i}']['bin'] == path for i in range(10))
+        status = heist.heist.rollout.status(rollout_hub)[path]
+        assert status['upgraded'] == 10
+        assert [w['kind'] for w in status['waves']] == ['canary', 'wave', 'wave', 'wave']
+
+    @pytest.mark.parametrize('bad,status,upgraded',
+                             [({'t0', 't1'}, 'halted', 0),
+                              ({'t3', 't4'}, 'halted', 3),
+                              ({'t3'}, 'done', 9)])
+    @pytest.mark.asyncio
+    async def test_failure_threshold(self, rollout_hub, bad, status, upgraded):
+        '''
+        test the rollout halts when the failures of a wave cross the
+        threshold and carries on below it
+        '''
+        path = rollout_hub.rollout_path
+
+        async def _update(t_name, *args):
+            if t_name in bad:
+                raise ConnectionResetError(t_name)
+        rollout_hub.heist.salt_master.update.side_effect = _update
+
+        state = heist.heist.rollout.start(rollout_hub, rollout_hub.heist.CONS['t0']['art_dir'], path)
+        await asyncio.wait_for(state['task'], 2)
+
+        assert state['status'] == status
+        assert len(state['upgraded']) == upgraded
+        assert set(state['failed']) == bad
+        for t_name in bad:
+            assert rollout_hub.heist.CONS[t_name]['bin'] != path
+        # A halted rollout is not started again for the same artifact
+        if status == 'halted':
+            art_dir = rollout_hub.heist.CONS['t0']['art_dir']
+            assert heist.heist.rollout.start(rollout_hub, art_dir, path) is state
+
+    @pytest.mark.asyncio
+    async def test_not_connected(self, rollout_hub):
+        '''
+        test a target whose upgraded minion never connects counts as a
+        failed upgrade
+        '''
+        path = rollout_hub.rollout_path
+
+        async def _wait(t_name):
+            return 'failed' if t_name == 't1' else 'connected'
+        rollout_hub.heist.ready.wait.side_effect = _wait
+
+        state = heist.heist.rollout.start(rollout_hub, rollout_hub.heist.CONS['t0']['art_dir'], path)
+        await asyncio.wait_for(state['task'], 2)
+
+        assert state['status'] == 'halted'
+        assert state['upgraded'] == ['t0']
+        assert state['failed'] == ['t1']
+        assert rollout_hub.heist.CONS['t1']['bin'] != path
+        assert heist.heist.gate.status(rollout_hub, 'rollout')['active'] == 0
+
+    @pytest.mark.asyncio
+    async def test_bandwidth(self, rollout_hub):
+        '''
+        test uploads are spread out to stay within the bandwidth budget
+        '''
+        rollout_hub.OPT['heist']['rollout_bandwidth'] = 1024 * 20
+        rollout_hub.OPT['heist']['rollout_max_in_flight'] = 10
+        loop = asyncio.get_event_loop()
+        started = []
+
+        async def _update(*args):
+            started.append(loop.time())
+        rollout_hub.heist.salt_master.update.side_effect = _update
+
+        state = heist.heist.rollout.start(rollout_hub, rollout_hub.heist.CONS['t0']['art_dir'],
+                                          rollout_hub.rollout_path)
+        await asyncio.wait_for(state['task'], 2)
+
+        # Each upload is 1 KiB, at 20 KiB/s ten of them take about 0.45 seconds
+        assert started[-1] - started[0] >= 0.4
+
+    @pytest.mark.asyncio
+    async def test_stop(self, rollout_hub):
+        '''
+        test stopping cancels a running rollout
+        '''
+        async def _update(*args):
+            await asyncio.sleep(10)
+        rollout_hub.heist.salt_master.update.side_effect = _update
+
+        state = heist.heist.rollout.start(rollout_hub, rollout_hub.heist.CONS['t0']['art_dir'],
+                                          rollout_hub.rollout_path)
+        await asyncio.sleep(0.01)
+        await heist.heist.rollout.stop(rollout_hub)
+
+        assert state['status'] == 'cancelled'
+        assert heist.heist.gate.status(rollout_hub, 'rollout')['active'] == 0
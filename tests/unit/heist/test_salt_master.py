@@ -4,12 +4,19 @@
 '''
 # Import Python libs
 import asyncio
+import hashlib
 import os
 import secrets
+import shutil
+import subprocess
+import time
 from typing import Any, Dict, Tuple
 import unittest.mock as mock
 
 # Import Local libs
+import heist.heist.facts
+import heist.heist.gate
+import heist.heist.ready
 import heist.heist.salt_master
 
 # Import 3rd-party libs
@@ -18,6 +25,18 @@ import pop.mods.pop.testing as testing
 import pytest
 
 
+def mk_facts(**kwargs) -> heist.heist.facts.Facts:
+    facts = {'os': 'linux',
+             'arch': 'x86_64',
+             'kernel': 'Linux test-name 5.0',
+             'init': '',
+             'tools': frozenset(),
+             'free': -1,
+             'deployments': ()}
+    facts.update(kwargs)
+    return heist.heist.facts.Facts(**facts)
+
+
 @pytest.fixture
 def mk_config_data(mock_hub, roster):
     # Setup
@@ -32,6 +51,65 @@ def mk_config_data(mock_hub, roster):
         os.remove(minion_config)
 
 
+def mk_minion_config(root_dir):
+    '''
+    Return the minion config the local_tunnel fixture renders for root_dir
+    '''
+    return f'master: 127.0.0.1\nroot_dir: {root_dir}\n'
+
+
+@pytest.fixture
+def local_tunnel(mock_hub: testing.MockHub, tmp_path):
+    '''
+    Run the tunnel commands and transfers of the mock hub on this host, with
+    the remote root of heist under tmp_path
+    '''
+    async def _cmd(name, command):
+        ret = subprocess.run(command, shell=True, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, universal_newlines=True)
+        return asyncssh.process.SSHCompletedProcess(
+            command=command, exit_status=ret.returncode, returncode=ret.returncode,
+            stdout=ret.stdout, stderr=ret.stderr)
+
+    async def _send(name, source, dest):
+        shutil.copy(source, dest)
+
+    async def _send_many(name, dest, files):
+        for path, spec in files.items():
+            path = os.path.join(dest, path)
+            os.makedirs(path if spec is None else os.path.dirname(path), exist_ok=True)
+            if isinstance(spec, dict):
+                if os.path.lexists(path):
+                    os.remove(path)
+                os.symlink(spec['symlink'], path)
+            elif spec is not None:
+                shutil.copy(spec, path)
+
+    mock_hub.tunnel.asyncssh.cmd.side_effect = _cmd
+    mock_hub.tunnel.asyncssh.send.side_effect = _send
+    mock_hub.tunnel.asyncssh.send_many.side_effect = _send_many
+    mock_hub.heist.salt_master.DIGESTS = {}
+    mock_hub.heist.ROSTERS = {'t': {}}
+    mock_hub.heist.facts.get.return_value = None
+
+    def _mk_config(root_dir, t_name):
+        config = tmp_path / 'minion'
+        config.write_text(mk_minion_config(root_dir))
+        return str(config)
+    mock_hub.heist.salt_master.mk_config.side_effect = _mk_config
+    artifact = tmp_path / 'salt-2019.2.1'
+    artifact.write_bytes(b'salt' * 1024)
+    return str(artifact), str(tmp_path / 'heist_root')
+
+
+def run_opts(**kwargs):
+    opts = {'max_in_flight': 10, 'dynamic_upgrade': False}
+    for stage in heist.heist.salt_master.STAGES:
+        opts[f'{stage}_limit'] = 2
+    opts.update(kwargs)
+    return {'heist': opts}
+
+
 @pytest.fixture
 def remote() -> Dict[str, Any]:
     return {
@@ -44,9 +122,61 @@ def remote() -> Dict[str, Any]:
 class TestSaltMaster:
     @pytest.mark.asyncio
     async def test_run(self, mock_hub: testing.MockHub, remote: Dict[str, Dict[str, str]]):
+        mock_hub.OPT = run_opts()
         await heist.heist.salt_master.run(mock_hub, [remote])
+        mock_hub.heist.gate.create.assert_any_call('deploy', 10)
+        for stage in heist.heist.salt_master.STAGES:
+            mock_hub.heist.gate.create.assert_any_call(f'stage:{stage}', 2)
         mock_hub.heist.salt_master.single.assert_called_with(remote)
 
+    @pytest.mark.asyncio
+    async def test_run_failure(self, mock_hub: testing.MockHub, remote: Dict[str, Dict[str, str]]):
+        '''
+        test a failing target does not stop the other targets
+        '''
+        mock_hub.OPT = run_opts()
+        done = []
+
+        async def _single(remote):
+            if remote['id'] == 'bad':
+                raise ConnectionResetError
+            await asyncio.sleep(0)
+            done.append(remote['id'])
+        mock_hub.heist.salt_master.single.side_effect = _single
+
+        await heist.heist.salt_master.run(mock_hub, [dict(remote, id='bad'), remote])
+        assert done == ['localhost']
+
+    @pytest.mark.asyncio
+    async def test_run_stream(self, mock_hub: testing.MockHub, remote: Dict[str, Dict[str, str]]):
+        '''
+        test heist.salt_master.run starts each streamed remote as it arrives
+        '''
+        mock_hub.OPT = run_opts()
+        started = asyncio.Event()
+
+        async def _single(remote):
+            started.set()
+        mock_hub.heist.salt_master.single.side_effect = _single
+
+        async def _remotes():
+            yield remote
+            # The first remote is started before the stream is exhausted
+            await asyncio.wait_for(started.wait(), 1)
+            yield dict(remote, id='second')
+
+        await heist.heist.salt_master.run(mock_hub, _remotes())
+        assert mock_hub.heist.salt_master.single.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_run_dynamic_upgrade(self, mock_hub: testing.MockHub, remote: Dict[str, Dict[str, str]]):
+        '''
+        test heist.salt_master.run starts one artifacts watcher for all targets
+        '''
+        mock_hub.OPT = run_opts(dynamic_upgrade=True, artifacts_dir='/tmp/artifacts')
+
+        await heist.heist.salt_master.run(mock_hub, [remote, dict(remote, id='second')])
+        mock_hub.heist.watch.start.assert_called_once_with('/tmp/artifacts')
 
     @pytest.mark.parametrize('roster',
                              [{'publish_port': '4505'},
@@ -121,7 +251,8 @@ class TestSaltMaster:
         mock_hub.heist.CONS = {}
         minion_config, _, _ = mk_config_data
         mock_hub.heist.salt_master.mk_config.return_value = minion_config
-        mock_hub.heist.salt_master.detect_os.return_value = 'linux'
+        mock_hub.heist.facts.gather.return_value = mk_facts()
+        mock_hub.heist.facts.get.return_value = mk_facts()
         mock_hub.artifact.salt.get_version.return_value = ('2019.2.1', {})
         patch_asyncio = mock.Mock(asyncio.sleep)
         patch_asyncio.side_effect = [InterruptedError]
@@ -154,126 +285,590 @@ class TestSaltMaster:
             mock_hub.tunnel.asyncssh.tunnel.assert_any_call(t_name, *tunnel)
 
     @pytest.mark.asyncio
-    async def test_detect_os(self,
-                             mock_hub):
+    async def test_single_connect_failed(self,
+                                         mock_hub: testing.MockHub,
+                                         remote: Dict[str, Dict[str, str]]):
         '''
-        test heist.heist.salt_master.detect_os
-        when returncode is 0 and os is linux
+        test heist.salt_master.single gives its deployment slot back when
+        the connection fails
         '''
-        cmd_ret = asyncssh.process.SSHCompletedProcess(
-            command={'uname -a'},
-            exit_status=0,
-            returncode=0,
-            stdout='Linux test-name 5.0',
-            stderr='')
+        mock_hub.heist.ROSTERS = {}
+        remote['priority'] = 5
+        mock_hub.tunnel.asyncssh.create.return_value = False
 
-        # Setup
-        t_name = secrets.token_hex()
-        mock_hub.tunnel.asyncssh.cmd.return_value = cmd_ret
-        ret = await heist.heist.salt_master.detect_os(mock_hub, t_name, 'asyncssh')
-        assert ret == 'linux'
+        await heist.heist.salt_master.single(mock_hub, remote)
+
+        assert mock_hub.heist.gate.acquire.call_args_list == [
+            mock.call('deploy', 5), mock.call('stage:connect', 5)]
+        assert mock_hub.heist.gate.release.call_args_list == [
+            mock.call('stage:connect'), mock.call('deploy')]
+        mock_hub.heist.aimd.release.assert_called_once()
+        assert mock_hub.heist.aimd.release.call_args[0][2] is False
+        mock_hub.heist.facts.gather.assert_not_called()
 
     @pytest.mark.asyncio
-    async def test_detect_os_bad_return(self,
-                                        mock_hub: testing.MockHub):
+    async def test_single_stages(self,
+                                 mock_hub: testing.MockHub,
+                                 call_through,
+                                 remote: Dict[str, Dict[str, str]]):
         '''
-        test heist.heist.salt_master.detect_os
-        when returncode is not 0 and os is linux
+        test a stage with a limit of 1 lets one target through at a time and
+        a target held up in the transfer stage does not keep another target
+        from connecting
         '''
-        cmd_ret = asyncssh.process.SSHCompletedProcess(
-            command={'uname -a'},
-            exit_status=0,
-            returncode=127,
-            stdout='',
-            stderr='zsh:1: command not found: name\n')
+        mock_hub.OPT = run_opts(artifacts_dir='art', checkin_time=60,
+                                dynamic_upgrade=False)
+        mock_hub.heist.ROSTERS = {}
+        mock_hub.heist.CONS = {}
+        mock_hub.heist.gate.GATES = {}
+        call_through(mock_hub.heist.gate, heist.heist.gate, 'create', 'acquire', 'release')
+        heist.heist.gate.create(mock_hub, 'deploy', 10)
+        for stage in heist.heist.salt_master.STAGES:
+            heist.heist.gate.create(mock_hub, f'stage:{stage}', 1)
+        mock_hub.heist.facts.gather.return_value = mk_facts()
+        mock_hub.heist.facts.get.return_value = mk_facts()
+        mock_hub.artifact.salt.get_version.return_value = '2019.2.1'
+        uploads = []
+        upload_done = asyncio.Event()
+
+        async def _deploy(*args):
+            uploads.append(heist.heist.gate.status(mock_hub, 'stage:transfer'))
+            await upload_done.wait()
+            return 'tgt'
+        mock_hub.heist.salt_master.deploy.side_effect = _deploy
+        started = []
+
+        async def _start_minion(hub, t_type, t_name, *args):
+            started.append(t_name)
+
+        async def _settle():
+            for _ in range(20):
+                await asyncio.sleep(0)
+
+        with mock.patch.object(heist.heist.salt_master, '_start_minion', _start_minion):
+            first = asyncio.ensure_future(heist.heist.salt_master.single(mock_hub, remote))
+            await _settle()
+            second = asyncio.ensure_future(
+                heist.heist.salt_master.single(mock_hub, dict(remote, host='127.0.0.2')))
+            await _settle()
+            # The second target connected and waits for the transfer stage
+            # the first one holds
+            assert mock_hub.tunnel.asyncssh.create.call_count == 2
+            assert len(uploads) == 1
+            assert heist.heist.gate.status(mock_hub, 'stage:transfer') == {
+                'limit': 1, 'active': 1, 'waiting': 1}
+            upload_done.set()
+            await _settle()
+            assert len(uploads) == 2
+            assert all(status['active'] == 1 for status in uploads)
+            assert len(started) == 2
+            assert heist.heist.gate.status(mock_hub, 'stage:transfer')['active'] == 0
+            first.cancel()
+            second.cancel()
+            await asyncio.gather(first, second, return_exceptions=True)
+        assert heist.heist.gate.status(mock_hub, 'deploy')['active'] == 0
+
+    @pytest.mark.parametrize('dynamic_upgrade', [True, False])
+    @pytest.mark.asyncio
+    async def test_single_checkin(self,
+                                  mock_hub: testing.MockHub,
+                                  remote: Dict[str, Dict[str, str]],
+                                  dynamic_upgrade):
+        '''
+        test heist.salt_master.single hands the target's check-ins to the
+        scheduler and returns once the minion is started
+        '''
+        mock_hub.OPT = {'heist': {'dynamic_upgrade': dynamic_upgrade, 'checkin_time': 60}}
+        mock_hub.heist.ROSTERS = {}
+        mock_hub.heist.salt_master.FOLLOWERS = {}
+        stages = {'connect': True,
+                  'detect': ('linux', '2019.2.1'),
+                  'transfer': ('art/linux', 'art/linux/salt-2019.2.1', 'tgt'),
+                  'start': None}
+
+        async def _stage(hub, stage, *args):
+            return stages[stage]
 
-        # Setup
         t_name = secrets.token_hex()
-        mock_hub.tunnel.asyncssh.cmd.return_value = cmd_ret
-        ret = await heist.heist.salt_master.detect_os(mock_hub, t_name,
-                                                      'asyncssh')
-        assert not ret
+        with mock.patch.object(secrets, 'token_hex', lambda: t_name):
+            with mock.patch.object(heist.heist.salt_master, '_stage', _stage):
+                await asyncio.wait_for(heist.heist.salt_master.single(mock_hub, remote), 1)
+
+        mock_hub.heist.schedule.add.assert_called_once_with(
+            t_name, 60, mock_hub.heist.salt_master.checkin, t_name)
+        followers = mock_hub.heist.salt_master.FOLLOWERS
+        assert list(followers) == (['linux'] if dynamic_upgrade else [])
+        for follower in followers.values():
+            follower.cancel()
+        await asyncio.gather(*followers.values(), return_exceptions=True)
+
+    @pytest.mark.parametrize('latest,update',
+                             [('art/linux/salt-2019.2.2', True),
+                              ('art/linux/salt-2019.2.1', False),
+                              (False, False)])
+    @pytest.mark.asyncio
+    async def test_checkin(self, mock_hub: testing.MockHub, latest, update):
+        '''
+        test heist.salt_master.checkin upgrades the minion only when a newer
+        artifact is available
+        '''
+        mock_hub.OPT = {'heist': {'dynamic_upgrade': True, 'rolling_upgrade': False}}
+        mock_hub.heist.CONS = {'t': {'t_type': 'asyncssh',
+                                     'art_dir': 'art/linux',
+                                     'bin': 'art/linux/salt-2019.2.1',
+                                     'tgt': 'tgt',
+                                     'run_dir': 'run'}}
+        mock_hub.heist.salt_master.latest.return_value = latest
+
+        await heist.heist.salt_master.checkin(mock_hub, 't')
+
+        mock_hub.heist.salt_master.latest.assert_called_once_with('salt', 'art/linux')
+        if update:
+            mock_hub.heist.salt_master.update.assert_called_once_with(
+                't', 'asyncssh', latest, 'tgt', 'run')
+            assert mock_hub.heist.CONS['t']['bin'] == latest
+        else:
+            mock_hub.heist.salt_master.update.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_checkin_rolling_upgrade(self, mock_hub: testing.MockHub):
+        '''
+        test heist.salt_master.checkin leaves a newer artifact to the rollout
+        when rolling upgrades are enabled
+        '''
+        mock_hub.OPT = {'heist': {'dynamic_upgrade': True, 'rolling_upgrade': True}}
+        mock_hub.heist.CONS = {'t': {'art_dir': 'art/linux',
+                                     'bin': 'art/linux/salt-2019.2.1',
+                                     'pid': 1234}}
+        mock_hub.heist.salt_master.latest.return_value = 'art/linux/salt-2019.2.2'
+
+        await heist.heist.salt_master.checkin(mock_hub, 't')
+
+        mock_hub.heist.rollout.start.assert_called_once_with('art/linux', 'art/linux/salt-2019.2.2')
+        mock_hub.heist.salt_master.update.assert_not_called()
+        assert mock_hub.heist.CONS['t']['bin'] == 'art/linux/salt-2019.2.1'
+
+    @pytest.mark.asyncio
+    async def test_checkin_no_dynamic_upgrade(self, mock_hub: testing.MockHub):
+        '''
+        test heist.salt_master.checkin does not look for artifacts when
+        dynamic upgrades are disabled
+        '''
+        mock_hub.OPT = {'heist': {'dynamic_upgrade': False}}
+
+        await heist.heist.salt_master.checkin(mock_hub, 't')
+
+        mock_hub.heist.salt_master.latest.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_follow(self, mock_hub: testing.MockHub):
+        '''
+        test a new salt artifact wakes the check-ins of the targets running
+        that os
+        '''
+        mock_hub.heist.salt_master.FOLLOWERS = {}
+        mock_hub.heist.CONS = {'a': {'t_os': 'linux'},
+                               'b': {'t_os': 'darwin'},
+                               'c': {'t_os': 'linux'}}
+        updates = asyncio.Queue()
+        mock_hub.heist.watch.subscribe.return_value = updates
+
+        heist.heist.salt_master._follow(mock_hub, 'linux')
+        heist.heist.salt_master._follow(mock_hub, 'linux')
+        updates.put_nowait(('other', 'art/linux/other-1'))
+        updates.put_nowait(('salt', 'art/linux/salt-2019.2.2'))
+        for _ in range(5):
+            await asyncio.sleep(0)
+
+        mock_hub.heist.watch.subscribe.assert_called_once_with('linux')
+        assert mock_hub.heist.schedule.wake.call_args_list == [mock.call('a'), mock.call('c')]
+        follower = mock_hub.heist.salt_master.FOLLOWERS['linux']
+        follower.cancel()
+        await asyncio.gather(follower, return_exceptions=True)
+        mock_hub.heist.watch.unsubscribe.assert_called_once_with('linux', updates)
+
+    @pytest.mark.asyncio
+    async def test_deploy_store(self, mock_hub: testing.MockHub, local_tunnel):
+        '''
+        test heist.salt_master.deploy uploads the binary into the store of the
+        target once and links it into every run_dir after that
+        '''
+        bin_, root = local_tunnel
+        sha = heist.heist.salt_master._hash(bin_)
+        stored = os.path.join(root, 'store', sha)
+
+        for run in ('aaaa', 'bbbb'):
+            run_dir = os.path.join(root, run)
+            tgt = await heist.heist.salt_master.deploy(mock_hub, 't', 'asyncssh', bin_, run_dir)
+            assert tgt == os.path.join(run_dir, 'salt-2019.2.1')
+            assert os.path.samefile(tgt, stored)
+            assert os.access(tgt, os.X_OK)
+
+        # The binary was sent once, everything else in one archive per deploy
+        assert mock_hub.tunnel.asyncssh.send.call_count == 1
+        assert mock_hub.tunnel.asyncssh.send_many.call_count == 2
+        assert os.path.isfile(os.path.join(root, 'bbbb', 'conf', 'minion'))
+        assert os.path.isdir(os.path.join(root, 'bbbb', 'root'))
+        assert os.listdir(os.path.join(root, 'store')) == [sha]
+
+    @pytest.mark.asyncio
+    async def test_deploy_no_tar(self, mock_hub: testing.MockHub, local_tunnel):
+        '''
+        test heist.salt_master.deploy sends the files one at a time to a
+        target without tar
+        '''
+        bin_, root = local_tunnel
+        mock_hub.heist.facts.get.return_value = mk_facts(tools=frozenset({'sha256sum'}))
+        run_dir = os.path.join(root, 'aaaa')
+
+        tgt = await heist.heist.salt_master.deploy(mock_hub, 't', 'asyncssh', bin_, run_dir)
+
+        mock_hub.tunnel.asyncssh.send_many.assert_not_called()
+        assert os.path.samefile(tgt, os.path.join(root, 'store', heist.heist.salt_master._hash(bin_)))
+        with open(os.path.join(run_dir, 'conf', 'minion')) as fp:
+            assert fp.read() == mk_minion_config(os.path.join(run_dir, 'root'))
+        assert os.path.isdir(os.path.join(run_dir, 'root'))
+
+    @pytest.mark.asyncio
+    async def test_deploy_send_many_failed(self, mock_hub: testing.MockHub, local_tunnel):
+        '''
+        test heist.salt_master.deploy fails when the deployment files could
+        not be sent instead of carrying on without them
+        '''
+        bin_, root = local_tunnel
+        mock_hub.tunnel.asyncssh.send_many.side_effect = OSError('tar: not found')
+
+        with pytest.raises(OSError):
+            await heist.heist.salt_master.deploy(mock_hub, 't', 'asyncssh', bin_,
+                                                 os.path.join(root, 'aaaa'))
+
+        mock_hub.tunnel.asyncssh.send.assert_not_called()
+        assert not os.path.exists(os.path.join(os.path.dirname(bin_), 'minion'))
+
+    @pytest.mark.asyncio
+    async def test_deploy_store_mismatch(self, mock_hub: testing.MockHub, local_tunnel):
+        '''
+        test heist.salt_master.deploy replaces a stored binary whose contents
+        do not match its name
+        '''
+        bin_, root = local_tunnel
+        sha = heist.heist.salt_master._hash(bin_)
+        os.makedirs(os.path.join(root, 'store'))
+        with open(os.path.join(root, 'store', sha), 'w') as fp:
+            fp.write('truncated')
+
+        tgt = await heist.heist.salt_master.deploy(mock_hub, 't', 'asyncssh', bin_,
+                                                   os.path.join(root, 'aaaa'))
+
+        assert heist.heist.salt_master._hash(tgt) == sha
+        sent = [c[0][1] for c in mock_hub.tunnel.asyncssh.send.call_args_list]
+        assert sent.count(bin_) == 1
+
+    @pytest.mark.asyncio
+    async def test_remote_digest_facts(self, mock_hub: testing.MockHub):
+        '''
+        test heist.salt_master._remote_digest only runs the hashing tool the
+        target has
+        '''
+        mock_hub.heist.facts.get.return_value = mk_facts(tools=frozenset({'shasum'}))
+        mock_hub.tunnel.asyncssh.cmd.return_value = asyncssh.process.SSHCompletedProcess(
+            command='shasum', exit_status=0, returncode=0, stdout='abc  /path\n', stderr='')
+
+        ret = await heist.heist.salt_master._remote_digest(mock_hub, 't', 'asyncssh', '/path')
+
+        assert ret == 'abc'
+        mock_hub.tunnel.asyncssh.cmd.assert_called_once_with('t', 'shasum -a 256 /path')
+
+    @pytest.mark.asyncio
+    async def test_update_delta(self, mock_hub: testing.MockHub, local_tunnel):
+        '''
+        test heist.salt_master.update sends the new binary as a delta
+        against the stored binary it replaces
+        '''
+        old, root = local_tunnel
+        run_dir = os.path.join(root, 'aaaa')
+        mock_hub.heist.CONS = {'t': {'bin': old}}
+
+        async def _start_minion(*args):
+            pass
+
+        with mock.patch.object(heist.heist.salt_master, '_start_minion', _start_minion):
+            await heist.heist.salt_master.update(mock_hub, 't', 'asyncssh', old + '.new',
+                                                 'tgt', run_dir)
+
+        basis = os.path.join(root, 'store', heist.heist.salt_master._hash(old))
+        mock_hub.heist.salt_master.deploy.assert_called_once_with(
+            't', 'asyncssh', old + '.new', run_dir, basis=basis)
+
+    @pytest.mark.parametrize('alive', [True, False])
+    @pytest.mark.asyncio
+    async def test_single_cached(self,
+                                 mock_hub: testing.MockHub,
+                                 remote: Dict[str, Dict[str, str]],
+                                 tmp_path,
+                                 alive):
+        '''
+        test heist.salt_master.single takes the facts of a known host from the
+        cache and reattaches to its minion if that still runs, otherwise it
+        deploys into the same run_dir again
+        '''
+        mock_hub.OPT = run_opts(artifacts_dir='art', checkin_time=60)
+        mock_hub.heist.ROSTERS = {}
+        mock_hub.heist.CONS = {}
+        mock_hub.heist.salt_master.DIGESTS = {}
+        bin_ = tmp_path / 'salt-2019.2.1'
+        bin_.write_bytes(b'salt')
+        run_dir = '/var/tmp/heist_root/abcd'
+        mock_hub.heist.salt_master.latest.return_value = str(bin_)
+        mock_hub.heist.salt_master.deploy.return_value = 'tgt'
+        mock_hub.artifact.salt.get_version.return_value = '2019.2.1'
+        mock_hub.tunnel.asyncssh.fingerprint.return_value = 'SHA256:key'
+        mock_hub.heist.facts.load.return_value = mk_facts()
+        mock_hub.heist.facts.get.return_value = mk_facts()
+        mock_hub.heist.facts.dump.return_value = {'os': 'linux'}
+        sha = heist.heist.salt_master._hash(str(bin_))
+        config = tmp_path / 'minion'
+
+        def _mk_config(root_dir, t_name):
+            config.write_text(mk_minion_config(root_dir))
+            return str(config)
+        mock_hub.heist.salt_master.mk_config.side_effect = _mk_config
+        conf_sha = hashlib.sha256(
+            mk_minion_config(f'{run_dir}/root').encode()).hexdigest()
+        mock_hub.heist.cache.get.return_value = {
+            'user': 'root',
+            'facts': {'os': 'linux'},
+            'sha': sha,
+            'bin': str(bin_),
+            'run_dir': run_dir,
+            'pid': 4321}
+        stdout = (f'{run_dir} 4321 {sha}  {run_dir}/salt-2019.2.1 '
+                  f'{conf_sha}  {run_dir}/conf/minion\n' if alive else '')
+        mock_hub.tunnel.asyncssh.cmd.return_value = asyncssh.process.SSHCompletedProcess(
+            command='sh', exit_status=0, returncode=0, stdout=stdout, stderr='')
+
+        started = []
+
+        async def _start_minion(*args):
+            started.append(args)
+
+        with mock.patch.object(heist.heist.salt_master, '_start_minion', _start_minion):
+            await heist.heist.salt_master.single(mock_hub, remote)
+
+        mock_hub.heist.cache.get.assert_called_once_with('127.0.0.1', 'SHA256:key')
+        mock_hub.heist.facts.load.assert_called_once_with(mock.ANY, {'os': 'linux'})
+        mock_hub.heist.facts.gather.assert_not_called()
+        con = list(mock_hub.heist.CONS.values())[0]
+        assert con['run_dir'] == run_dir
+        mock_hub.tunnel.asyncssh.tunnel.assert_any_call(mock.ANY, 44505, 4505)
+        if alive:
+            assert con['pid'] == 4321
+            mock_hub.heist.salt_master.deploy.assert_not_called()
+            assert not started
+            mock_hub.heist.cache.put.assert_called_once_with(
+                '127.0.0.1', 'SHA256:key', user='root', facts={'os': 'linux'}, run_dir=run_dir)
+        else:
+            assert con['pid'] is None
+            mock_hub.heist.salt_master.deploy.assert_called_once_with(
+                mock.ANY, 'asyncssh', str(bin_), run_dir)
+            assert len(started) == 1
+            mock_hub.heist.cache.put.assert_called_once_with(
+                '127.0.0.1', 'SHA256:key', user='root', facts={'os': 'linux'}, run_dir=run_dir,
+                sha=None, bin=None, pid=None)
+
+    @pytest.mark.asyncio
+    async def test_find_running(self, mock_hub: testing.MockHub, local_tunnel):
+        '''
+        test heist.salt_master._find_running finds the run_dir whose minion
+        is alive and runs the same binary with the same config, with one
+        command
+        '''
+        bin_, root = local_tunnel
+        other = os.path.join(root, 'salt-2019.2.0')
+        os.makedirs(root)
+        with open(other, 'w') as fp:
+            fp.write('older salt')
+        dead = subprocess.Popen(['true'])
+        dead.wait()
+        run_dirs = {'aaaa': (os.getpid(), other),
+                    'bbbb': (dead.pid, bin_),
+                    'bbbc': (os.getpid(), bin_),
+                    'cccc': (os.getpid(), bin_),
+                    'dddd': (None, bin_)}
+        for run, (pid, binary) in run_dirs.items():
+            os.makedirs(os.path.join(root, run, 'conf'))
+            os.symlink(binary, os.path.join(root, run, 'salt-2019.2.1'))
+            # The minion in bbbc runs with the config of another run_dir
+            conf_run = 'aaaa' if run == 'bbbc' else run
+            with open(os.path.join(root, run, 'conf', 'minion'), 'w') as fp:
+                fp.write(mk_minion_config(os.path.join(root, conf_run, 'root')))
+            if pid:
+                with open(os.path.join(root, run, 'pfile'), 'w') as fp:
+                    fp.write(str(pid))
+
+        ret = await heist.heist.salt_master._find_running(
+            mock_hub, 't', 'asyncssh', bin_, [os.path.join(root, run) for run in sorted(run_dirs)])
+
+        assert ret == (os.path.join(root, 'cccc'), os.getpid())
+        assert mock_hub.tunnel.asyncssh.cmd.call_count == 1
+        ret = await heist.heist.salt_master._find_running(
+            mock_hub, 't', 'asyncssh', bin_, [os.path.join(root, 'aaaa')])
+        assert ret is None
+
+    @pytest.mark.asyncio
+    async def test_transfer_running(self, mock_hub: testing.MockHub, local_tunnel):
+        '''
+        test heist.salt_master._transfer deploys nothing when a minion of the
+        artifact runs from an earlier deployment found by the facts
+        '''
+        bin_, root = local_tunnel
+        running = os.path.join(root, 'aaaa')
+        os.makedirs(os.path.join(running, 'conf'))
+        os.symlink(bin_, os.path.join(running, 'salt-2019.2.1'))
+        with open(os.path.join(running, 'conf', 'minion'), 'w') as fp:
+            fp.write(mk_minion_config(os.path.join(running, 'root')))
+        with open(os.path.join(running, 'pfile'), 'w') as fp:
+            fp.write(str(os.getpid()))
+        mock_hub.OPT = {'heist': {'artifacts_dir': 'art'}}
+        mock_hub.heist.CONS = {}
+        mock_hub.heist.facts.get.return_value = mk_facts(
+            deployments=(running, '/var/tmp/heist_other/beef'))
+        mock_hub.heist.salt_master.latest.return_value = bin_
+
+        ret = await heist.heist.salt_master._transfer(
+            mock_hub, 't', 'asyncssh', 'salt', 'linux', None, os.path.join(root, 'bbbb'))
+
+        assert ret == ('art/linux', bin_, os.path.join(running, 'salt-2019.2.1'))
+        mock_hub.heist.salt_master.deploy.assert_not_called()
+        assert mock_hub.heist.CONS['t']['run_dir'] == running
+        assert mock_hub.heist.CONS['t']['pid'] == os.getpid()
+
+    @pytest.mark.asyncio
+    async def test_transfer_no_artifact(self, mock_hub: testing.MockHub):
+        '''
+        test heist.salt_master._transfer gives up on the target when there
+        is no artifact to deploy
+        '''
+        mock_hub.OPT = {'heist': {'artifacts_dir': 'art'}}
+        mock_hub.heist.CONS = {}
+        mock_hub.heist.facts.get.return_value = mk_facts(free=1024)
+        mock_hub.heist.salt_master.latest.return_value = False
+
+        ret = await heist.heist.salt_master._transfer(
+            mock_hub, 't', 'asyncssh', 'salt', 'linux', '2019.2.1', '/var/tmp/heist_root/bbbb')
+
+        assert ret is None
+        mock_hub.heist.salt_master.deploy.assert_not_called()
+        assert mock_hub.heist.CONS == {}
+
+    @pytest.mark.asyncio
+    async def test_checkin_record_pid(self, mock_hub: testing.MockHub, tmp_path):
+        '''
+        test heist.salt_master.checkin caches the pid of a new minion once it
+        wrote its pidfile, together with the binary it runs
+        '''
+        bin_ = tmp_path / 'salt-2019.2.1'
+        bin_.write_bytes(b'salt')
+        mock_hub.OPT = {'heist': {'dynamic_upgrade': False}}
+        mock_hub.heist.salt_master.DIGESTS = {}
+        mock_hub.heist.CONS = {'t': {'t_type': 'asyncssh',
+                                     'run_dir': 'run',
+                                     'bin': str(bin_),
+                                     'pid': None,
+                                     'host': '127.0.0.1',
+                                     'fingerprint': 'SHA256:key'}}
+        mock_hub.tunnel.asyncssh.cmd.side_effect = [
+            asyncssh.process.SSHCompletedProcess(
+                command='cat', exit_status=1, returncode=1, stdout='', stderr='missing'),
+            asyncssh.process.SSHCompletedProcess(
+                command='cat', exit_status=0, returncode=0, stdout='4321\n', stderr='')]
+
+        await heist.heist.salt_master.checkin(mock_hub, 't')
+        mock_hub.heist.cache.put.assert_not_called()
+        await heist.heist.salt_master.checkin(mock_hub, 't')
+        await heist.heist.salt_master.checkin(mock_hub, 't')
+
+        mock_hub.tunnel.asyncssh.cmd.assert_called_with('t', 'cat run/pfile')
+        assert mock_hub.tunnel.asyncssh.cmd.call_count == 2
+        assert mock_hub.heist.CONS['t']['pid'] == 4321
+        mock_hub.heist.cache.put.assert_called_once_with(
+            '127.0.0.1', 'SHA256:key', pid=4321, bin=str(bin_),
+            sha=heist.heist.salt_master._hash(str(bin_)))
 
     @pytest.mark.asyncio
     async def test_get_start_cmd(self,
                                  mock_hub: testing.MockHub):
         '''
-        test heist.heist.salt_master._get_start_cmd when systemctl exists
+        test heist.heist.salt_master._get_start_cmd when systemd runs the
+        target
         '''
         # Setup
         t_name = secrets.token_hex()
         run_dir = os.path.join(os.sep, 'var', 'tmp', 'test')
         mock_hub.heist.ROSTERS[t_name]['bootstrap'] = True
-        cmd_ret = asyncssh.process.SSHCompletedProcess(
-            command={'which systemctl'},
-            exit_status=0,
-            returncode=0,
-            stdout='/usr/bin/systemctl',
-            stderr='')
-
-        mock_hub.tunnel.asyncssh.cmd.return_value = cmd_ret
+        mock_hub.heist.facts.get.return_value = mk_facts(
+            init='systemd', tools=frozenset({'systemctl', 'at'}))
 
         ret = await heist.heist.salt_master._get_start_cmd(mock_hub, 'asyncssh', t_name,
                                                            os.path.join(run_dir, 'salt-2019.2.2'),
                                                            run_dir, os.path.join(run_dir, 'pfile'))
         assert ret == 'systemctl start salt-minion'
+        mock_hub.tunnel.asyncssh.cmd.assert_not_called()
 
+    @pytest.mark.parametrize('tools,prefix', [({'systemctl', 'at', 'setsid', 'nohup'}, 'setsid '),
+                                              ({'nohup'}, 'nohup ')])
     @pytest.mark.asyncio
-    async def test_get_start_cmd_at(self,
-                                    mock_hub: testing.MockHub):
+    async def test_get_start_cmd_detached(self,
+                                          mock_hub: testing.MockHub,
+                                          tools,
+                                          prefix):
         '''
-        test heist.heist.salt_master._get_start_cmd when systemctl
-        does not exist but at does
+        test heist.heist.salt_master._get_start_cmd starts the minion in the
+        background when systemd does not run the target
         '''
         # Setup
         t_name = secrets.token_hex()
         run_dir = os.path.join(os.sep, 'var', 'tmp', 'test')
         mock_hub.heist.ROSTERS[t_name]['bootstrap'] = True
-        sys_ret = asyncssh.process.SSHCompletedProcess(
-            command={'which systemctl'},
-            exit_status=1,
-            returncode=1,
-            stdout='',
-            stderr='systemctl not found')
-        at_ret = asyncssh.process.SSHCompletedProcess(
-            command={'which at'},
-            exit_status=0,
-            returncode=0,
-            stdout='/usr/bin/at',
-            stderr='')
-
-
-        mock_hub.tunnel.asyncssh.cmd.side_effect = [sys_ret, at_ret]
+        mock_hub.heist.facts.get.return_value = mk_facts(tools=frozenset(tools))
 
         ret = await heist.heist.salt_master._get_start_cmd(mock_hub, 'asyncssh', t_name,
                                                            os.path.join(run_dir, 'salt-2019.2.2'),
                                                            run_dir, os.path.join(run_dir, 'pfile'))
-        assert ret == f'at -f {run_dir}/at-minion-scheduler.sh now + 1 minute'
+        assert ret == f'{prefix}{run_dir}/salt-2019.2.2 minion --config-dir {run_dir}/conf '\
+                      f'--pid-file={run_dir}/pfile </dev/null >>{run_dir}/minion.log 2>&1 &'
+        mock_hub.tunnel.asyncssh.cmd.assert_not_called()
 
     @pytest.mark.asyncio
     async def test_get_start_cmd_not_exist(self,
                                            mock_hub: testing.MockHub):
         '''
-        test heist.heist.salt_master._get_start_cmd when systemctl
-        and at do not exist
+        test heist.heist.salt_master._get_start_cmd when systemctl, setsid
+        and nohup do not exist
         '''
         # Setup
         t_name = secrets.token_hex()
         run_dir = os.path.join(os.sep, 'var', 'tmp', 'test')
         mock_hub.heist.ROSTERS[t_name]['bootstrap'] = True
-        sys_ret = asyncssh.process.SSHCompletedProcess(
-            command={'which systemctl'},
-            exit_status=1,
-            returncode=1,
-            stdout='',
-            stderr='systemctl not found')
-        at_ret = asyncssh.process.SSHCompletedProcess(
-            command={'which at'},
-            exit_status=1,
-            returncode=1,
-            stdout='',
-            stderr='at not found')
-        mock_hub.tunnel.asyncssh.cmd.side_effect = [sys_ret, at_ret]
+        mock_hub.heist.facts.get.return_value = mk_facts()
+
+        ret = await heist.heist.salt_master._get_start_cmd(mock_hub, 'asyncssh', t_name,
+                                                           os.path.join(run_dir, 'salt-2019.2.2'),
+                                                           run_dir, os.path.join(run_dir, 'pfile'))
+        assert ret == f'''sh -c 'trap "" HUP; exec {run_dir}/salt-2019.2.2 minion '''\
+                      f'''--config-dir {run_dir}/conf --pid-file={run_dir}/pfile' '''\
+                      f'</dev/null >>{run_dir}/minion.log 2>&1 &'
+
+    @pytest.mark.asyncio
+    async def test_get_start_cmd_foreground(self,
+                                            mock_hub: testing.MockHub):
+        '''
+        test heist.heist.salt_master._get_start_cmd runs the minion in the
+        ssh session when the target is not bootstrapped
+        '''
+        t_name = secrets.token_hex()
+        run_dir = os.path.join(os.sep, 'var', 'tmp', 'test')
+        mock_hub.heist.ROSTERS = {t_name: {}}
 
         ret = await heist.heist.salt_master._get_start_cmd(mock_hub, 'asyncssh', t_name,
                                                            os.path.join(run_dir, 'salt-2019.2.2'),
@@ -281,6 +876,164 @@ class TestSaltMaster:
         assert ret == f' {run_dir}/salt-2019.2.2 minion '\
                       f'--config-dir {run_dir}/conf --pid-file={run_dir}/pfile'
 
+    @pytest.mark.parametrize('delay,started', [(0.3, True), (5, False)])
+    @pytest.mark.asyncio
+    async def test_start_minion_detached(self,
+                                         mock_hub: testing.MockHub,
+                                         local_tunnel,
+                                         delay,
+                                         started):
+        '''
+        test heist.heist.salt_master._start_minion returns as soon as a minion
+        started in the background wrote its pidfile, and gives up on it at
+        the deadline
+        '''
+        if not shutil.which('setsid'):
+            pytest.skip('setsid is not installed')
+        _, root = local_tunnel
+        run_dir = os.path.join(root, 'aaaa')
+        os.makedirs(run_dir)
+        # A minion that takes a while to write its pidfile
+        tgt = os.path.join(run_dir, 'salt-2019.2.1')
+        with open(tgt, 'w') as fp:
+            fp.write('#!/bin/sh\n'
+                     f'sleep {delay}\n'
+                     'echo $$ > "${4#--pid-file=}"\n'
+                     'exec sleep 30\n')
+        os.chmod(tgt, 0o755)
+        mock_hub.OPT = {'heist': {'start_timeout': 1}}
+        mock_hub.heist.ROSTERS = {'t': {'bootstrap': True}}
+        mock_hub.heist.CONS = {'t': {'bin': tgt}}
+        mock_hub.heist.salt_master.FUTURES = {}
+        mock_hub.heist.facts.get.return_value = mk_facts(tools=frozenset({'setsid'}))
+
+        start = time.monotonic()
+        await heist.heist.salt_master._start_minion(mock_hub, 'asyncssh', 't', tgt, run_dir)
+        took = time.monotonic() - start
+        pfile = os.path.join(run_dir, 'pfile')
+        try:
+            if started:
+                assert took < 1
+                with open(pfile) as fp:
+                    assert mock_hub.heist.CONS['t']['pid'] == int(fp.read())
+            else:
+                assert 1 <= took < 2
+                assert 'pid' not in mock_hub.heist.CONS['t']
+        finally:
+            subprocess.run(f'pkill -f "{tgt}"', shell=True)
+
+    def test_established(self):
+        '''
+        test heist.heist.salt_master._established finds the remote ports of
+        the established connections in /proc/net/tcp and netstat output
+        '''
+        proc = ('  sl  local_address rem_address   st tx_queue rx_queue\n'
+                '   0: 0100007F:9C40 0100007F:ADF9 01 00000000:00000000\n'
+                '   1: 0100007F:9C41 0100007F:ADFA 01 00000000:00000000\n'
+                '   2: 00000000:0016 00000000:0000 0A 00000000:00000000\n')
+        netstat = ('Proto Recv-Q Send-Q  Local Address          Foreign Address        (state)\n'
+                   'tcp4       0      0  10.0.0.2.50123         10.0.0.1.4506          ESTABLISHED\n'
+                   'tcp4       0      0  10.0.0.2.50124         10.0.0.1.4505          TIME_WAIT\n')
+        assert heist.heist.salt_master._established(mock.MagicMock(stdout=proc)) == {44537, 44538}
+        assert heist.heist.salt_master._established(mock.MagicMock(stdout=netstat)) == {4506}
+
+    @pytest.mark.asyncio
+    async def test_wait_connected_port_str(self, mock_hub: testing.MockHub):
+        '''
+        test heist.heist.salt_master._wait_connected matches the ports of a
+        roster that gives them as strings
+        '''
+        mock_hub.OPT = {'heist': {'ready_timeout': 0.2}}
+        mock_hub.heist.ROSTERS = {'t': {'master_port': '4506', 'publish_port': '4505'}}
+        mock_hub.tunnel.asyncssh.cmd.return_value = mock.MagicMock(
+            returncode=0,
+            stdout=('   0: 0100007F:9C40 0100007F:119A 01 00000000:00000000\n'
+                    '   1: 0100007F:9C41 0100007F:1199 01 00000000:00000000\n'))
+
+        assert await heist.heist.salt_master._wait_connected(mock_hub, 'asyncssh', 't')
+        mock_hub.heist.ready.advance.assert_called_once_with('t', 'connected')
+
+    @pytest.mark.parametrize('connect_on,state,attempts', [(2, 'connected', 2),
+                                                           (3, 'failed', 2)])
+    @pytest.mark.asyncio
+    async def test_track_retry(self, mock_hub: testing.MockHub, call_through, tmp_path,
+                               connect_on, state, attempts):
+        '''
+        test heist.heist.salt_master._track starts a minion that never
+        connects again and gives up on it after ready_retries
+        '''
+        mock_hub.OPT = {'heist': {'start_timeout': 1, 'ready_timeout': 0.2, 'ready_retries': 1}}
+        mock_hub.heist.ROSTERS = {'t': {'master_port': 4506, 'publish_port': 4505}}
+        tgt = tmp_path / 'salt-2019.2.1'
+        tgt.write_bytes(b'salt')
+        mock_hub.heist.CONS = {'t': {'bin': str(tgt)}}
+        mock_hub.heist.salt_master.FUTURES = {}
+        mock_hub.heist.salt_master.DIGESTS = {}
+        mock_hub.heist.facts.get.return_value = mk_facts()
+        mock_hub.heist.ready.TARGETS = {}
+        mock_hub.heist.ready.TASKS = {}
+        call_through(mock_hub.heist.ready, heist.heist.ready,
+                     'begin', 'advance', 'fail', 'state', 'track', 'cancel')
+        starts = []
+
+        async def _cmd(name, command):
+            if 'pid-file' in command:
+                starts.append(command)
+            if 'kill -0' in command:
+                stdout = '1234\n'
+            elif '/proc/net/tcp' in command and len(starts) >= connect_on:
+                stdout = ('   0: 0100007F:9C40 0100007F:119A 01 00000000:00000000\n'
+                          '   1: 0100007F:9C41 0100007F:1199 01 00000000:00000000\n')
+            else:
+                stdout = ''
+            return mock.MagicMock(returncode=0, stdout=stdout)
+        mock_hub.tunnel.asyncssh.cmd.side_effect = _cmd
+
+        await heist.heist.salt_master._start_minion(mock_hub, 'asyncssh', 't', str(tgt), str(tmp_path))
+        while mock_hub.heist.ready.TASKS:
+            await asyncio.gather(*mock_hub.heist.ready.TASKS.values())
+
+        assert len(starts) == attempts
+        record = mock_hub.heist.ready.TARGETS['t']
+        assert record['state'] == state
+        assert record['attempts'] == attempts
+        if state == 'connected':
+            assert set(record['latency']) == {'started', 'alive', 'connected', 'total'}
+        else:
+            assert record['failed'] == 'connected'
+
+    def test_latest(self, mock_hub: testing.MockHub, call_through, tmp_path):
+        '''
+        test heist.heist.salt_master.latest returns the newest artifact and
+        only lists the directory again when it changes
+        '''
+        mock_hub.heist.salt_master.ARTIFACTS = {}
+        call_through(mock_hub.heist.salt_master, heist.heist.salt_master, 'index')
+        a_dir = str(tmp_path)
+        for fn in ('salt-2019.2.2', 'salt-2019.2.10', 'salt-2019.2.1', '.salt-3000.part', 'README'):
+            (tmp_path / fn).touch()
+
+        with mock.patch.object(os, 'listdir', wraps=os.listdir) as listdir:
+            assert heist.heist.salt_master.latest(mock_hub, 'salt', a_dir) == \
+                os.path.join(a_dir, 'salt-2019.2.10')
+            assert heist.heist.salt_master.latest(mock_hub, 'salt', a_dir, version='2019.2.1') == \
+                os.path.join(a_dir, 'salt-2019.2.1')
+            assert not heist.heist.salt_master.latest(mock_hub, 'salt', a_dir, version='3000')
+            assert listdir.call_count == 1
+
+            (tmp_path / 'salt-3000.1').touch()
+            os.utime(a_dir, ns=(0, os.stat(a_dir).st_mtime_ns + 1))
+            assert heist.heist.salt_master.latest(mock_hub, 'salt', a_dir) == \
+                os.path.join(a_dir, 'salt-3000.1')
+            assert listdir.call_count == 2
+
+    def test_latest_missing_dir(self, mock_hub: testing.MockHub, call_through, tmp_path):
+        '''
+        test heist.heist.salt_master.latest when there are no artifacts
+        '''
+        mock_hub.heist.salt_master.ARTIFACTS = {}
+        call_through(mock_hub.heist.salt_master, heist.heist.salt_master, 'index')
+        assert not heist.heist.salt_master.latest(mock_hub, 'salt', str(tmp_path / 'missing'))
 
     def test_mk_startup_conf_systemctl(self,
                                        mock_hub: testing.MockHub):
@@ -296,19 +1049,3 @@ class TestSaltMaster:
         with open(path, 'r') as _fp:
             content = _fp.read()
         assert '[Unit]\nDescription=The Salt Minion' in content
-
-    def test_mk_startup_conf_at(self,
-                                mock_hub: testing.MockHub):
-        '''
-        test heist.heist.salt_master.mk_startup_conf when cmd is at
-        '''
-        # Setup
-        run_dir = os.path.join(os.sep, 'var', 'tmp', 'test')
-
-        path = heist.heist.salt_master.mk_startup_conf(mock_hub, 'at',
-                                                       os.path.join(run_dir, 'salt-2019.2.2'),
-                                                       run_dir, os.path.join(run_dir, 'pfile'))
-        with open(path, 'r') as _fp:
-            content = _fp.read()
-        assert '[Unit]\nDescription=The Salt Minion' not in content
-        assert f'{run_dir}/salt-2019.2.2 minion' in content
@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+'''
+    unit tests for heist.heist.schedule
+'''
+# Import Python libs
+import asyncio
+import unittest.mock as mock
+
+# Import Local libs
+import heist.heist.schedule
+
+# Import 3rd-party libs
+import pop.mods.pop.testing as testing
+import pytest
+
+
+@pytest.fixture
+def schedule_hub(mock_hub: testing.MockHub, call_through):
+    '''
+    A mock hub where the scheduler functions call the real implementation
+    '''
+    mock_hub.OPT = {'heist': {'checkin_tick': 0.01,
+                              'checkin_jitter': 0.0,
+                              'checkin_batch': 2}}
+    heist.heist.schedule.__init__(mock_hub)
+    call_through(mock_hub.heist.schedule, heist.heist.schedule,
+                 'add', 'remove', 'wake', 'start', 'stop', 'join', 'status')
+    yield mock_hub
+    if mock_hub.heist.schedule.TASK is not None:
+        mock_hub.heist.schedule.TASK.cancel()
+
+
+class TestSchedule:
+    def test_place(self, schedule_hub):
+        '''
+        test entries further away than one turn of the wheel wait out the
+        extra turns in their slot
+        '''
+        wheel = schedule_hub.heist.schedule.WHEEL
+        wheel['pos'] = 10
+        slots = heist.heist.schedule.SLOTS
+        for delay, slot, rounds in [(0, 11, 0),
+                                    (0.05, 15, 0),
+                                    (slots * 0.01, 10, 0),
+                                    (slots * 0.01 + 0.01, 11, 1),
+                                    (slots * 0.03, 10, 2)]:
+            entry = {'key': 'k', 'slot': None}
+            heist.heist.schedule._place(schedule_hub, entry, delay)
+            assert (entry['slot'], entry['rounds']) == (slot, rounds)
+            heist.heist.schedule._unplace(schedule_hub, entry)
+        assert not any(wheel['slots'])
+
+    @pytest.mark.asyncio
+    async def test_add(self, schedule_hub):
+        '''
+        test entries run every interval, first at a point spread across the
+        interval, until they are removed
+        '''
+        runs = {}
+
+        async def _checkin(key):
+            runs[key] = runs.get(key, 0) + 1
+
+        with mock.patch('random.uniform', lambda a, b: (a + b) / 2):
+            for key in ('a', 'b', 'c'):
+                heist.heist.schedule.add(schedule_hub, key, 0.1, _checkin, key)
+        assert heist.heist.schedule.status(schedule_hub)['entries'] == 3
+        await asyncio.sleep(0.03)
+        # The first run is half way into the interval
+        assert runs == {}
+        await asyncio.sleep(0.2)
+        assert runs == {'a': 2, 'b': 2, 'c': 2}
+
+        heist.heist.schedule.remove(schedule_hub, 'b')
+        before = dict(runs)
+        await asyncio.sleep(0.15)
+        assert runs['b'] == before['b']
+        assert runs['a'] > before['a']
+
+        await heist.heist.schedule.stop(schedule_hub)
+        status = heist.heist.schedule.status(schedule_hub)
+        assert status['entries'] == 0
+        assert status['runs'] == sum(runs.values())
+
+    @pytest.mark.asyncio
+    async def test_batches(self, schedule_hub):
+        '''
+        test entries due on the same tick run checkin_batch at a time and a
+        slow batch does not hold up the wheel
+        '''
+        release = asyncio.Event()
+        running = []
+        peak = []
+
+        async def _checkin(key):
+            running.append(key)
+            peak.append(len(running))
+            await release.wait()
+            running.remove(key)
+
+        with mock.patch('random.uniform', lambda a, b: 0):
+            for key in range(5):
+                heist.heist.schedule.add(schedule_hub, key, 10, _checkin, key)
+        await asyncio.sleep(0.05)
+        assert running == [0, 1]
+        assert heist.heist.schedule.status(schedule_hub)['running'] == 2
+
+        ran = asyncio.Event()
+
+        async def _fast():
+            ran.set()
+        heist.heist.schedule.add(schedule_hub, 'fast', 10, _fast)
+        heist.heist.schedule.wake(schedule_hub, 'fast')
+        await asyncio.wait_for(ran.wait(), 1)
+
+        release.set()
+        await asyncio.sleep(0.01)
+        assert max(peak) == 2
+        assert heist.heist.schedule.status(schedule_hub)['runs'] == 6
+        await heist.heist.schedule.stop(schedule_hub)
+
+    @pytest.mark.asyncio
+    async def test_wake_and_failure(self, schedule_hub):
+        '''
+        test a woken entry runs on the next tick and a failing entry stays
+        scheduled
+        '''
+        calls = []
+
+        async def _checkin():
+            calls.append(True)
+            raise ValueError('broken')
+
+        heist.heist.schedule.add(schedule_hub, 'a', 60, _checkin)
+        heist.heist.schedule.wake(schedule_hub, 'a')
+        await asyncio.sleep(0.05)
+
+        assert calls == [True]
+        assert heist.heist.schedule.status(schedule_hub)['failures'] == 1
+        entry = schedule_hub.heist.schedule.WHEEL['entries']['a']
+        assert entry['slot'] is not None
+        await heist.heist.schedule.stop(schedule_hub)
+
+    @pytest.mark.asyncio
+    async def test_join(self, schedule_hub):
+        '''
+        test join returns at once when nothing is scheduled and waits for
+        the wheel otherwise
+        '''
+        await asyncio.wait_for(heist.heist.schedule.join(schedule_hub), 1)
+
+        async def _checkin():
+            pass
+        heist.heist.schedule.add(schedule_hub, 'a', 60, _checkin)
+        join = asyncio.ensure_future(heist.heist.schedule.join(schedule_hub))
+        await asyncio.sleep(0.03)
+        assert not join.done()
+        await heist.heist.schedule.stop(schedule_hub)
+        await asyncio.wait_for(join, 1)
@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+'''
+    unit tests for heist.heist.watch
+'''
+# Import Python libs
+import asyncio
+import os
+
+# Import Local libs
+import heist.heist.salt_master
+import heist.heist.watch
+
+# Import 3rd-party libs
+import pop.mods.pop.testing as testing
+import pytest
+
+
+@pytest.fixture
+def watch_hub(mock_hub: testing.MockHub, call_through):
+    '''
+    A mock hub where the watcher uses the real artifact index and publishing
+    '''
+    mock_hub.OPT = {'heist': {'watch_interval': 0.01}}
+    mock_hub.heist.watch.SUBSCRIBERS = {}
+    mock_hub.heist.watch.LATEST = {}
+    mock_hub.heist.watch.TASK = None
+    mock_hub.heist.salt_master.ARTIFACTS = {}
+    call_through(mock_hub.heist.salt_master, heist.heist.salt_master, 'index')
+    call_through(mock_hub.heist.watch, heist.heist.watch, 'scan', 'publish')
+    yield mock_hub
+    if mock_hub.heist.watch.TASK is not None:
+        mock_hub.heist.watch.TASK.cancel()
+
+
+def _add_artifact(a_dir, t_os, fn):
+    '''
+    Move an artifact into place the way heist downloads do
+    '''
+    os_dir = os.path.join(a_dir, t_os)
+    os.makedirs(os_dir, exist_ok=True)
+    tmp = os.path.join(os_dir, f'.{fn}.part')
+    with open(tmp, 'w') as fp:
+        fp.write('salt')
+    os.replace(tmp, os.path.join(os_dir, fn))
+
+
+class TestWatch:
+    def test_scan(self, watch_hub, tmp_path):
+        '''
+        test only artifacts that became the latest are published
+        '''
+        a_dir = str(tmp_path)
+        _add_artifact(a_dir, 'linux', 'salt-2019.2.1')
+        queue = heist.heist.watch.subscribe(watch_hub, 'linux')
+        heist.heist.watch.scan(watch_hub, a_dir, notify=False)
+        assert queue.empty()
+
+        _add_artifact(a_dir, 'linux', 'salt-2019.2.0')
+        heist.heist.watch.scan(watch_hub, a_dir)
+        assert queue.empty()
+
+        _add_artifact(a_dir, 'linux', 'salt-2019.2.2')
+        _add_artifact(a_dir, 'darwin', 'salt-2019.2.2')
+        heist.heist.watch.scan(watch_hub, a_dir)
+        assert queue.get_nowait() == ('salt', os.path.join(a_dir, 'linux', 'salt-2019.2.2'))
+        assert queue.empty()
+
+        heist.heist.watch.unsubscribe(watch_hub, 'linux', queue)
+        _add_artifact(a_dir, 'linux', 'salt-2019.2.3')
+        heist.heist.watch.scan(watch_hub, a_dir)
+        assert queue.empty()
+
+    @pytest.mark.parametrize('inotify', [True, False])
+    @pytest.mark.asyncio
+    async def test_start(self, watch_hub, tmp_path, monkeypatch, inotify):
+        '''
+        test the watcher publishes new artifacts, including ones for an os
+        directory created after it started
+        '''
+        if not inotify:
+            monkeypatch.setattr(heist.heist.watch, '_libc', lambda: None)
+        elif heist.heist.watch._libc() is None:
+            pytest.skip('inotify is not available')
+        a_dir = str(tmp_path)
+        _add_artifact(a_dir, 'linux', 'salt-2019.2.1')
+        linux = heist.heist.watch.subscribe(watch_hub, 'linux')
+        darwin = heist.heist.watch.subscribe(watch_hub, 'darwin')
+        heist.heist.watch.start(watch_hub, a_dir)
+        await asyncio.sleep(0.05)
+
+        _add_artifact(a_dir, 'linux', 'salt-2019.2.2')
+        assert await asyncio.wait_for(linux.get(), 2) == \
+            ('salt', os.path.join(a_dir, 'linux', 'salt-2019.2.2'))
+        os.makedirs(os.path.join(a_dir, 'darwin'))
+        await asyncio.sleep(0.05)
+        _add_artifact(a_dir, 'darwin', 'salt-2019.2.2')
+        assert await asyncio.wait_for(darwin.get(), 2) == \
+            ('salt', os.path.join(a_dir, 'darwin', 'salt-2019.2.2'))
+
+        await heist.heist.watch.stop(watch_hub)
+        assert watch_hub.heist.watch.TASK is None
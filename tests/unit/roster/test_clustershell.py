@@ -27,6 +27,7 @@ class TestClustershellRoster:
         addr = socket.gethostbyname(target)
         mock_hub.OPT = {'heist': {'target': target,
                                   'ssh_scan_ports': [22]}}
+        mock_hub.heist.dns.resolve_many.return_value = {target: addr}
 
         # Execute
         ret = await heist.roster.clustershell.read(mock_hub)
@@ -45,8 +46,27 @@ class TestClustershellRoster:
         target = '127.0.0.1'
         mock_hub.OPT = {'heist': {'target': target,
                                   'ssh_scan_ports': [22222]}}
+        mock_hub.heist.dns.resolve_many.return_value = {target: target}
 
         # Execute
         ret = await heist.roster.clustershell.read(mock_hub)
 
         assert ret == {}
+
+    @pytest.mark.asyncio
+    async def test_clustershell_unresolved(self, mock_hub):
+        '''
+        test clustershell roster skips hosts that do not resolve
+        '''
+        # Setup
+        mock_hub.OPT = {'heist': {'target': 'missing[1-2]',
+                                  'ssh_scan_ports': [22222]}}
+        mock_hub.heist.dns.resolve_many.return_value = {'missing1': None,
+                                                        'missing2': None}
+
+        # Execute
+        ret = await heist.roster.clustershell.read(mock_hub)
+
+        mock_hub.heist.dns.resolve_many.assert_called_once_with(
+            ['missing1', 'missing2'], family=socket.AF_INET)
+        assert ret == {}
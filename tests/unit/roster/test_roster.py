@@ -89,3 +89,47 @@ class TestSaltMaster:
 
         # Verify
         mock_hub.roster.flat.read.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_stream_read_fallback(self, mock_hub: testing.MockHub):
+        '''
+        test heist.roster.init.stream with a roster that only implements read
+        '''
+        # Setup
+        expected = [{'id': 'id_0'}, {'id': 'id_1'}]
+        mock_hub.roster.init.read.return_value = expected
+
+        # Execute
+        result = [r async for r in heist.roster.init.stream(mock_hub, 'flat')]
+
+        # Verify
+        mock_hub.roster.init.read.assert_called_once_with('flat')
+        assert result == expected
+
+    @pytest.mark.asyncio
+    async def test_stream_read_fallback_false(self, mock_hub: testing.MockHub):
+        '''
+        test heist.roster.init.stream when the roster read fails
+        '''
+        mock_hub.roster.init.read.return_value = False
+
+        assert [r async for r in heist.roster.init.stream(mock_hub, 'flat')] == []
+
+    @pytest.mark.asyncio
+    async def test_stream(self, mock_hub: testing.MockHub):
+        '''
+        test heist.roster.init.stream with a roster that streams targets
+        '''
+        # Setup
+        async def _stream():
+            yield 'id_0', {}
+            yield 'id_1', 'not a dict'
+            yield 'id_2', {'id': 'other'}
+        mock_hub.roster.scan.stream.side_effect = _stream
+
+        # Execute
+        result = [r async for r in heist.roster.init.stream(mock_hub, 'scan')]
+
+        # Verify
+        mock_hub.roster.init.read.assert_not_called()
+        assert result == [{'id': 'id_0'}, {'id': 'other'}]
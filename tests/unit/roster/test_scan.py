@@ -1,5 +1,9 @@
 #!/usr/bin/python3
 
+# Import python libs
+import asyncio
+import socket
+
 # Import local libs
 import heist.roster.scan
 
@@ -7,6 +11,37 @@ import heist.roster.scan
 import pytest
 
 
+def scan_opts(target, ports, concurrency=512, timeout=3.0):
+    return {'heist': {'target': target,
+                      'ssh_scan_ports': ports,
+                      'scan_concurrency': concurrency,
+                      'scan_timeout': timeout,
+                      'scan_banner_timeout': timeout}}
+
+
+@pytest.fixture
+async def listeners():
+    '''
+    Start fake ssh servers on a few loopback addresses that share a port
+    '''
+    async def _banner(reader, writer):
+        writer.write(b'SSH-2.0-heist_test\r\n')
+        await writer.drain()
+        writer.close()
+
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    servers = []
+    for addr in ('127.0.0.2', '127.0.0.5', '127.0.0.6'):
+        servers.append(await asyncio.start_server(_banner, addr, port))
+    yield port
+    for server in servers:
+        server.close()
+        await server.wait_closed()
+
+
 class TestScanRoster:
     '''
     unit tests for heist.roster.scan
@@ -18,8 +53,7 @@ class TestScanRoster:
         '''
         # Setup
         target = '127.0.0.1'
-        mock_hub.OPT = {'heist': {'target': target,
-                                  'ssh_scan_ports': [22]}}
+        mock_hub.OPT = scan_opts(target, [22])
 
         # Execute
         ret = await heist.roster.scan.read(mock_hub)
@@ -34,10 +68,67 @@ class TestScanRoster:
         '''
         # Setup
         target = '127.0.0.1'
-        mock_hub.OPT = {'heist': {'target': target,
-                                  'ssh_scan_ports': [22222]}}
+        mock_hub.OPT = scan_opts(target, [22222])
 
         # Execute
         ret = await heist.roster.scan.read(mock_hub)
 
         assert ret == {}
+
+    @pytest.mark.parametrize('concurrency', [1, 3, 512])
+    @pytest.mark.asyncio
+    async def test_read_network(self, mock_hub, listeners, concurrency):
+        '''
+        test scan roster against a network of loopback listeners returns
+        the open hosts in address order regardless of concurrency
+        '''
+        mock_hub.OPT = scan_opts('127.0.0.0/29', [22222, listeners],
+                                 concurrency=concurrency)
+
+        ret = await heist.roster.scan.read(mock_hub)
+
+        assert list(ret) == ['127.0.0.2', '127.0.0.5', '127.0.0.6']
+        for addr, data in ret.items():
+            assert data == {'host': addr, 'port': listeners}
+
+    @pytest.mark.asyncio
+    async def test_probe_banner_timeout(self, mock_hub):
+        '''
+        test a listener that never sends a banner does not block the probe
+        past the banner timeout
+        '''
+        async def _silent(reader, writer):
+            await reader.read()
+
+        server = await asyncio.start_server(_silent, '127.0.0.3', 0)
+        port = server.sockets[0].getsockname()[1]
+        mock_hub.OPT = scan_opts('127.0.0.3', [port], timeout=0.1)
+        try:
+            ret = await asyncio.wait_for(heist.roster.scan.read(mock_hub), 5)
+        finally:
+            server.close()
+            await server.wait_closed()
+
+        assert ret == {'127.0.0.3': {'host': '127.0.0.3', 'port': port}}
+
+    @pytest.mark.asyncio
+    async def test_read_invalid_target(self, mock_hub):
+        '''
+        test scan roster with a target that is not an address or network
+        '''
+        mock_hub.OPT = scan_opts('not-a-network', [22])
+
+        assert await heist.roster.scan.read(mock_hub) == {}
+
+    @pytest.mark.asyncio
+    async def test_stream(self, mock_hub, listeners):
+        '''
+        test the scan roster streams each open host once
+        '''
+        mock_hub.OPT = scan_opts('127.0.0.0/29', [listeners, listeners])
+
+        ret = [t async for t in heist.roster.scan.stream(mock_hub)]
+
+        assert sorted(addr for addr, _ in ret) == ['127.0.0.2', '127.0.0.5', '127.0.0.6']
+        for addr, data in ret:
+            assert data == {'host': addr, 'port': listeners}
@@ -1,8 +1,112 @@
 #!/usr/bin/python3
+# Import python libs
+import asyncio
+import os
+import shutil
+import subprocess
+
 # Import local libs
 import heist.tunnel.asyncssh_tunnel as asyncssh_tunnel
+import tests.helpers as helpers
 import unittest.mock as mock
 
+# Import 3rd-party libs
+import asyncssh
+import asyncssh.process
+import pytest
+
+BLOCK = asyncssh_tunnel.DELTA_BLOCK_SIZE
+
+
+def sftp_con(sftp, **kwargs):
+    con = {'sftp': sftp,
+           'block_size': 0,
+           'max_requests': 0,
+           'rtt': None,
+           'bandwidth': asyncssh_tunnel.SFTP_BANDWIDTH,
+           'measured': False,
+           'compression': 'auto',
+           'decompressors': None,
+           'stats': {'transfers': 0, 'bytes': 0, 'seconds': 0.0, 'last': None}}
+    con.update(kwargs)
+    return con
+
+
+@pytest.fixture
+def local_con(mock_hub, call_through, tmp_path):
+    '''
+    A connection on the mock hub whose commands and sftp transfers run on
+    this host
+    '''
+    async def _cmd(name, command):
+        ret = subprocess.run(command, shell=True, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, universal_newlines=True)
+        return asyncssh.process.SSHCompletedProcess(
+            command=command, exit_status=ret.returncode, returncode=ret.returncode,
+            stdout=ret.stdout, stderr=ret.stderr)
+
+    async def _put(source, dest):
+        shutil.copy(source, dest)
+
+    class _File:
+        def __init__(self, path, mode, **kwargs):
+            self.fp = open(path, mode)
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            self.fp.close()
+
+        async def write(self, data):
+            assert isinstance(data, memoryview)
+            self.fp.write(data)
+
+    sftp = mock.Mock()
+    sftp.put = mock.Mock(side_effect=_put)
+    sftp.open = mock.Mock(side_effect=_File)
+
+    async def _realpath(path):
+        return '/'
+    sftp.realpath = mock.Mock(side_effect=_realpath)
+
+    async def _remove(path):
+        os.remove(path)
+    sftp.remove = mock.Mock(side_effect=_remove)
+    mock_hub.tunnel.asyncssh.cmd.side_effect = _cmd
+    call_through(mock_hub.tunnel.asyncssh, asyncssh_tunnel, 'send_buffer')
+    class _Process:
+        def __init__(self, command):
+            self.command = command
+            self.stdin = self
+            self.data = []
+
+        def write(self, data):
+            self.data.append(data)
+
+        async def drain(self):
+            pass
+
+        def write_eof(self):
+            pass
+
+        async def wait(self):
+            ret = subprocess.run(self.command, shell=True, input=b''.join(self.data),
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            return asyncssh.process.SSHCompletedProcess(
+                command=self.command, exit_status=ret.returncode, returncode=ret.returncode,
+                stdout=ret.stdout, stderr=ret.stderr)
+
+    async def _create_process(command, encoding=None):
+        return _Process(command)
+
+    con = mock.Mock()
+    con.create_process = mock.Mock(side_effect=_create_process)
+    mock_hub.tunnel.asyncssh.CONS = {'t': sftp_con(sftp, con=con)}
+    mock_hub.tunnel.asyncssh.BUFFERS = {}
+    mock_hub.tunnel.asyncssh.COMPRESSED = {}
+    return tmp_path
+
 
 class TestAsyncSSH:
     def test__get_asyncssh_opt_target(self, mock_hub):
@@ -35,3 +139,441 @@ class TestAsyncSSH:
 
     def test_autodetect_asyncssh_opt(self):
         ...
+
+    def test_fingerprint(self, mock_hub):
+        '''
+        Test the fingerprint of the host key of the connection is returned
+        '''
+        con = mock.Mock()
+        con.get_server_host_key.return_value.get_fingerprint.return_value = 'SHA256:key'
+        mock_hub.tunnel.asyncssh.CONS = {'t': {'con': con}}
+        assert asyncssh_tunnel.fingerprint(mock_hub, 't') == 'SHA256:key'
+        con.get_server_host_key.return_value = None
+        assert asyncssh_tunnel.fingerprint(mock_hub, 't') == ''
+
+
+class TestAsyncSSHSend:
+    @pytest.mark.parametrize('changed,delta',
+                             [([3], True),
+                              ([0, 5, 9], True),
+                              (range(10), False)])
+    @pytest.mark.asyncio
+    async def test_send_delta(self, mock_hub, local_con, changed, delta):
+        '''
+        test send only sends the changed blocks when the basis shares most
+        of the file and the whole file otherwise
+        '''
+        old = os.urandom(BLOCK * 10 + 123)
+        new = bytearray(old)
+        for index in changed:
+            new[index * BLOCK:(index + 1) * BLOCK] = os.urandom(BLOCK)
+        basis = local_con / 'basis'
+        basis.write_bytes(old)
+        source = local_con / 'source'
+        source.write_bytes(bytes(new))
+        dest = local_con / 'dest'
+
+        await asyncssh_tunnel.send(mock_hub, 't', str(source), str(dest), basis=str(basis))
+
+        assert dest.read_bytes() == bytes(new)
+        sftp = mock_hub.tunnel.asyncssh.CONS['t']['sftp']
+        saved = mock_hub.tunnel.asyncssh.CONS['t'].get('saved', 0)
+        if delta:
+            sftp.open.assert_not_called()
+            assert saved > BLOCK * (10 - len(changed)) - 1024
+        else:
+            assert sftp.open.call_args[0] == (str(dest), 'wb')
+            assert saved == 0
+        assert sorted(os.listdir(local_con)) == ['basis', 'dest', 'source']
+
+    @pytest.mark.asyncio
+    async def test_send_delta_missing_basis(self, mock_hub, local_con):
+        '''
+        test send falls back to sending the whole file without a basis
+        '''
+        source = local_con / 'source'
+        source.write_bytes(os.urandom(BLOCK * 2))
+        dest = local_con / 'dest'
+
+        await asyncssh_tunnel.send(mock_hub, 't', str(source), str(dest),
+                                   basis=str(local_con / 'missing'))
+
+        assert dest.read_bytes() == source.read_bytes()
+        sftp = mock_hub.tunnel.asyncssh.CONS['t']['sftp']
+        assert sftp.open.call_args[0] == (str(dest), 'wb')
+
+    @pytest.mark.parametrize('size', [0, BLOCK * 3 + 1])
+    @pytest.mark.asyncio
+    async def test_send_shared_buffer(self, mock_hub, local_con, size):
+        '''
+        test concurrent uploads of the same file share one memory map that
+        is closed after the last upload
+        '''
+        source = local_con / 'source'
+        source.write_bytes(os.urandom(size))
+        release = asyncio.Event()
+        views = []
+
+        async def _send_buffer(name, buffer, dest):
+            views.append(buffer)
+            await release.wait()
+            await asyncssh_tunnel.send_buffer(mock_hub, name, buffer, dest)
+        mock_hub.tunnel.asyncssh.send_buffer.side_effect = _send_buffer
+
+        sends = [asyncio.ensure_future(asyncssh_tunnel.send(
+            mock_hub, 't', str(source), str(local_con / f'dest{i}'))) for i in range(5)]
+        await asyncio.sleep(0)
+        assert len(mock_hub.tunnel.asyncssh.BUFFERS) == 1
+        assert all(view is views[0] for view in views)
+        release.set()
+        await asyncio.gather(*sends)
+
+        assert mock_hub.tunnel.asyncssh.BUFFERS == {}
+        for i in range(5):
+            assert (local_con / f'dest{i}').read_bytes() == source.read_bytes()
+
+    @pytest.mark.parametrize('opts,rtt,expected',
+                             [({}, 0.001, (BLOCK, 16)),
+                              ({}, 0.15, (BLOCK, 58)),
+                              ({}, 30.0, (BLOCK, 1024)),
+                              ({'block_size': 32768}, 0.15, (32768, 115)),
+                              ({'block_size': 32768, 'max_requests': 8}, None, (32768, 8))])
+    @pytest.mark.asyncio
+    async def test_sftp_opts(self, mock_hub, opts, rtt, expected):
+        '''
+        test uploads keep twice the bandwidth-delay product in flight unless
+        the roster or cli set the request count
+        '''
+        sftp = mock.Mock()
+        mock_hub.tunnel.asyncssh.CONS = {'t': sftp_con(sftp, rtt=rtt, **opts)}
+
+        assert await asyncssh_tunnel._sftp_opts(mock_hub, 't') == expected
+        sftp.realpath.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_sftp_opts_measure_rtt(self, mock_hub, local_con):
+        '''
+        test the latency of a connection is measured once before its first
+        tuned upload and the throughput of each upload is kept
+        '''
+        source = local_con / 'source'
+        source.write_bytes(os.urandom(BLOCK * 4))
+
+        for dest in ('dest1', 'dest2'):
+            await asyncssh_tunnel.send(mock_hub, 't', str(source), str(local_con / dest))
+
+        con = mock_hub.tunnel.asyncssh.CONS['t']
+        con['sftp'].realpath.assert_called_once_with('.')
+        assert con['rtt'] is not None
+        assert con['stats']['transfers'] == 2
+        assert con['stats']['bytes'] == BLOCK * 8
+        assert con['stats']['last']['dest'] == str(local_con / 'dest2')
+        assert con['sftp'].open.call_args[1] == {'block_size': BLOCK, 'max_requests': 16}
+
+    @pytest.mark.asyncio
+    async def test_send_buffer_sftp(self, mock_hub, tmp_path):
+        '''
+        test send_buffer relies on the asyncssh sftp client to split a large
+        buffer into write requests of block_size with at most max_requests
+        in flight
+        '''
+        key = os.path.join(os.path.dirname(helpers.__file__), 'id_rsa_testing')
+        writes = []
+        inflight = [0, 0]
+        real_write = asyncssh.sftp.SFTPClientHandler.write
+
+        async def _write(handler, handle, offset, data):
+            writes.append(len(data))
+            inflight[0] += 1
+            inflight[1] = max(inflight)
+            try:
+                return await real_write(handler, handle, offset, data)
+            finally:
+                inflight[0] -= 1
+
+        server = await asyncssh.listen(
+            '127.0.0.1', 0, server_host_keys=[key], authorized_client_keys=f'{key}.pub',
+            sftp_factory=lambda chan: asyncssh.SFTPServer(chan, chroot=str(tmp_path)))
+        port = server.sockets[0].getsockname()[1]
+        try:
+            async with asyncssh.connect('127.0.0.1', port, client_keys=[key], known_hosts=None,
+                                        username='heist') as con:
+                async with con.start_sftp_client() as sftp:
+                    mock_hub.tunnel.asyncssh.CONS = {
+                        't': sftp_con(sftp, block_size=16384, max_requests=4)}
+                    data = os.urandom(16384 * 10 + 1)
+                    with mock.patch.object(asyncssh.sftp.SFTPClientHandler, 'write', _write):
+                        await asyncssh_tunnel.send_buffer(mock_hub, 't', data, 'dest')
+        finally:
+            server.close()
+
+        assert (tmp_path / 'dest').read_bytes() == data
+        assert len(writes) == 11
+        assert max(writes) == 16384
+        assert 1 < inflight[1] <= 4
+
+    @pytest.mark.parametrize('rate,bandwidth',
+                             [(BLOCK * 16 / 0.1, BLOCK * 16 / 0.1 * 2),
+                              (1000.0, 1000.0)])
+    def test_record(self, mock_hub, rate, bandwidth):
+        '''
+        test the bandwidth estimate grows while uploads are limited by the
+        requests in flight and follows the measured rate otherwise
+        '''
+        mock_hub.tunnel.asyncssh.CONS = {'t': sftp_con(None, rtt=0.1, bandwidth=0)}
+        size = BLOCK * 64
+
+        asyncssh_tunnel._record(mock_hub, 't', 'dest', size, size / rate, BLOCK, 16)
+
+        assert mock_hub.tunnel.asyncssh.CONS['t']['bandwidth'] == pytest.approx(bandwidth)
+        assert mock_hub.tunnel.asyncssh.CONS['t']['measured']
+
+    @pytest.mark.asyncio
+    async def test_measure(self, mock_hub, local_con):
+        '''
+        test the bandwidth of a connection is measured with a timed upload
+        that is removed again
+        '''
+        con = mock_hub.tunnel.asyncssh.CONS['t']
+
+        await asyncssh_tunnel._measure(mock_hub, 't', str(local_con / 'dest'))
+
+        assert con['measured']
+        assert con['bandwidth'] != asyncssh_tunnel.SFTP_BANDWIDTH
+        assert con['sftp'].open.call_args[0] == (str(local_con / 'dest.probe'), 'wb')
+        assert con['sftp'].open.call_args[1]['max_requests'] == 16
+        assert os.listdir(local_con) == []
+
+    @pytest.mark.parametrize('choice,found,bandwidth,size,expected',
+                             [('auto', 'xz', 1e6, 2 ** 24, 'xz'),
+                              ('auto', '', 1e6, 2 ** 24, None),
+                              ('auto', 'xz', 1e6, 1024, None),
+                              ('auto', 'xz', 1e9, 2 ** 24, None),
+                              ('auto', 'xz zstd', 1e9, 2 ** 24,
+                               'zstd' if asyncssh_tunnel.HAS_ZSTD else None),
+                              ('none', 'xz', 1e6, 2 ** 24, None),
+                              ('xz', 'xz', 1e9, 2 ** 24, 'xz'),
+                              ('xz', 'zstd', 1e6, 2 ** 24, None)])
+    @pytest.mark.asyncio
+    async def test_codec(self, mock_hub, choice, found, bandwidth, size, expected):
+        '''
+        test the codec is picked from the link speed and the decompressors
+        the target has, unless the roster or cli pick one
+        '''
+        stdout = ''.join(f'/usr/bin/{prog}\n' for prog in found.split())
+        mock_hub.tunnel.asyncssh.cmd.return_value = asyncssh.process.SSHCompletedProcess(
+            command='', exit_status=0, returncode=0, stdout=stdout, stderr='')
+        mock_hub.tunnel.asyncssh.CONS = {'t': sftp_con(None, compression=choice,
+                                                       bandwidth=bandwidth, measured=True)}
+
+        assert await asyncssh_tunnel._codec(mock_hub, 't', size, 'dest') == expected
+
+    @pytest.mark.parametrize('bandwidth,expected', [(1e6, 'xz'), (1e9, None), (None, None)])
+    @pytest.mark.asyncio
+    async def test_codec_measure(self, mock_hub, bandwidth, expected):
+        '''
+        test the codec is only picked once the bandwidth of the connection
+        was measured, and the file is sent as it is when that fails
+        '''
+        mock_hub.tunnel.asyncssh.cmd.return_value = asyncssh.process.SSHCompletedProcess(
+            command='', exit_status=0, returncode=0, stdout='/usr/bin/xz\n', stderr='')
+        mock_hub.tunnel.asyncssh.CONS = {'t': sftp_con(None)}
+        probes = []
+
+        async def _measure(hub, name, dest):
+            probes.append(dest)
+            if bandwidth is None:
+                raise OSError('Permission denied')
+            hub.tunnel.asyncssh.CONS[name].update(bandwidth=bandwidth, measured=True)
+
+        with mock.patch.object(asyncssh_tunnel, '_measure', _measure):
+            for _ in range(2):
+                assert await asyncssh_tunnel._codec(mock_hub, 't', 2 ** 24, 'dest') == expected
+        assert probes == ['dest'] * (2 if bandwidth is None else 1)
+
+    @pytest.mark.asyncio
+    async def test_send_compressed(self, mock_hub, local_con):
+        '''
+        test a large file is streamed compressed into the decompressor on a
+        slow link and the compressed copy is made once
+        '''
+        if not shutil.which('xz'):
+            pytest.skip('xz is not installed')
+        mock_hub.tunnel.asyncssh.CONS['t'].update(bandwidth=1e6, measured=True, rtt=0.01)
+        mock_hub.tunnel.asyncssh.CONS['t']['decompressors'] = {'xz'}
+        art_dir = local_con / 'art'
+        art_dir.mkdir()
+        source = art_dir / 'salt-2019.2.1'
+        source.write_bytes(b'salt minion ' * 200000)
+
+        for dest in ('dest1', 'dest2'):
+            await asyncssh_tunnel.send(mock_hub, 't', str(source), str(local_con / dest))
+            assert (local_con / dest).read_bytes() == source.read_bytes()
+
+        con = mock_hub.tunnel.asyncssh.CONS['t']
+        assert con['con'].create_process.call_count == 2
+        con['sftp'].open.assert_not_called()
+        assert sorted(os.listdir(art_dir)) == ['.salt-2019.2.1.xz', 'salt-2019.2.1']
+        assert con['stats']['bytes'] < source.stat().st_size / 10
+        # Compressed transfers are bound by the decompressor as much as the link
+        assert con['bandwidth'] == 1e6
+
+    @pytest.mark.asyncio
+    async def test_send_many(self, mock_hub, local_con):
+        '''
+        test the files, directories and links are unpacked by one tar process
+        with their modes, and an existing link is replaced
+        '''
+        if not shutil.which('tar'):
+            pytest.skip('tar is not installed')
+        config = local_con / 'minion'
+        config.write_text('master: 127.0.0.1')
+        binary = local_con / 'salt'
+        binary.write_bytes(b'salt' * 100000)
+        dest = local_con / 'heist'
+        files = {'run/conf/minion': str(config),
+                 'run/root': None,
+                 'run/salt-run': {'source': str(binary), 'mode': 0o750},
+                 'run/salt': {'symlink': str(binary)}}
+
+        for _ in range(2):
+            await asyncssh_tunnel.send_many(mock_hub, 't', str(dest), files)
+
+        assert (dest / 'run' / 'conf' / 'minion').read_text() == 'master: 127.0.0.1'
+        assert (dest / 'run' / 'root').is_dir()
+        assert (dest / 'run' / 'salt-run').read_bytes() == binary.read_bytes()
+        assert (dest / 'run' / 'salt-run').stat().st_mode & 0o777 == 0o750
+        assert os.readlink(dest / 'run' / 'salt') == str(binary)
+        con = mock_hub.tunnel.asyncssh.CONS['t']
+        assert con['con'].create_process.call_count == 2
+        assert not mock_hub.tunnel.asyncssh.BUFFERS
+
+    @pytest.mark.asyncio
+    async def test_send_many_fail(self, mock_hub, local_con):
+        '''
+        test a failed unpack raises
+        '''
+        dest = local_con / 'file'
+        dest.write_text('not a directory')
+        with pytest.raises(OSError):
+            await asyncssh_tunnel.send_many(mock_hub, 't', str(dest), {'root': None})
+
+
+@pytest.fixture
+async def shell_con(mock_hub):
+    '''
+    A connection on the mock hub with the persistent shell enabled, the
+    shells run on this host. Their pipes buffer without a limit, like the
+    channels of asyncssh
+    '''
+    shells = []
+
+    async def _create_process(command, encoding=None):
+        shell = await asyncio.create_subprocess_shell(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            limit=2 ** 24)
+        shells.append(shell)
+        return shell
+
+    async def _run(command):
+        return asyncssh.process.SSHCompletedProcess(
+            command=command, exit_status=0, returncode=0, stdout='', stderr='')
+
+    con = mock.Mock()
+    con.create_process = mock.Mock(side_effect=_create_process)
+    con.run = mock.Mock(side_effect=_run)
+    mock_hub.tunnel.asyncssh.CONS = {'t': {'con': con,
+                                           'persistent_shell': True,
+                                           'shell': None,
+                                           'shell_lock': asyncio.Lock()}}
+    yield con
+    asyncssh_tunnel._close_shell(mock_hub, 't')
+    for shell in shells:
+        await shell.wait()
+
+
+class TestAsyncSSHCmd:
+    @pytest.mark.asyncio
+    async def test_cmd_shell(self, mock_hub, shell_con):
+        '''
+        test commands run one after another in a single shell and their
+        output and return codes are kept apart
+        '''
+        ret = await asyncssh_tunnel.cmd(mock_hub, 't', 'echo out; echo err >&2; exit 3')
+        assert (ret.returncode, ret.stdout, ret.stderr) == (3, 'out\n', 'err\n')
+        # A command that exits does not end the shell
+        ret = await asyncssh_tunnel.cmd(mock_hub, 't', 'printf no-newline; cat')
+        assert (ret.returncode, ret.stdout, ret.stderr) == (0, 'no-newline', '')
+        ret = await asyncssh_tunnel.cmd(mock_hub, 't', 'false')
+        assert ret.returncode == 1
+
+        shell_con.create_process.assert_called_once_with('sh', encoding=None)
+        shell_con.run.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_cmd_shell_busy(self, mock_hub, shell_con):
+        '''
+        test a command sent while the shell is busy runs on its own channel
+        '''
+        slow = asyncio.ensure_future(asyncssh_tunnel.cmd(mock_hub, 't', 'sleep 0.2; echo slow'))
+        await asyncio.sleep(0.05)
+        await asyncssh_tunnel.cmd(mock_hub, 't', 'echo fast')
+        assert (await slow).stdout == 'slow\n'
+        shell_con.run.assert_called_once_with('echo fast')
+
+    @pytest.mark.asyncio
+    async def test_cmd_shell_gone(self, mock_hub, shell_con):
+        '''
+        test a command the shell exited on is not run a second time and the
+        next command starts a new shell
+        '''
+        await asyncssh_tunnel.cmd(mock_hub, 't', 'true')
+        with pytest.raises(EOFError):
+            await asyncssh_tunnel.cmd(mock_hub, 't', 'kill -9 $$')
+        shell_con.run.assert_not_called()
+        assert mock_hub.tunnel.asyncssh.CONS['t']['shell'] is None
+        ret = await asyncssh_tunnel.cmd(mock_hub, 't', 'echo again')
+        assert ret.stdout == 'again\n'
+        assert shell_con.create_process.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_cmd_shell_exited(self, mock_hub, shell_con):
+        '''
+        test a shell that exited between commands is replaced before the
+        next command is sent, and the command runs on its own channel when
+        no shell can be started
+        '''
+        await asyncssh_tunnel.cmd(mock_hub, 't', 'true')
+        shell = mock_hub.tunnel.asyncssh.CONS['t']['shell']
+        shell.kill()
+        await shell.wait()
+        ret = await asyncssh_tunnel.cmd(mock_hub, 't', 'echo new')
+        assert ret.stdout == 'new\n'
+        assert shell_con.create_process.call_count == 2
+
+        asyncssh_tunnel._close_shell(mock_hub, 't')
+        shell_con.create_process.side_effect = ConnectionResetError
+        mock_hub.tunnel.asyncssh.CONS['t']['sudo'] = True
+        await asyncssh_tunnel.cmd(mock_hub, 't', 'true')
+        shell_con.run.assert_called_once_with('sudo true')
+
+    @pytest.mark.asyncio
+    async def test_cmd_shell_stderr(self, mock_hub, shell_con):
+        '''
+        test a command that writes more to stderr than a pipe holds before
+        its stdout is done does not hold up the shell
+        '''
+        ret = await asyncio.wait_for(asyncssh_tunnel.cmd(
+            mock_hub, 't', 'head -c 1000000 /dev/zero | tr "\\0" e >&2; echo out'), 5)
+        assert ret.stdout == 'out\n'
+        assert len(ret.stderr) == 1000000
+
+    @pytest.mark.asyncio
+    async def test_cmd_no_shell(self, mock_hub, shell_con):
+        '''
+        test every command gets its own channel without the persistent shell
+        '''
+        mock_hub.tunnel.asyncssh.CONS['t'].update({'persistent_shell': False, 'sudo': True})
+        await asyncssh_tunnel.cmd(mock_hub, 't', 'true')
+        shell_con.run.assert_called_once_with('sudo true')
+        shell_con.create_process.assert_not_called()